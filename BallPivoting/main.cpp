@@ -52,8 +52,9 @@ int main(int argc, char **argv)
     int outfile_flag = -1;
     std::list<double> radii;
     int parallel_flag = -1;
+    int binary_flag = -1;
 
-    while( (c = getopt(argc,argv, "i:o:d:r:p")) != -1)
+    while( (c = getopt(argc,argv, "i:o:d:r:pb")) != -1)
     {
         switch(c)
         {
@@ -85,6 +86,11 @@ int main(int argc, char **argv)
                 parallel_flag = 1;
                 break;
             }
+            case 'b':
+            {
+                binary_flag = 1;
+                break;
+            }
             case 'r': 
             {
                 input_radii=optarg;
@@ -111,6 +117,14 @@ int main(int argc, char **argv)
         return EXIT_FAILURE;
     }
 
+    //"-" stands for the standard streams: the mesh is then written as raw
+    //binary arrays and all messages are redirected to the error stream
+    if(infile == "-" || outfile == "-")
+        std::ios::sync_with_stdio(false);
+    std::streambuf *mesh_buffer = std::cout.rdbuf();
+    if(outfile == "-")
+        std::cout.rdbuf(std::cerr.rdbuf());
+
     if(radius_flag == 1)
     {
         radii.sort();
@@ -124,14 +138,22 @@ int main(int argc, char **argv)
 
     std::time(&start);
     bool ok;
-    if(radius >0)
+    if(radius <= 0)
+        octree.setDepth(depth);
+
+    if(infile == "-")
+    {
+        ok = FileIO::readAndSortPoints(std::cin,octree,radius,
+                                       binary_flag == 1);
+    }
+    else if(binary_flag == 1)
     {
-        ok = FileIO::readAndSortPoints(infile.c_str(),octree,radius); 
+        std::ifstream in(infile.c_str(), std::ios::binary);
+        ok = in && FileIO::readAndSortPoints(in,octree,radius,true);
     }
     else
     {
-        octree.setDepth(depth);
-        ok = FileIO::readAndSortPoints(infile.c_str(),octree);  
+        ok = FileIO::readAndSortPoints(infile.c_str(),octree,radius);
     }
     if( !ok )
     {
@@ -191,7 +213,17 @@ int main(int argc, char **argv)
              <<" vertices; "<<mesher.nFacets()<<" facets. "<<std::endl;
     std::cout<<mesher.nBorderEdges()<<" border edges"<<std::endl;
 
-    if(! FileIO::saveMesh(outfile.c_str(), mesher))
+    if(outfile == "-")
+    {
+        std::ostream mesh_out(mesh_buffer);
+        ok = FileIO::saveMeshBinary(mesh_out, mesher);
+    }
+    else
+    {
+        ok = FileIO::saveMesh(outfile.c_str(), mesher);
+    }
+
+    if(! ok)
     {
         std::cerr<<"Pb saving the mesh; exiting."<<std::endl;
         return EXIT_FAILURE;
@@ -17,74 +17,374 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Can also be used as a module: readPly returns the vertices (with all their
+# properties: normals, colors, ...) and faces as numpy arrays.
+#
+# Triangle meshes can be decimated on the way with the scanner mesher
+# (src/mesher/meshfile.py simplify), when it is found next to this script.
 
 
 import sys
 import os
-import string
+import getopt
+from itertools import islice
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+try:
+    from mesher.meshfile import simplify
+except ImportError:
+    simplify = None
+
+# Number of lines (ascii) or elements (binary) processed at once
+BLOCK = 1 << 16
+
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'
+}
+
+ENDIANNESS = {'ascii': '=', 'binary_little_endian': '<', 'binary_big_endian': '>'}
+
+
+class PlyError(Exception):
+    pass
+
+
+def readHeader(plyfile):
+    """
+    Read a PLY header, return the format and the list of elements as
+    (name, count, properties), properties being (name, type) for scalars
+    and (name, (count type, index type)) for lists
+    """
+    if plyfile.readline().strip() != "ply":
+        raise PlyError("Bad PLY file header")
+
+    fmt, elements = None, []
+    # readline (not iteration) keeps the file position right for binary data
+    for line in iter(plyfile.readline, ''):
+        t = line.split()
+        if t == [] or t[0] in ('comment', 'obj_info'):
+            continue
+        if t[0] == "format":
+            fmt = t[1]
+        elif t[0] == "element":
+            elements.append((t[1], int(t[2]), []))
+        elif t[0] == "property" and t[1] == "list":
+            elements[-1][2].append((t[4], (PLY_TYPES[t[2]], PLY_TYPES[t[3]])))
+        elif t[0] == "property":
+            elements[-1][2].append((t[2], PLY_TYPES[t[1]]))
+        elif t[0] == "end_header":
+            break
+
+    if fmt not in ENDIANNESS:
+        raise PlyError("Unknown PLY format %s" % fmt)
+    names = [e[0] for e in elements]
+    if 'vertex' not in names or 'face' not in names:
+        raise PlyError("Imcomplete PLY file header")
+    return fmt, elements
+
+
+def scalarDtype(properties, endian):
+    if any(isinstance(kind, tuple) for name, kind in properties):
+        raise PlyError("Only the face element can hold lists")
+    return np.dtype([(name, endian+kind) for name, kind in properties])
+
+
+def readAsciiBlocks(plyfile, count):
+    """ Yields the next count lines, BLOCK lines at a time """
+    while count > 0:
+        lines = list(islice(plyfile, min(count, BLOCK)))
+        if len(lines) == 0:
+            raise PlyError("Unexpected end of file")
+        yield lines
+        count -= len(lines)
+
+
+def readAsciiLines(plyfile, count):
+    """ Read count lines as a 2D array of numbers, BLOCK lines at a time """
+    blocks = []
+    for lines in readAsciiBlocks(plyfile, count):
+        values = np.fromstring(" ".join(lines), sep=" ")
+        if values.size % len(lines) != 0:
+            raise PlyError("Lines of an element must all have the same length")
+        blocks.append(values.reshape((len(lines), -1)))
+    return np.vstack(blocks) if blocks else np.zeros((0, 0))
+
+
+def mergeFaces(blocks, degree=3):
+    """ (m,k) array of blocks of faces of a same degree k, list of the faces as arrays otherwise """
+    if all(isinstance(block, np.ndarray) for block in blocks) and len(set(block.shape[1] for block in blocks)) <= 1:
+        return np.vstack(blocks) if blocks else np.zeros((0, degree), dtype=np.int64)
+    return [np.asarray(face, dtype=np.int64) for block in blocks for face in block]
+
+
+def readAsciiFaces(plyfile, count):
+    blocks = []
+    for lines in readAsciiBlocks(plyfile, count):
+        values = np.fromstring(" ".join(lines), sep=" ")
+        # Faces of a same degree make a regular array, others are read one by one
+        if values.size % len(lines) == 0:
+            values = values.reshape((len(lines), -1))
+            if np.all(values[:, 0] == values.shape[1]-1):
+                blocks.append(values[:, 1:].astype(np.int64))
+                continue
+        faces = []
+        for line in lines:
+            values = [int(v) for v in line.split()]
+            if len(values) == 0 or values[0] != len(values)-1:
+                raise PlyError("Bad face %s" % line.strip())
+            faces.append(values[1:])
+        blocks.append(faces)
+    return mergeFaces(blocks)
+
+
+def readAsciiElement(plyfile, name, count, properties):
+    if name == 'face':
+        return readAsciiFaces(plyfile, count)
+    dtype = scalarDtype(properties, '=')
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    values = readAsciiLines(plyfile, count)
+    data = np.empty(count, dtype=dtype)
+    for i, field in enumerate(dtype.names):
+        data[field] = values[:, i]
+    return data
+
+
+def readBinaryElement(plyfile, name, count, properties, endian):
+    if name != 'face':
+        dtype = scalarDtype(properties, endian)
+        data = np.fromfile(plyfile, dtype=dtype, count=count)
+        if len(data) != count:
+            raise PlyError("Unexpected end of file")
+        return data
+
+    # Faces are read by blocks with the degree of the first one,
+    # the others from the first face of another degree one by one
+    countType, indexType = properties[0][1]
+    countType, indexType = np.dtype(endian+countType), np.dtype(endian+indexType)
+    start = plyfile.tell()
+    degree = int(np.fromfile(plyfile, dtype=countType, count=1)[0]) if count else 3
+    plyfile.seek(start)
+    dtype = np.dtype([('n', countType), ('v', indexType, (degree,))])
+    blocks = []
+    first = 0
+    while first < count:
+        start = plyfile.tell()
+        block = np.fromfile(plyfile, dtype=dtype, count=min(BLOCK, count-first))
+        regular = len(block) if np.all(block['n'] == degree) else int(np.argmax(block['n'] != degree))
+        if regular > 0:
+            blocks.append(block['v'][:regular].astype(np.int64))
+            first += regular
+        if regular == len(block) and len(block) > 0:
+            continue
+        plyfile.seek(start + regular*dtype.itemsize)
+        faces = []
+        while first < count:
+            n = np.fromfile(plyfile, dtype=countType, count=1)
+            face = np.fromfile(plyfile, dtype=indexType, count=int(n[0])) if len(n) else []
+            if len(n) == 0 or len(face) != n[0]:
+                raise PlyError("Unexpected end of file")
+            faces.append(face)
+            first += 1
+        blocks.append(faces)
+    return mergeFaces(blocks, degree)
+
+
+def readPly(plyfilename):
+    """
+    Read a PLY mesh (ascii or binary)
+    Return (vertices, faces) : structured array of the vertex properties
+    (x, y, z, and nx, ny, nz, red, green, blue, ... when present) and a
+    (m,k) array of vertex indices of the faces, starting from 0, or a list
+    of the faces as arrays if they do not all have the same number of vertices
+    """
+    with open(plyfilename, "rb") as plyfile:
+        fmt, elements = readHeader(plyfile)
+        result = {}
+        for name, count, properties in elements:
+            if fmt == 'ascii':
+                result[name] = readAsciiElement(plyfile, name, count, properties)
+            else:
+                result[name] = readBinaryElement(plyfile, name, count, properties, ENDIANNESS[fmt])
+    return result['vertex'], result['face']
+
+
+def writeRows(objfile, prefix, rows, fmt):
+    """
+    Write rows of a 2D array as "prefix fmt fmt ..." lines, BLOCK rows at
+    a time, fmt being repeated to consume all the values of a row
+    """
+    line = prefix + " " + " ".join([fmt]*(rows.shape[1]/fmt.count('%'))) + "\n"
+    for first in xrange(0, len(rows), BLOCK):
+        block = rows[first:first+BLOCK]
+        objfile.write((line*len(block)) % tuple(block.ravel()))
+
+
+def vertexColors(vertices):
+    """ (n,3) array of the vertex colors (in [0,1]) as read by readPly, None if absent """
+    names = vertices.dtype.names
+    for channels in (('red', 'green', 'blue'), ('r', 'g', 'b'), ('diffuse_red', 'diffuse_green', 'diffuse_blue')):
+        if all(c in names for c in channels):
+            scale = 255.0 if vertices.dtype[channels[0]].kind in 'ui' else 1.0
+            return np.column_stack([vertices[c]/scale for c in channels])
+    return None
+
+
+def decimateVertices(vertices, faces, decimation):
+    """
+    Return (vertices, faces) as read by readPly decimated to decimation =
+    (target number of faces, maximum error) (see meshfile.simplify),
+    the vertices keeping their position, normals and colors only
+    """
+    if simplify is None:
+        raise PlyError("The decimation needs src/mesher next to this script")
+    if isinstance(faces, list) or faces.shape[1] != 3:
+        raise PlyError("Only triangle meshes can be decimated")
+    names = vertices.dtype.names
+    xyz = np.column_stack([vertices[c] for c in ('x', 'y', 'z')])
+    normals = np.column_stack([vertices[c] for c in ('nx', 'ny', 'nz')]) if all(c in names for c in ('nx', 'ny', 'nz')) else None
+    xyz, faces, normals, colors = simplify(xyz, faces, normals, vertexColors(vertices), decimation)
+    fields = ['x', 'y', 'z'] + (['nx', 'ny', 'nz'] if normals is not None else []) + (['red', 'green', 'blue'] if colors is not None else [])
+    columns = np.column_stack([values for values in (xyz, normals, colors) if values is not None])
+    decimated = np.empty(len(xyz), dtype=[(name, 'f8') for name in fields])
+    for i, name in enumerate(fields):
+        decimated[name] = columns[:, i]
+    return decimated, np.asarray(faces, dtype=np.int64)
+
+
+def writeObj(objfilename, vertices, faces):
+    """
+    Write vertices and faces as read by readPly in an OBJ file,
+    with vertex colors (in [0,1]) and normals if present
+    """
+    names = vertices.dtype.names
+    columns = [vertices[c] for c in ('x', 'y', 'z')]
+    colors = vertexColors(vertices)
+    if colors is not None:
+        columns.append(colors)
+    hasNormals = all(c in names for c in ('nx', 'ny', 'nz'))
+
+    with open(objfilename, "w") as objfile:
+        objfile.write("# File type: ASCII OBJ\n")
+        writeRows(objfile, "v", np.column_stack(columns), "%f")
+        if hasNormals:
+            writeRows(objfile, "vn", np.column_stack([vertices[c] for c in ('nx', 'ny', 'nz')]), "%f")
+        ## In obj files the first vertex is 1 not 0
+        fmt = "%d//%d" if hasNormals else "%d"
+        if isinstance(faces, list):
+            for face in faces:
+                writeRows(objfile, "f", np.repeat(face[None, :]+1, 2 if hasNormals else 1, axis=1), fmt)
+        else:
+            writeRows(objfile, "f", np.repeat(faces+1, 2 if hasNormals else 1, axis=1), fmt)
+
+
+def ply2obj(plyfilename, objfilename, decimation=None):
+    """
+    Convert a PLY mesh to an OBJ file, decimated to decimation =
+    (target number of faces, maximum error) if given (see decimateVertices)
+    """
+    vertices, faces = readPly(plyfilename)
+    if decimation is not None:
+        vertices, faces = decimateVertices(vertices, faces, decimation)
+    writeObj(objfilename, vertices, faces)
+    return vertices, faces
 
 
 def print_help():
-    print "Usage: "+os.path.basename(sys.argv[0])+" filein.ply [fileout.obj]"
+    print "Usage: "+os.path.basename(sys.argv[0])+" [--faces N] [--error E] filein.ply [fileout.obj]"
+    print "  --faces N : decimate the mesh to N faces"
+    print "  --error E : decimate the mesh while the collapses cost less than E"
     sys.exit()
 
 def print_error(str):
     print "ERROR: "+str
     sys.exit()
 
-if (len(sys.argv) < 2):
-    print_help()
-
-plyfilename = sys.argv[1];
-objfilename = sys.argv[1].replace(".ply","")+".obj"; 
-if (len(sys.argv) == 3):
-    objfilename = sys.argv[2];
-
-
-objfile = open(objfilename, "w")
-plyfile = open(plyfilename, "r")
-
-line = plyfile.readline()
-tab = string.split(line)
-if cmp(tab[0],"ply") != 0:
-    print_error("Bad PLY file header")
-
-# Read header
-pointNb = -1
-faceNb = -1
-line = plyfile.readline()
-while line != "":
-    t = string.split(line)
-    if t!= []:
-        if t[0][0] != '#':
-            if cmp(t[0], "element")==0 and cmp(t[1], "vertex")==0:
-                pointNb = int(t[2])
-            if cmp(t[0], "element")==0 and cmp(t[1], "face")==0:
-                faceNb = int(t[2])
-            if cmp(t[0], "end_header")==0:
-                break
-    line = plyfile.readline()
-
-if pointNb == -1 or faceNb == -1:
-    print_error("Imcomplete PLY file header")
-
-objfile.write("# File type: ASCII OBJ\n")
-
-for i in range(pointNb):
-    line = plyfile.readline()
-    t = string.split(line)
-    objfile.write("v "+t[0]+" "+t[1]+" "+t[2]+"\n")
-
-
-for i in range(faceNb):
-    line = plyfile.readline()
-    t = string.split(line)
-    ## In obj files the first vertex is 1 not 0
-    polyDegree = int(t[0]) # number of vertex per polygone
-    tOut = []        
-    for j in range(polyDegree):
-        tOut.append(str(int(t[j+1]) +1))
-    objfile.write("f "+string.join(tOut," ")+"\n")
-
-objfile.close()
-plyfile.close()
+
+def writeTestPly(filename, fmt, faces):
+    """ PLY file of 5 vertices and faces, lists of vertex indices """
+    header = ["ply", "format %s 1.0" % fmt, "element vertex 5", "property float x",
+              "property float y", "property float z", "element face %d" % len(faces),
+              "property list uchar int vertex_indices", "end_header"]
+    vertices = np.arange(15, dtype=float).reshape((5, 3))
+    with open(filename, "wb") as plyfile:
+        plyfile.write("\n".join(header) + "\n")
+        if fmt == 'ascii':
+            for vertex in vertices:
+                plyfile.write("%f %f %f\n" % tuple(vertex))
+            for face in faces:
+                plyfile.write(" ".join(map(str, [len(face)] + face)) + "\n")
+        else:
+            vertices.astype('<f4').tofile(plyfile)
+            for face in faces:
+                np.uint8(len(face)).tofile(plyfile)
+                np.array(face, dtype='<i4').tofile(plyfile)
+
+def test_readPly_mixed(tmpdir):
+    faces = [[0, 1, 2], [1, 2, 3, 4], [2, 3, 4]]
+    for fmt in ('ascii', 'binary_little_endian'):
+        filename = str(tmpdir.join(fmt + ".ply"))
+        writeTestPly(filename, fmt, faces)
+        vertices, read = readPly(filename)
+        assert len(vertices) == 5 and vertices['z'][4] == 14
+        assert [face.tolist() for face in read] == faces
+        ply2obj(filename, str(tmpdir.join(fmt + ".obj")))
+        with open(str(tmpdir.join(fmt + ".obj"))) as objfile:
+            assert "f 2 3 4 5\n" in objfile.read()
+
+def test_readPly_regular(tmpdir):
+    for fmt in ('ascii', 'binary_little_endian'):
+        filename = str(tmpdir.join(fmt + ".ply"))
+        writeTestPly(filename, fmt, [[0, 1, 2], [2, 3, 4]])
+        vertices, faces = readPly(filename)
+        assert faces.shape == (2, 3) and faces.tolist() == [[0, 1, 2], [2, 3, 4]]
+        writeTestPly(filename, fmt, [])
+        vertices, faces = readPly(filename)
+        assert len(vertices) == 5 and faces.shape == (0, 3)
+
+def test_ply2obj_decimation(tmpdir):
+    from mesher.decimate import gridMesh
+    from mesher.meshfile import writePly
+    vertices, faces = gridMesh(10)
+    filename = str(tmpdir.join("grid.ply"))
+    writePly(filename, vertices, faces, colors=np.ones(vertices.shape))
+    decimated, simple = ply2obj(filename, str(tmpdir.join("grid.obj")), decimation=(20, None))
+    assert 0 < len(simple) <= 20 and np.allclose(decimated['red'], 1)
+    with open(str(tmpdir.join("grid.obj"))) as objfile:
+        lines = objfile.read().splitlines()
+    assert len([line for line in lines if line.startswith("f ")]) == len(simple)
+    writeTestPly(filename, 'ascii', [[0, 1, 2], [1, 2, 3, 4]])
+    try:
+        ply2obj(filename, str(tmpdir.join("mixed.obj")), decimation=(1, None))
+        assert False
+    except PlyError:
+        pass
+
+
+if __name__ == "__main__":
+    try:
+        options, args = getopt.getopt(sys.argv[1:], "", ["faces=", "error="])
+        options = dict(options)
+        decimation = None
+        if options:
+            decimation = (int(options["--faces"]) if "--faces" in options else None,
+                          float(options["--error"]) if "--error" in options else None)
+    except (getopt.GetoptError, ValueError):
+        print_help()
+    if (len(args) < 1):
+        print_help()
+
+    plyfilename = args[0];
+    objfilename = args[0].replace(".ply","")+".obj";
+    if (len(args) == 2):
+        objfilename = args[1];
+
+    try:
+        ply2obj(plyfilename, objfilename, decimation)
+    except PlyError as err:
+        print_error(str(err))
@@ -49,48 +49,77 @@ bool FileIO::readAndSortPoints(const char* filename, Octree& octree,
         return false;
     }
 
-    string firstline;
+    bool ok = readAndSortPoints(in, octree, min_radius);
+    in.close();
+    return ok;
+}
 
-    getline(in, firstline);
 
-    istringstream line_in(firstline);
-    string word;
-    int nword = 0;
-    while (line_in>> word)
-        nword++;
+bool FileIO::readAndSortPoints(istream& in, Octree& octree,
+                               double min_radius, bool binary)
+{
+    double x,y,z,nx,ny,nz;
+    list<Vertex> input_vertices;
 
-    if(nword == 3)
+    if(binary)
     {
-        std::cerr<< "Only three doubles per line: unoriented points?"
-           <<"This program needs oriented points!"<<endl;
-        return false;
+        float buffer[6];
+        while(in.read(reinterpret_cast<char*>(buffer), sizeof(buffer)))
+        {
+            input_vertices.push_back(Vertex(buffer[0], buffer[1], buffer[2],
+                                            buffer[3], buffer[4], buffer[5]));
+        }
+        if(input_vertices.empty())
+        {
+            std::cerr<<"No point could be read from the binary stream"<<endl;
+            return false;
+        }
     }
-
-    if( nword != 6)
+    else
     {
-        std::cerr<<"each point must be given by 6 values (position + normal) :"
-            <<"x y z nx ny nz"<<endl;
-        return false;
-    }
+        string firstline;
 
-    in.clear() ;
-    in.seekg(0, ios::beg);
+        getline(in, firstline);
 
-    double x,y,z,nx,ny,nz;
-    in >> x >> y >> z >> nx >> ny >> nz;
+        istringstream line_in(firstline);
+        string word;
+        int nword = 0;
+        while (line_in>> word)
+            nword++;
 
-    list<Vertex> input_vertices;
-    input_vertices.push_back(Vertex(x,y,z,nx,ny,nz));
+        if(nword == 3)
+        {
+            std::cerr<< "Only three doubles per line: unoriented points?"
+               <<"This program needs oriented points!"<<endl;
+            return false;
+        }
 
-    double xmin, ymin, zmin, xmax, ymax, zmax;
-    xmin = xmax = x;
-    ymin = ymax = y;
-    zmin = zmax = z;
+        if( nword != 6)
+        {
+            std::cerr<<"each point must be given by 6 values (position + normal) :"
+                <<"x y z nx ny nz"<<endl;
+            return false;
+        }
 
-    while( in >> x >> y >> z >> nx >> ny >> nz)
-    {
+        istringstream first_in(firstline);
+        first_in >> x >> y >> z >> nx >> ny >> nz;
         input_vertices.push_back(Vertex(x,y,z,nx,ny,nz));
 
+        while( in >> x >> y >> z >> nx >> ny >> nz)
+            input_vertices.push_back(Vertex(x,y,z,nx,ny,nz));
+    }
+
+    list<Vertex>::const_iterator vi = input_vertices.begin();
+    double xmin, ymin, zmin, xmax, ymax, zmax;
+    xmin = xmax = vi->x();
+    ymin = ymax = vi->y();
+    zmin = zmax = vi->z();
+
+    for(++vi; vi != input_vertices.end(); ++vi)
+    {
+        x = vi->x();
+        y = vi->y();
+        z = vi->z();
         xmin = x < xmin ? x : xmin;
         xmax = x > xmax ? x : xmax;
         ymin = y < ymin ? y : ymin;
@@ -98,7 +127,6 @@ bool FileIO::readAndSortPoints(const char* filename, Octree& octree,
         zmin = z < zmin ? z : zmin;
         zmax = z > zmax ? z : zmax;
     }
-    in.close();
 
     std::cout<<input_vertices.size()<<" points read"<<std::endl;
 
@@ -195,43 +223,77 @@ bool FileIO::saveMesh(const char* filename, Mesher& mesher)
     for( Facet_star_list::const_iterator fi = mesher.facets_begin();
         fi != mesher.facets_end(); ++fi)
     {
+        int indices[3];
+        orientedIndices(*fi, indices);
         out << 3 << "\t";
-        const Facet* f = *fi;
+        out << indices[0] <<"\t";
+        out << indices[1] <<"\t";
+        out << indices[2] <<endl;
+    }
+    return true;
+}
 
-        Vertex *v0 = f->vertex(0);
-        Vertex *v1 = f->vertex(1);
-        Vertex *v2 = f->vertex(2);
 
-        double nx = v0->nx() + v1->nx() + v2->nx();
-        double ny = v0->ny() + v1->ny() + v2->ny();
-        double nz = v0->nz() + v1->nz() + v2->nz();
+bool FileIO::saveMeshBinary(ostream& out, Mesher& mesher)
+{
+    unsigned int header[2] = {mesher.nVertices(), mesher.nFacets()};
+    out.write("BPAM", 4);
+    out.write(reinterpret_cast<const char*>(header), sizeof(header));
 
-        double tx = v1->x() - v0->x();
-        double ty = v1->y() - v0->y();
-        double tz = v1->z() - v0->z();
+    for( Vertex_star_list::const_iterator vi = mesher.vertices_begin();
+        vi != mesher.vertices_end(); ++vi)
+    {
+        Vertex *v = *vi;
+        float buffer[6] = {(float)v->x(), (float)v->y(), (float)v->z(),
+                           (float)v->nx(), (float)v->ny(), (float)v->nz()};
+        out.write(reinterpret_cast<const char*>(buffer), sizeof(buffer));
+    }
 
-        double sx = v2->x() - v0->x();
-        double sy = v2->y() - v0->y();
-        double sz = v2->z() - v0->z();
+    for( Facet_star_list::const_iterator fi = mesher.facets_begin();
+        fi != mesher.facets_end(); ++fi)
+    {
+        int indices[3];
+        orientedIndices(*fi, indices);
+        out.write(reinterpret_cast<const char*>(indices), sizeof(indices));
+    }
+    out.flush();
 
-        double cprodx, cprody, cprodz;
-        cross_product(tx, ty, tz, sx, sy, sz, cprodx, cprody, cprodz);
+    return !out.fail();
+}
 
 
-        if( nx * cprodx + ny * cprody + nz * cprodz > 0)
-        {
-            out << v0->index() <<"\t";
-            out << v1->index() <<"\t";
-            out << v2->index() <<endl;
-        }
-        else
-        {
-            out << v0->index() <<"\t";
-            out << v2->index() <<"\t";
-            out << v1->index() <<endl;
-        }
+void FileIO::orientedIndices(const Facet* f, int indices[3])
+{
+    Vertex *v0 = f->vertex(0);
+    Vertex *v1 = f->vertex(1);
+    Vertex *v2 = f->vertex(2);
+
+    double nx = v0->nx() + v1->nx() + v2->nx();
+    double ny = v0->ny() + v1->ny() + v2->ny();
+    double nz = v0->nz() + v1->nz() + v2->nz();
+
+    double tx = v1->x() - v0->x();
+    double ty = v1->y() - v0->y();
+    double tz = v1->z() - v0->z();
+
+    double sx = v2->x() - v0->x();
+    double sy = v2->y() - v0->y();
+    double sz = v2->z() - v0->z();
+
+    double cprodx, cprody, cprodz;
+    cross_product(tx, ty, tz, sx, sy, sz, cprodx, cprody, cprodz);
+
+    indices[0] = v0->index();
+    if( nx * cprodx + ny * cprody + nz * cprodz > 0)
+    {
+        indices[1] = v1->index();
+        indices[2] = v2->index();
+    }
+    else
+    {
+        indices[1] = v2->index();
+        indices[2] = v1->index();
     }
-    return true;
 }
 
 
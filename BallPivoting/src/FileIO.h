@@ -55,6 +55,20 @@ class FileIO
         static bool readAndSortPoints(const char *filename, Octree &octree,
                                       double min_radius = -1);
 
+        /** @brief read points from a stream
+         * @param in stream to read points from
+         * @param octree to sort and store the points in
+         * @param min_radius if positive, create the octree such that
+         * the smallest cell has size 2*min_radius
+         * @param binary if true, points are read as raw native floats
+         * (x y z nx ny nz for each point) until the end of the stream,
+         * otherwise as ascii lines
+         * @return false if no valid point could be read
+         */
+        static bool readAndSortPoints(std::istream &in, Octree &octree,
+                                      double min_radius = -1,
+                                      bool binary = false);
+
         /** @brief save points from an octree to a file
          * @param filename name of the file to save to
          * @param octree octree to save the points from
@@ -70,8 +84,26 @@ class FileIO
          */
         static bool saveMesh(const char* filename, Mesher &mesher);
 
+        /** @brief save triangulation as raw binary arrays
+         *
+         * The stream receives the "BPAM" tag, the number of vertices and
+         * facets (two unsigned ints), the vertices (6 floats each: position
+         * + normal) and the facets (3 ints each, vertex indices).
+         * @param out stream to save to
+         * @param mesher name of the mesher to save vertices and facets from
+         * @return false if something went wrong
+         */
+        static bool saveMeshBinary(std::ostream &out, Mesher &mesher);
+
     private :
 
+        /** @brief get the vertex indices of a facet, ordered so that the
+         * facet normal agrees with the vertex normals
+         * @param f facet to orient
+         * @param indices array receiving the three vertex indices
+         */
+        static void orientedIndices(const Facet *f, int indices[3]);
+
         /** @brief save all vertices contained in a node
          * @param node node to save from
          * @param f stream to save to
@@ -150,6 +150,7 @@ void Mesher::reconstruct(std::list< double >& radii)
 
         changeRadius(radius);
         reconstruct();
+        printPass(radius);
         radii.pop_front();
     }
 }
@@ -699,6 +700,7 @@ void Mesher::parallelReconstruct(std::list< double >& radii)
                      <<" ; Nfacets "<<nFacets()
                      <<" ; Front "<<nFrontEdges()<<"."<<std::endl;
         }
+        printPass(*ri);
         ++ri;
         ++init;
     }
@@ -708,10 +710,18 @@ void Mesher::parallelReconstruct(std::list< double >& radii)
         std::cout<<"Remaining front edges "<<m_edge_front.size()<<std::endl;
         setBallRadius(radii.back());
         expandTriangulation();
+        printPass(radii.back());
     }
 }
 
 
+void Mesher::printPass(double radius) const
+{
+    std::cout<<"Radius "<<radius<<" done ; Nvertices: "<<nVertices()
+             <<" ; Nfacets "<<nFacets()<<"."<<std::endl;
+}
+
+
 
 
 void Mesher::findSeedTriangle(OctreeNode* containment_node, OctreeNode* node,
@@ -166,6 +166,11 @@ class Mesher
          */
         unsigned int nBorderEdges() const;
 
+        /** @brief print the size of the mesh after a radius pass
+         * @param radius ball radius of the pass
+         */
+        void printPass(double radius) const;
+
 
         /** @brief get access to the mesh vertices
          * @return begin iterator of the vertices
@@ -126,8 +126,8 @@ void loop() {
       default: 
         ok = false;
     }
-    /* Echo back if command suceeded */
-    if (ok) 
-      Serial.println(cmd);
+    /* Echo back if command suceeded, '?' otherwise: every command gets a
+       reply, so that the host can match replies to commands in order */
+    Serial.println(ok ? cmd : '?');
   }      
 }
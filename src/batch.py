@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import sys
+import logging
+import getopt
+from scanner.processing import processDirectories, summary
+
+
+def usage(args):
+    print("Usage : %s <options> <directory> [<directory> ...]" % args[0])
+    print("Process archived scans (directories of pictures with their default.cfg) without GUI")
+    print("Available options:")
+    print("  --help      , -h             : print this help")
+    print("  --output    , -o <directory> : write the point clouds (and meshes) there (default=./clouds)")
+    print("  --jobs      , -j <number>    : number of directories processed in parallel (default=number of CPUs)")
+    print("  --mesh      , -m             : also mesh the point clouds (ball pivoting)")
+    print("  --reduce    , -r <factor>    : process pictures at 1/2, 1/4 or 1/8 of their resolution (preview)")
+    print("  --loglevel  , -l <loglevel>  : set logelevel (default=WARNING)")
+
+def main(args):
+    try:
+        opts, directories = getopt.getopt(args[1:], "o:j:mr:l:h", ["output=", "jobs=", "mesh", "reduce=", "loglevel=", "help"])
+    except getopt.GetoptError as err:
+        logging.error(str(err))
+        usage(args)
+        sys.exit(2)
+
+    output, jobs, mesh, reduce = "./clouds", None, False, 1
+    for o,a in opts:
+        if(o in ("-h", "--help")):
+            usage(args)
+            sys.exit()
+        elif(o in ("-o", "--output")):
+            output = a
+        elif(o in ("-j", "--jobs")):
+            jobs = int(a)
+        elif(o in ("-m", "--mesh")):
+            mesh = True
+        elif(o in ("-r", "--reduce")):
+            if(a not in ("1", "2", "4", "8")):
+                logging.error("Invalid reduce factor")
+                sys.exit(2)
+            reduce = int(a)
+        elif(o in ("-l", "--loglevel")):
+            try:
+                logging.getLogger().setLevel(getattr(logging, a.upper()))
+            except:
+                logging.error("Invalid loglevel")
+                sys.exit(2)
+
+    if(len(directories) == 0):
+        usage(args)
+        sys.exit(2)
+
+    results = processDirectories(directories, output, jobs, mesh, reduce)
+    print(summary(results))
+    sys.exit(1 if any(r['error'] is not None for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
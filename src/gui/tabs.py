@@ -7,7 +7,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from mesher.voxel import Point
+from mesher.voxel import pointsToArrays
+
+# Viewer refresh rate (frames per second) and number of points drawn
+VIEWER_FPS    = 4
+VIEWER_POINTS = 20000
 
 class Tab(Tkinter.Frame):
     def __init__(self, rootTab, title=""):
@@ -111,6 +115,67 @@ class SetupTab(Tab):
         self.config.save()
 
 
+class PointCloud:
+    def __init__(self, budget=VIEWER_POINTS, capacity=4096):
+        """ Create a new PointCloud object, the points received during a scan
+        budget   = maximum number of points returned by sample
+        capacity = initial size of the arrays, doubled when full
+        """
+        self.budget   = budget
+        self.count    = 0
+        self.version  = 0
+        self.lock     = threading.Lock()
+        self.random   = np.random.RandomState(0)
+        self.xyz      = np.empty((capacity, 3))
+        self.colors   = np.empty((capacity, 3))
+        self.priority = np.empty(capacity)
+
+    def add(self, points):
+        """ Append a list of Point, from any thread """
+        xyz, colors, normals = pointsToArrays(points)
+        with self.lock:
+            end = self.count + len(xyz)
+            if(end > len(self.xyz)):
+                size = max(end, 2*len(self.xyz))
+                for name in ('xyz', 'colors', 'priority'):
+                    array = getattr(self, name)
+                    grown = np.empty((size,) + array.shape[1:])
+                    grown[:self.count] = array[:self.count]
+                    setattr(self, name, grown)
+            self.xyz[self.count:end] = xyz
+            self.colors[self.count:end] = colors
+            # Points keep their priority: the sample only loses points as the scan grows
+            self.priority[self.count:end] = self.random.random_sample(len(xyz))
+            self.count = end
+            self.version += 1
+
+    def sample(self):
+        """ (xyz, colors) arrays of at most budget points drawn at random, copies """
+        with self.lock:
+            if(self.count <= self.budget):
+                return self.xyz[:self.count].copy(), self.colors[:self.count].copy()
+            # The budget points of lowest priority, in the order they came
+            keep = np.sort(np.argpartition(self.priority[:self.count], self.budget-1)[:self.budget])
+            return self.xyz[keep], self.colors[keep]
+
+
+def moveScatter(scatter, xyz, colors):
+    """
+    Replace the points and colors of a 3D scatter collection in place.
+    matplotlib has no public way to do it: Path3DCollection keeps its 3D
+    points in _offsets3d and (up to matplotlib 3.3) the colors it shades by
+    depth in _facecolor3d and _edgecolor3d. Return False if the collection
+    has no _offsets3d, the caller has to draw a new scatter then
+    """
+    if(not hasattr(scatter, '_offsets3d')):
+        return False
+    scatter._offsets3d = (xyz[:, 0], xyz[:, 1], xyz[:, 2])
+    scatter.set_color(colors)
+    if(hasattr(scatter, '_facecolor3d')):
+        scatter._facecolor3d = scatter._edgecolor3d = colors
+    return True
+
+
 class ViewerTab(Tab):
     def __init__(self, rootTab, scanner):
         """ Create a new ViewerTab object
@@ -122,8 +187,12 @@ class ViewerTab(Tab):
         self.scanner = scanner
         self.graph   = None
         self.axis    = None
+        self.scatter = None
+        self.cloud   = PointCloud()
+        self.drawn   = 0
         self.createGraph()
         self.createOptions()
+        self.after(1000//VIEWER_FPS, self.refresh)
 
     def createGraph(self, init=True):
         if(init):
@@ -133,6 +202,7 @@ class ViewerTab(Tab):
             self.axis = self.figure.add_subplot(111, projection='3d')
         else:
             self.axis.clear()
+            self.scatter = None
         self.axis.set_xlabel('X axis')
         self.axis.set_xlim3d(-250,250)
         self.axis.set_ylabel('Y axis')
@@ -149,7 +219,9 @@ class ViewerTab(Tab):
         Tkinter.Button(frame, text="Mesh", command=self.mesh).grid(row=2, column=0)
         Tkinter.Button(frame, text="Mesh with Delaunay3D", command=self.meshDelaunay).grid(row=3, column=0)
         Tkinter.Button(frame, text="Mesh with BPA", command=self.meshBPA).grid(row=4, column=0)
-        Tkinter.Button(frame, text="Quit", command=self.winfo_toplevel().destroy).grid(row=5, column=0)
+        Tkinter.Button(frame, text="Mesh with slice grid", command=self.meshSliceGrid).grid(row=5, column=0)
+        Tkinter.Button(frame, text="Mesh with TSDF", command=self.meshTSDF).grid(row=6, column=0)
+        Tkinter.Button(frame, text="Quit", command=self.winfo_toplevel().destroy).grid(row=7, column=0)
 
     def _objSaveDialog(self, extension=".obj"):
         filename, ext = None, None
@@ -167,25 +239,37 @@ class ViewerTab(Tab):
         self.scanner.startScan()
         self.plot()
 
-    def plot(self, scene=None, lock=None):
-        if(lock == None):
+    def plot(self, scene=None):
+        """ Collect the points of the scenes in the cloud, drawn by refresh """
+        if(scene == None):
             self.createGraph(False)
             logging.info("Start plotting")
-            lock = threading.Lock()
-            thread_left = threading.Thread(target=self.plot, args=(self.scanner.sceneLeft, lock))
-            thread_right = threading.Thread(target=self.plot, args=(self.scanner.sceneRight, lock))
-            thread_left.start()
-            thread_right.start()
+            self.cloud = PointCloud()
+            self.drawn = 0
+            for scene in (self.scanner.sceneLeft, self.scanner.sceneRight):
+                thread = threading.Thread(target=self.plot, args=(scene,))
+                thread.daemon = True
+                thread.start()
         else:
+            cloud = self.cloud
             for slice in scene:
-                arrays = map(Point.toNPArray, slice[0])
-                colors = map(Point.toRGB, slice[0])
-                if(len(arrays) != 0):
-                    x, y, z = zip(*arrays)
-                    lock.acquire()
-                    self.axis.scatter(x, y, z, c=colors)
-                    self.graph.draw()
-                    lock.release()
+                if(len(slice[0]) != 0):
+                    cloud.add(slice[0])
+
+    def refresh(self):
+        """ Draw the new points of the cloud, at most VIEWER_FPS times a second (Tk thread only) """
+        cloud = self.cloud
+        if(cloud.version != self.drawn):
+            self.drawn = cloud.version
+            xyz, colors = cloud.sample()
+            colors = np.column_stack((np.clip(colors, 0, 1), np.ones(len(colors))))
+            # A single collection, moved instead of adding one per slice
+            if(self.scatter == None or not moveScatter(self.scatter, xyz, colors)):
+                if(self.scatter != None):
+                    self.scatter.remove()
+                self.scatter = self.axis.scatter(xyz[:, 0], xyz[:, 1], xyz[:, 2], c=colors)
+            self.graph.draw_idle()
+        self.after(1000//VIEWER_FPS, self.refresh)
 
     def mesh(self):
         filename = self._objSaveDialog()
@@ -201,3 +285,29 @@ class ViewerTab(Tab):
         filename = self._objSaveDialog(".ply")
         if filename != "":
             self.scanner.meshBPA(filename)
+
+    def meshSliceGrid(self):
+        filename = self._objSaveDialog(".ply")
+        if filename != "":
+            self.scanner.meshSliceGrid(filename)
+
+    def meshTSDF(self):
+        filename = self._objSaveDialog(".ply")
+        if filename != "":
+            self.scanner.meshTSDF(filename)
+
+
+def test_pointCloud():
+    from mesher.voxel import Point
+    cloud = PointCloud(budget=100, capacity=8)
+    for step in range(30):
+        cloud.add([Point(step, i, 0, r=0.5, g=0.5, b=0.5) for i in range(10)])
+    assert cloud.count == 300 and len(cloud.xyz) >= 300 and cloud.version == 30
+    assert np.array_equal(cloud.xyz[:10, 1], np.arange(10))
+    xyz, colors = cloud.sample()
+    assert len(xyz) == 100 and np.allclose(colors, 0.5)
+    # Points drawn stay drawn as long as they fit in the budget
+    cloud.budget = 50
+    assert set(map(tuple, cloud.sample()[0])) <= set(map(tuple, xyz))
+    cloud.budget = 1000
+    assert len(cloud.sample()[0]) == 300
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from voxel import VoxelSpace, Point, norm3D
+from voxel import VoxelSpace, Point, norm3D, pointsToArrays
+from meshfile import writeObj
 from math import sqrt
 import Queue
 import numpy as np
@@ -61,7 +62,16 @@ class Mesher:
             existing = self.existingEdges.get(otherPoint, set())
             self.existingEdges[otherPoint] = existing.union(set((point,)))
 
-    def writeToObj(self, filename):
+    def writeToObj(self, filename, decimation=None):
+        """ Write the mesh in an OBJ file, simplified to decimation if given (see meshfile.simplify) """
+        if decimation is not None:
+            points = self.points.getSortedPoints()
+            rows = dict((point.index, row) for row, point in enumerate(points))
+            faces = np.array([[rows[face[i].index] for i in range(3)] for face in self.faces], dtype=int)
+            xyz, colors, normals = pointsToArrays(points)
+            writeObj(filename, xyz, faces, normals, colors, decimation,
+                     header="Semiteleporter version: %s" % CURRENT_VERSION)
+            return
         with open(filename, 'w') as obj:
             print >>obj, "### Semiteleporter version:", CURRENT_VERSION, "###"
             for point in self.points.getSortedPoints():
@@ -1,19 +1,274 @@
-import tempfile
-from subprocess import check_output
+import re
+import logging
+import threading
+import numpy as np
+from subprocess import Popen, PIPE
+from meshfile import writePly
+from neighbors import knnDistances
 
-def meshBPA(points, outFile, radius=[10, 20, 50, 80]):
-    pointsFile = tempfile.NamedTemporaryFile()
+BPA_EXECUTABLE = "./ballpivoting"
+BPA_CHUNK = 1 << 16
+
+# Progress lines printed by ballpivoting on its error stream
+BPA_RADIUS = re.compile(r"Ball radius (\S+)")
+BPA_NODES = re.compile(r"Nodes (\d+)/7 ; Nvertices: (\d+) ; Nfacets (\d+)")
+BPA_PASS = re.compile(r"Radius (\S+) done ; Nvertices: (\d+) ; Nfacets (\d+)")
+
+
+def pointsChunks(points, chunkSize=BPA_CHUNK):
+    """
+    Yield the points as (n,6) float32 arrays of x, y, z, nx, ny, nz,
+    at most chunkSize points at a time
+    """
+    chunk = []
     for p in points:
-        x, y, z = p.xyz
-        u, v, w = p.normal
-        pointsFile.write(("%f "*6 + "\n")%(x, y, z, u, v, w))
-    pointsFile.flush()
+        chunk.append(np.concatenate((p.xyz, p.normal)))
+        if len(chunk) == chunkSize:
+            yield np.array(chunk, dtype=np.float32)
+            chunk = []
+    if len(chunk) > 0:
+        yield np.array(chunk, dtype=np.float32)
+
+
+def parseProgress(line):
+    """
+    Parse a progress line of ballpivoting, return a dict with the ball radius
+    or the number of vertices and facets, or None for any other line
+    """
+    match = BPA_PASS.search(line)
+    if match:
+        return {'pass': float(match.group(1)),
+                'vertices': int(match.group(2)),
+                'facets': int(match.group(3))}
+    match = BPA_RADIUS.search(line)
+    if match:
+        return {'radius': float(match.group(1))}
+    match = BPA_NODES.search(line)
+    if match:
+        return {'nodes': int(match.group(1)),
+                'vertices': int(match.group(2)),
+                'facets': int(match.group(3))}
+    return None
+
+
+def readExactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise IOError("ballpivoting output truncated (%d/%d bytes)" % (len(data), size))
+    return data
+
+
+def readMesh(stream):
+    """
+    Read a binary mesh written by ballpivoting on its standard output
+    Return (vertices, faces) : (n,6) float32 array of positions and normals,
+    (m,3) int32 array of vertex indices
+    """
+    if readExactly(stream, 4) != "BPAM":
+        raise IOError("Bad ballpivoting output header")
+    nVertices, nFaces = np.frombuffer(readExactly(stream, 8), dtype=np.uint32)
+    vertices = np.frombuffer(readExactly(stream, int(nVertices)*6*4), dtype=np.float32)
+    faces = np.frombuffer(readExactly(stream, int(nFaces)*3*4), dtype=np.int32)
+    return vertices.reshape((-1, 6)), faces.reshape((-1, 3))
+
+
+def weightedPercentile(values, weights, q):
+    order = np.argsort(values)
+    cumulated = np.cumsum(weights[order], dtype=float)
+    index = np.searchsorted(cumulated, q*cumulated[-1])
+    return values[order][min(index, len(values)-1)]
+
+
+class RadiusPlan:
+    """ RadiusPlan holds the ball radii chosen for a point cloud from its
+        nearest neighbors statistics, with the number of faces each radius
+        pass is expected to add and actually added """
+    def __init__(self, spacing, regionSpacing, regionPoints, radii, factor):
+        """ Create a new RadiusPlan object
+        spacing       = global median point spacing
+        regionSpacing = mean point spacing of each region
+        regionPoints  = number of points of each region
+        radii         = increasing list of ball radii
+        factor        = ratio between ball radius and point spacing
+        """
+        self.spacing = spacing
+        self.regionSpacing = regionSpacing
+        self.regionPoints = regionPoints
+        self.radii = radii
+        self.facets = {}
+
+        # A region is meshed by the first radius large enough for its spacing,
+        # a triangulated surface has about 2 faces per vertex
+        needed = np.searchsorted(radii, factor*regionSpacing)
+        added = np.bincount(needed, weights=regionPoints, minlength=len(radii)+1)
+        self.predicted = [int(2*n) for n in added[:len(radii)]]
+        self.uncovered = int(added[len(radii)])
+
+    def record(self, info):
+        """ Progress callback of meshBPA, keeps the number of facets after each pass """
+        if 'pass' in info:
+            self.facets[info['pass']] = info['facets']
+
+    def actual(self):
+        """ Faces actually added by each radius pass (None if not run) """
+        res, previous = [], 0
+        for radius in self.radii:
+            facets = self.facets.get(round(radius, 6))
+            res.append(None if facets is None else facets-previous)
+            previous = previous if facets is None else facets
+        return res
 
-    radius_opts = reduce(lambda acc,x: acc + ["-r", str(x)], radius, [])
+    def report(self):
+        lines = ["Point spacing %.2f (%d regions, %.2f..%.2f)" % (self.spacing,
+                 len(self.regionSpacing), self.regionSpacing.min(), self.regionSpacing.max())]
+        for radius, predicted, actual in zip(self.radii, self.predicted, self.actual()):
+            lines.append("Radius %7.2f : %7d faces predicted, %7s added" % (radius, predicted,
+                         '-' if actual is None else actual))
+        if self.uncovered:
+            lines.append("%d points in regions too sparse for the largest radius" % self.uncovered)
+        return "\n".join(lines)
 
-    print check_output([
-        "./ballpivoting", 
-        "-i", pointsFile.name, "-o", outFile, #Input/Output
+
+def planRadii(xyz, k=6, factor=1.5, ratio=2.0, coverage=(0.05, 0.98), regionSize=None):
+    """
+    Choose a minimal sequence of ball radii from the point spacing.
+    The spacing of each point is the mean distance to its k nearest
+    neighbors, it is averaged over cubic regions of regionSize (default:
+    20 times the global spacing). Radii go from the spacing of the densest
+    regions to the spacing of the sparsest ones (coverage percentiles of the
+    points), each radius being ratio times larger than the previous one.
+    xyz    = (n,3) array of positions
+    factor = ratio between ball radius and point spacing
+    Return a RadiusPlan
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    distances = knnDistances(xyz, k)
+    distances[np.isinf(distances)] = np.nan
+    local = np.nanmean(distances, axis=1)
+    valid = ~np.isnan(local)
+    xyz, local = xyz[valid], local[valid]
+    spacing = np.median(local)
+
+    regionSize = 20*spacing if regionSize is None else regionSize
+    cells = np.floor(xyz/regionSize).astype(np.int64)
+    regions = np.unique(cells, axis=0, return_inverse=True)[1]
+    regionPoints = np.bincount(regions)
+    regionSpacing = np.bincount(regions, weights=local)/regionPoints
+
+    smallest = factor*weightedPercentile(regionSpacing, regionPoints, coverage[0])
+    largest = factor*weightedPercentile(regionSpacing, regionPoints, coverage[1])
+    # Ladder down from the largest radius, so that the smallest radius keeps
+    # some margin over the spacing of the densest regions
+    radii = [largest]
+    while radii[0]/ratio >= smallest:
+        radii.insert(0, radii[0]/ratio)
+    radii = [np.ceil(r*100)/100 for r in radii]
+
+    plan = RadiusPlan(spacing, regionSpacing, regionPoints, radii, factor)
+    # Skip the passes no region needs
+    useful = [r for r, n in zip(radii[:-1], plan.predicted) if n > 0] + radii[-1:]
+    if len(useful) < len(radii):
+        plan = RadiusPlan(spacing, regionSpacing, regionPoints, useful, factor)
+    return plan
+
+
+def meshBPA(points, outFile=None, radius=None, progress=None, executable=BPA_EXECUTABLE, decimation=None):
+    """
+    Mesh points with the ball pivoting algorithm.
+    Points and normals are streamed as binary to ballpivoting through a pipe,
+    the mesh comes back the same way: nothing is written on disk but outFile.
+    points     = iterable of Point (with normals)
+    outFile    = if given, the mesh is also written in this PLY file
+    radius     = list of ball radii, used successively, or None to plan them
+                 from the point spacing (see planRadii)
+    progress   = callable receiving the dicts of parseProgress
+    executable = path to the ballpivoting program
+    decimation = (target number of faces, maximum error) to simplify the
+                 written mesh to, or None (see meshfile.simplify)
+    Return (vertices, faces) arrays (see readMesh)
+    """
+    plan = None
+    if radius is None:
+        points = list(points)
+        plan = planRadii(np.array([p.xyz for p in points]))
+        radius = plan.radii
+        logging.info("[BPA] Planned radii\n%s" % plan.report())
+
+    radius_opts = ["-r", " ".join(map(str, radius))]
+    process = Popen([
+        executable,
+        "-b", "-i", "-", "-o", "-", # Binary input/output through pipes
         "-p" # Parallel computation
-    ] + radius_opts)
+    ] + radius_opts, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+    def follow():
+        for line in iter(process.stderr.readline, ''):
+            logging.debug("[BPA] %s" % line.rstrip())
+            info = parseProgress(line)
+            if info is not None and plan is not None:
+                plan.record(info)
+            if info is not None and progress is not None:
+                progress(info)
+    follower = threading.Thread(target=follow)
+    follower.daemon = True
+    follower.start()
+
+    try:
+        for chunk in pointsChunks(points):
+            process.stdin.write(chunk.tostring())
+        process.stdin.close()
+        vertices, faces = readMesh(process.stdout)
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            logging.error("\033[31mballpivoting exited with code %d\033[0m" % process.returncode)
+        follower.join()
+
+    logging.info("BPA mesh : %d vertices, %d faces" % (len(vertices), len(faces)))
+    if plan is not None:
+        logging.info("[BPA] Radius passes\n%s" % plan.report())
+    if outFile:
+        writePly(outFile, vertices[:, :3], faces, normals=vertices[:, 3:], decimation=decimation)
+    return vertices, faces
+
+
+def test_pointsChunks():
+    from voxel import Point
+    points = [Point(i, 0, 0, nx=1.0) for i in range(5)]
+    chunks = list(pointsChunks(points, 2))
+    assert map(len, chunks) == [2, 2, 1]
+    assert chunks[0].dtype == np.float32
+    assert list(chunks[2][0]) == [4, 0, 0, 1, 0, 0]
+
+def test_parseProgress():
+    assert parseProgress("***********Ball radius 20 ***********") == {'radius': 20}
+    line = "Nodes 3/7 ; Nvertices: 120 ; Nfacets 200 ; Front 4."
+    assert parseProgress(line) == {'nodes': 3, 'vertices': 120, 'facets': 200}
+    assert parseProgress("1000 points read") is None
+
+def test_parseProgress_pass():
+    line = "Radius 20 done ; Nvertices: 120 ; Nfacets 200."
+    assert parseProgress(line) == {'pass': 20, 'vertices': 120, 'facets': 200}
+
+def test_planRadii():
+    rng = np.random.RandomState(0)
+    # Dense and sparse halves of a plane
+    dense = np.c_[rng.uniform(0, 100, (4000, 2)), np.zeros(4000)]
+    sparse = np.c_[rng.uniform(0, 100, (250, 2)), np.zeros(250)]
+    sparse[:, 0] += 100
+    plan = planRadii(np.vstack((dense, sparse)), regionSize=50)
+    assert len(plan.radii) == 2
+    assert plan.radii == sorted(plan.radii)
+    assert plan.radii[-1] > 3*plan.radii[0]
+    assert plan.predicted[0] > 2*3000 and plan.uncovered < 2*250
+    plan.record({'pass': plan.radii[0], 'facets': 100})
+    assert plan.actual()[0] == 100 and plan.actual()[1] is None
 
+def test_readMesh():
+    from StringIO import StringIO
+    vertices = np.arange(12, dtype=np.float32)
+    faces = np.array([0, 1, 0], dtype=np.int32)
+    data = "BPAM" + np.array([2, 1], dtype=np.uint32).tostring()
+    v, f = readMesh(StringIO(data + vertices.tostring() + faces.tostring()))
+    assert v.shape == (2, 6) and f.shape == (1, 3)
+    assert v[1][0] == 6 and list(f[0]) == [0, 1, 0]
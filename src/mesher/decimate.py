@@ -0,0 +1,212 @@
+import heapq
+import logging
+import itertools
+import numpy as np
+
+# Weight of the planes keeping the boundaries of open meshes in place
+BOUNDARY_WEIGHT = 100.0
+
+
+def planeQuadrics(vertices, faces):
+    """ (m,4,4) error quadrics of the planes of the faces, weighted by their area """
+    a, b, c = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+    normals = np.cross(b-a, c-a)
+    lengths = np.sqrt((normals**2).sum(axis=1))
+    normals /= np.maximum(lengths, 1e-12)[:, None]
+    planes = np.column_stack((normals, -(normals*a).sum(axis=1)))
+    return (lengths/2)[:, None, None]*planes[:, :, None]*planes[:, None, :]
+
+
+def boundaryQuadrics(vertices, faces):
+    """ (edges, quadrics) of the edges of a single face, with the quadrics of planes through them perpendicular to their face """
+    edges = np.vstack((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]))
+    owners = np.tile(np.arange(len(faces)), 3)
+    keys, index, counts = np.unique(np.sort(edges, axis=1), axis=0, return_index=True, return_counts=True)
+    boundary = index[counts == 1]
+    edges, owners = edges[boundary], owners[boundary]
+    a, b, c = [vertices[faces[owners, i]] for i in range(3)]
+    faceNormals = np.cross(b-a, c-a)
+    direction = vertices[edges[:, 1]]-vertices[edges[:, 0]]
+    normals = np.cross(direction, faceNormals)
+    normals /= np.maximum(np.sqrt((normals**2).sum(axis=1)), 1e-12)[:, None]
+    planes = np.column_stack((normals, -(normals*vertices[edges[:, 0]]).sum(axis=1)))
+    weights = BOUNDARY_WEIGHT*(direction**2).sum(axis=1)
+    return edges, weights[:, None, None]*planes[:, :, None]*planes[:, None, :]
+
+
+def quadricError(q, position):
+    """ Error of a (symmetric) quadric, as nested lists, at position """
+    x, y, z = position
+    error = (q[0][0]*x*x + q[1][1]*y*y + q[2][2]*z*z + q[3][3]
+             + 2*(q[0][1]*x*y + q[0][2]*x*z + q[1][2]*y*z + q[0][3]*x + q[1][3]*y + q[2][3]*z))
+    return max(error, 0.0)
+
+
+def collapseTarget(quadric, a, b):
+    """ (position, cost) of the point minimizing quadric, or of the best of a, b and their middle """
+    # Plain Python: faster than numpy on 3x3 systems
+    q = quadric.tolist()
+    (a11, a12, a13, b1), (a21, a22, a23, b2), (a31, a32, a33, b3) = q[:3]
+    det = a11*(a22*a33-a23*a32) - a12*(a21*a33-a23*a31) + a13*(a21*a32-a22*a31)
+    scale = max(abs(a11), abs(a22), abs(a33))
+    if abs(det) > 1e-8*scale**3:
+        # Cramer's rule on A.p = -b
+        b1, b2, b3 = -b1, -b2, -b3
+        candidates = [((b1*(a22*a33-a23*a32) - a12*(b2*a33-a23*b3) + a13*(b2*a32-a22*b3))/det,
+                       (a11*(b2*a33-a23*b3) - b1*(a21*a33-a23*a31) + a13*(a21*b3-b2*a31))/det,
+                       (a11*(a22*b3-b2*a32) - a12*(a21*b3-b2*a31) + b1*(a21*a32-a22*a31))/det)]
+    else:
+        candidates = [a, b, (a+b)/2]
+    costs = [quadricError(q, position) for position in candidates]
+    best = min(range(len(costs)), key=costs.__getitem__)
+    return np.array(candidates[best], dtype=float), costs[best]
+
+
+def decimate(vertices, faces, targetFaces=None, maxError=None, colors=None, normals=None):
+    """
+    Simplify a triangle mesh by collapsing its edges by increasing quadric
+    error (Garland & Heckbert), until it has targetFaces faces or the next
+    collapse costs more than maxError (squared distance to the original
+    planes, times their area). Collapses turning a face over or joining two
+    parts of the surface are skipped. Colors and normals (per vertex) are
+    interpolated along the collapsed edges.
+    Returns the (vertices, faces, colors, normals) arrays, colors and
+    normals being None if not given.
+    The collapses are done in plain Python, about 5000 input faces a second:
+    a mesh of millions of faces takes minutes and gigabytes of memory
+    """
+    vertices = np.array(vertices, dtype=float)
+    faces = np.array(faces, dtype=int).reshape((-1, 3))
+    attributes = [np.array(values, dtype=float) if values is not None else None for values in (colors, normals)]
+    target = targetFaces if targetFaces is not None else 0
+
+    quadrics = np.zeros((len(vertices), 4, 4))
+    planes = planeQuadrics(vertices, faces)
+    for i in range(3):
+        np.add.at(quadrics, faces[:, i], planes)
+    boundary, planes = boundaryQuadrics(vertices, faces)
+    for i in range(2):
+        np.add.at(quadrics, boundary[:, i], planes)
+
+    # Plain lists and sets: the collapses change a few faces at a time
+    edges = np.unique(np.sort(np.vstack((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]])), axis=1), axis=0)
+    faces = faces.tolist()
+    vertexFaces = [set() for v in range(len(vertices))]
+    for index, face in enumerate(faces):
+        for v in face:
+            vertexFaces[v].add(index)
+    removed = np.zeros(len(vertices), dtype=bool)
+    alive = np.ones(len(faces), dtype=bool)
+    version = np.zeros(len(vertices), dtype=int)
+    heap = []
+    counter = itertools.count()
+
+    def neighbors(v):
+        return set(u for index in vertexFaces[v] for u in faces[index] if u != v)
+
+    def push(a, b):
+        position, cost = collapseTarget(quadrics[a]+quadrics[b], vertices[a], vertices[b])
+        # The counter breaks ties before the positions are compared
+        heapq.heappush(heap, (cost, next(counter), a, b, version[a], version[b], position))
+
+    def flips(changed, a, b, position):
+        # Nothing to turn over when all the faces around a and b are removed
+        if len(changed) == 0:
+            return False
+        changed = np.array([faces[index] for index in changed], dtype=int)
+        corners = vertices[changed]
+        before = np.cross(corners[:, 1]-corners[:, 0], corners[:, 2]-corners[:, 0])
+        corners[(changed == a) | (changed == b)] = position
+        after = np.cross(corners[:, 1]-corners[:, 0], corners[:, 2]-corners[:, 0])
+        return ((before*after).sum(axis=1) <= 0).any()
+
+    for a, b in edges.tolist():
+        push(a, b)
+
+    count = len(faces)
+    while heap and count > target:
+        cost, order, a, b, versionA, versionB, position = heapq.heappop(heap)
+        if removed[a] or removed[b] or version[a] != versionA or version[b] != versionB:
+            continue
+        if maxError is not None and cost > maxError:
+            break
+        shared = vertexFaces[a] & vertexFaces[b]
+        # Vertices next to both a and b must be the ones of their common faces
+        if neighbors(a) & neighbors(b) != set(v for index in shared for v in faces[index]) - set((a, b)):
+            continue
+        if flips(list((vertexFaces[a] | vertexFaces[b]) - shared), a, b, position):
+            continue
+
+        # Attributes at the projection of the new position on the edge
+        edge = vertices[b]-vertices[a]
+        t = np.clip((position-vertices[a]).dot(edge)/max(edge.dot(edge), 1e-12), 0, 1)
+        for values in attributes:
+            if values is not None:
+                values[a] = (1-t)*values[a] + t*values[b]
+        vertices[a] = position
+        quadrics[a] += quadrics[b]
+        removed[b] = True
+        version[a] += 1
+
+        for index in shared:
+            alive[index] = False
+            for v in faces[index]:
+                vertexFaces[v].discard(index)
+            count -= 1
+        for index in vertexFaces[b]:
+            faces[index] = [a if v == b else v for v in faces[index]]
+            vertexFaces[a].add(index)
+        vertexFaces[b] = set()
+        for v in neighbors(a):
+            push(a, v)
+
+    # Remaining vertices, renumbered
+    kept = np.flatnonzero(~removed)
+    numbers = np.full(len(vertices), -1, dtype=int)
+    numbers[kept] = np.arange(len(kept))
+    colors, normals = [values[kept] if values is not None else None for values in attributes]
+    if normals is not None:
+        normals /= np.maximum(np.sqrt((normals**2).sum(axis=1)), 1e-12)[:, None]
+    logging.info("Decimation : %d -> %d faces" % (len(faces), alive.sum()))
+    return vertices[kept], numbers[np.array(faces, dtype=int).reshape((-1, 3))[alive]], colors, normals
+
+
+def gridMesh(size=20):
+    """ (vertices, faces) of a size x size square grid in the z=0 plane """
+    x, y = np.meshgrid(np.arange(size, dtype=float), np.arange(size, dtype=float))
+    vertices = np.column_stack((x.ravel(), y.ravel(), np.zeros(size*size)))
+    corners = (np.arange(size-1)[None, :] + size*np.arange(size-1)[:, None]).ravel()
+    faces = np.vstack((np.column_stack((corners, corners+1, corners+size+1)),
+                       np.column_stack((corners, corners+size+1, corners+size))))
+    return vertices, faces
+
+
+def test_decimate_plane():
+    vertices, faces = gridMesh()
+    colors = np.column_stack((vertices[:, 0]/19, np.zeros(len(vertices)), np.ones(len(vertices))))
+    decimated, simple, newColors, normals = decimate(vertices, faces, targetFaces=100, colors=colors)
+    assert len(simple) <= 100 and normals is None
+    assert np.allclose(decimated[:, 2], 0)
+    # Colors interpolated with the positions
+    assert np.allclose(newColors[:, 0], decimated[:, 0]/19)
+    # Boundaries stay in place: the square keeps its area
+    a, b, c = [decimated[simple[:, i]] for i in range(3)]
+    assert np.isclose(np.abs(np.cross(b-a, c-a)[:, 2]).sum()/2, 19*19)
+
+def test_decimate_maxError():
+    vertices, faces = gridMesh()
+    # A fold along x = 10 can not be removed without error
+    vertices[:, 2] = np.abs(vertices[:, 0]-10)
+    decimated, simple, colors, normals = decimate(vertices, faces, maxError=1e-6)
+    assert len(simple) < len(faces)/4
+    assert np.allclose(decimated[:, 2], np.abs(decimated[:, 0]-10))
+
+def test_decimate_pieces():
+    vertices, faces = gridMesh(5)
+    # A separate triangle, collapsed when the target needs it
+    vertices = np.vstack((vertices, np.eye(3)+10))
+    faces = np.vstack((faces, [[25, 26, 27]]))
+    decimated, simple, colors, normals = decimate(vertices, faces, targetFaces=0)
+    assert len(simple) == 0
+    decimated, simple, colors, normals = decimate(np.eye(3), [[0, 1, 2]], targetFaces=0)
+    assert len(simple) == 0
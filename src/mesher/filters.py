@@ -0,0 +1,65 @@
+import logging
+import numpy as np
+from neighbors import knnDistances, countNeighbors
+from voxel import pointsToArrays
+
+
+def statisticalOutliers(xyz, k=8, stdRatio=2.0):
+    """
+    Returns a mask of the points to keep: points whose mean distance to their
+    k nearest neighbors exceeds the mean of all these distances by more than
+    stdRatio standard deviations are outliers
+    """
+    if len(xyz) <= k:
+        return np.ones(len(xyz), dtype=bool)
+    meanDistances = knnDistances(xyz, k).mean(axis=1)
+    finite = np.isfinite(meanDistances)
+    mu = meanDistances[finite].mean()
+    sigma = meanDistances[finite].std()
+    return finite & (meanDistances <= mu + stdRatio*sigma)
+
+
+def radiusOutliers(xyz, radius, minNeighbors=3):
+    """ Returns a mask of the points having at least minNeighbors neighbors within radius """
+    return countNeighbors(xyz, radius) >= minNeighbors
+
+
+def removeOutliers(points, k=8, stdRatio=2.0, radius=None, minNeighbors=3):
+    """
+    Removes the isolated points of a list of points (stray laser reflections)
+    with the statistical filter (if stdRatio is set) then the radius filter
+    (if radius is set). Returns the kept points and a dict with the number
+    of points removed by each filter
+    """
+    points = list(points)
+    xyz = pointsToArrays(points)[0]
+    keep = np.ones(len(points), dtype=bool)
+    report = {'statistical': 0, 'radius': 0}
+
+    if stdRatio:
+        keep = statisticalOutliers(xyz, k, stdRatio)
+        report['statistical'] = int(len(points)-keep.sum())
+    if radius:
+        index = np.flatnonzero(keep)
+        inRadius = radiusOutliers(xyz[index], radius, minNeighbors)
+        keep[index[~inRadius]] = False
+        report['radius'] = int(len(index)-inRadius.sum())
+
+    logging.info("Outliers removed : %(statistical)d statistical, %(radius)d radius" % report)
+    return [p for p, ok in zip(points, keep) if ok], report
+
+
+def test_statisticalOutliers():
+    rng = np.random.RandomState(0)
+    plane = np.c_[rng.uniform(0, 100, (1000, 2)), np.zeros(1000)]
+    stray = np.array([[50, 50, 40], [200, 0, 0]], dtype=float)
+    keep = statisticalOutliers(np.vstack((plane, stray)))
+    assert not keep[-1] and not keep[-2]
+    assert keep[:-2].mean() > 0.95
+
+def test_removeOutliers():
+    from voxel import Point
+    points = [Point(x, y, 0) for x in range(10) for y in range(10)] + [Point(5, 5, 20)]
+    kept, report = removeOutliers(points, stdRatio=None, radius=1.5, minNeighbors=2)
+    assert report == {'statistical': 0, 'radius': 1}
+    assert len(kept) == 100 and points[-1] not in kept
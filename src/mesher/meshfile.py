@@ -0,0 +1,167 @@
+import numpy as np
+from decimate import decimate
+from voxel import mergeCells
+
+# Faces above which a mesh is first clustered on a grid (see cluster):
+# decimate collapses about 5000 faces a second
+CLUSTER_FACES = 200000
+
+
+def vertexDtype(normals=False, colors=False):
+    """ Structured dtype of a PLY vertex with optional normals and colors """
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if normals:
+        fields += [('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4')]
+    if colors:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    return np.dtype(fields)
+
+
+def cluster(vertices, faces, normals=None, colors=None, targetFaces=CLUSTER_FACES):
+    """
+    Returns (vertices, faces, normals, colors) with the vertices of each cell
+    of a grid merged (see voxel.mergeCells), the cells being sized from the
+    area of the surface for about targetFaces faces. The faces reduced to
+    an edge or a point and the repeated ones are dropped
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    faces = np.asarray(faces, dtype=int).reshape((-1, 3))
+    corners = vertices[faces]
+    area = np.sqrt((np.cross(corners[:, 1]-corners[:, 0], corners[:, 2]-corners[:, 0])**2).sum(axis=1)).sum()/2
+    # A triangulated surface has about two faces per vertex, one per cell
+    cellSize = np.sqrt(2*area/targetFaces)
+    if cellSize == 0:
+        return vertices, faces, normals, colors
+    zeros = np.zeros(vertices.shape)
+    merged, mergedColors, mergedNormals, cells = mergeCells(vertices, colors if colors is not None else zeros,
+                                                            normals if normals is not None else zeros, cellSize, True)
+    faces = cells[faces]
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+    # The same vertices in any order make the same face
+    faces = faces[np.sort(np.unique(np.sort(faces, axis=1), axis=0, return_index=True)[1])]
+    # Cells left without faces are dropped too
+    used, faces = np.unique(faces, return_inverse=True)
+    faces = faces.reshape((-1, 3))
+    return (merged[used], faces, mergedNormals[used] if normals is not None else None,
+            mergedColors[used] if colors is not None else None)
+
+
+def simplify(vertices, faces, normals=None, colors=None, decimation=None):
+    """
+    Returns (vertices, faces, normals, colors) decimated to decimation =
+    (target number of faces, maximum error), either being None (see decimate).
+    Meshes of more than CLUSTER_FACES faces are first clustered (see cluster)
+    down to CLUSTER_FACES faces, or to the target if it is larger
+    """
+    if decimation is None or len(faces) == 0:
+        return vertices, faces, normals, colors
+    targetFaces, maxError = decimation
+    if len(faces) > CLUSTER_FACES:
+        vertices, faces, normals, colors = cluster(vertices, faces, normals, colors, max(CLUSTER_FACES, targetFaces))
+    vertices, faces, colors, normals = decimate(vertices, faces, targetFaces, maxError, colors, normals)
+    return vertices, faces, normals, colors
+
+
+def writePly(filename, vertices, faces, normals=None, colors=None, decimation=None):
+    """
+    Write a triangle mesh in a binary (little endian) PLY file
+    vertices   = (n,3) array of positions
+    faces      = (m,3) array of vertex indices (starting from 0)
+    normals    = optional (n,3) array of vertex normals
+    colors     = optional (n,3) array of vertex colors in [0,1]
+    decimation = optional (target number of faces, maximum error) to
+                 simplify the mesh to before writing it (see simplify)
+    """
+    vertices, faces, normals, colors = simplify(vertices, faces, normals, colors, decimation)
+    dtype = vertexDtype(normals is not None, colors is not None)
+    data = np.empty(len(vertices), dtype=dtype)
+    for i, axis in enumerate('xyz'):
+        data[axis] = vertices[:, i]
+        if normals is not None:
+            data['n'+axis] = normals[:, i]
+    if colors is not None:
+        colors = np.clip(np.round(np.asarray(colors)*255), 0, 255)
+        for i, channel in enumerate(('red', 'green', 'blue')):
+            data[channel] = colors[:, i]
+
+    faceData = np.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+    faceData['n'] = 3
+    faceData['v'] = faces
+
+    with open(filename, 'wb') as ply:
+        ply.write("ply\nformat binary_little_endian 1.0\n")
+        ply.write("comment Semiteleporter mesh\n")
+        ply.write("element vertex %d\n" % len(vertices))
+        for name, kind in dtype.descr:
+            ply.write("property %s %s\n" % ('uchar' if kind == '|u1' else 'float', name))
+        ply.write("element face %d\n" % len(faces))
+        ply.write("property list uchar int vertex_indices\nend_header\n")
+        data.tofile(ply)
+        faceData.tofile(ply)
+
+
+def writeObj(filename, vertices, faces, normals=None, colors=None, decimation=None, header=None):
+    """
+    Write a triangle mesh in an OBJ file, colors appended to the vertices
+    (see writePly for the arguments), header being an optional comment line
+    """
+    vertices, faces, normals, colors = simplify(vertices, faces, normals, colors, decimation)
+    with open(filename, 'w') as obj:
+        if header is not None:
+            obj.write("### %s ###\n" % header)
+        for i, vertex in enumerate(vertices):
+            line = "v %f %f %f" % tuple(vertex)
+            if colors is not None:
+                line += " %f %f %f" % tuple(colors[i])
+            obj.write(line+"\n")
+            if normals is not None:
+                obj.write("vn %f %f %f\n" % tuple(normals[i]))
+        face = "f %d//%d %d//%d %d//%d\n" if normals is not None else "f %d %d %d\n"
+        for v in np.asarray(faces)+1:
+            obj.write(face % ((v[0], v[0], v[1], v[1], v[2], v[2]) if normals is not None else tuple(v)))
+
+
+def test_writePly():
+    import os, tempfile
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=float)
+    colors = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 0.5]])
+    handle, filename = tempfile.mkstemp('.ply')
+    os.close(handle)
+    try:
+        writePly(filename, vertices, np.array([[0, 1, 2]]), colors=colors)
+        with open(filename, 'rb') as ply:
+            content = ply.read()
+    finally:
+        os.remove(filename)
+    header, body = content.split("end_header\n")
+    assert "element vertex 3" in header and "property uchar red" in header
+    assert len(body) == 3*(3*4+3) + (1+3*4)
+
+def test_writeObj(tmpdir):
+    from decimate import gridMesh
+    vertices, faces = gridMesh(10)
+    filename = str(tmpdir.join("mesh.obj"))
+    writeObj(filename, vertices, faces, colors=np.ones(vertices.shape), decimation=(20, None), header="test")
+    with open(filename) as obj:
+        lines = obj.read().splitlines()
+    assert lines[0] == "### test ###"
+    assert 0 < len([line for line in lines if line.startswith("f ")]) <= 20
+    assert len(lines[1].split()) == 7
+
+def test_cluster():
+    from decimate import gridMesh
+    vertices, faces = gridMesh(60)
+    colors = np.column_stack((vertices[:, 0]/59, np.zeros(len(vertices)), np.ones(len(vertices))))
+    clustered, simple, normals, newColors = cluster(vertices, faces, colors=colors, targetFaces=1000)
+    assert 500 <= len(simple) <= 1500 and normals is None and len(newColors) == len(clustered)
+    assert np.allclose(clustered[:, 2], 0) and simple.max() == len(clustered)-1
+    assert np.all((simple[:, 0] != simple[:, 1]) & (simple[:, 1] != simple[:, 2]) & (simple[:, 2] != simple[:, 0]))
+    assert len(np.unique(np.sort(simple, axis=1), axis=0)) == len(simple)
+
+def test_simplify_cluster(monkeypatch):
+    from decimate import gridMesh
+    vertices, faces = gridMesh(60)
+    monkeypatch.setitem(globals(), 'CLUSTER_FACES', 2000)
+    decimated, simple, normals, colors = simplify(vertices, faces, decimation=(200, None))
+    assert 0 < len(simple) <= 200
+    assert np.allclose(decimated[:, 2], 0)
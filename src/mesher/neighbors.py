@@ -0,0 +1,132 @@
+import numpy as np
+
+# The 27 cells around (and including) a cell
+NEIGHBOR_OFFSETS = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)])
+
+
+def estimateSpacing(xyz):
+    """
+    Rough point spacing of a scanned surface, from the bounding box area
+    and the number of points (scans are surfaces, not volumes)
+    """
+    size = np.ptp(xyz, axis=0) if len(xyz) else np.zeros(3)
+    area = 2*(size[0]*size[1] + size[1]*size[2] + size[0]*size[2])
+    return max(np.sqrt(area/max(len(xyz), 1)), 1e-6)
+
+
+class NeighborGrid:
+    """ NeighborGrid sorts points by cell of a regular grid, so that all
+        neighbors of a batch of points within a cell size can be found
+        with a few array operations """
+    def __init__(self, xyz, cellSize):
+        """ Create a new NeighborGrid object
+        xyz      = (n,3) array of points positions
+        cellSize = size of the grid cells, the largest radius that can be queried
+        """
+        self.xyz = np.asarray(xyz, dtype=float)
+        self.cellSize = float(cellSize)
+        cells = np.floor(self.xyz/self.cellSize).astype(np.int64)
+        # Keep one empty cell on each side so that neighbor offsets stay in the grid
+        self.origin = cells.min(axis=0)-1 if len(cells) else np.zeros(3, dtype=np.int64)
+        self.dims = (cells.max(axis=0)-self.origin+2) if len(cells) else np.ones(3, dtype=np.int64)
+        keys = self.cellKeys(cells-self.origin)
+        self.order = np.argsort(keys, kind='mergesort')
+        self.sortedKeys = keys[self.order]
+
+    def cellKeys(self, cells):
+        return (cells[:, 0]*self.dims[1] + cells[:, 1])*self.dims[2] + cells[:, 2]
+
+    def pairs(self, query, radius=None, chunkSize=4096):
+        """
+        Yield (i, j, d) arrays for all pairs of query point i and grid point j
+        closer than radius (<= cellSize), chunkSize query points at a time.
+        Query points are also grid points, pairs (i, i) are included.
+        """
+        radius = self.cellSize if radius is None else radius
+        assert radius <= self.cellSize, "radius larger than the grid cells"
+        query = np.asarray(query, dtype=float)
+        for first in xrange(0, len(query), chunkSize):
+            points = query[first:first+chunkSize]
+            cells = np.floor(points/self.cellSize).astype(np.int64)-self.origin
+            # Queries outside the grid have no neighbor
+            inside = np.all((cells >= 1) & (cells < self.dims-1), axis=1)
+            index = np.flatnonzero(inside)
+            cells = cells[inside]
+            for offset in NEIGHBOR_OFFSETS:
+                keys = self.cellKeys(cells+offset)
+                start = np.searchsorted(self.sortedKeys, keys, 'left')
+                counts = np.searchsorted(self.sortedKeys, keys, 'right')-start
+                total = counts.sum()
+                if total == 0:
+                    continue
+                i = np.repeat(index, counts)
+                shift = np.repeat(np.cumsum(counts)-counts-start, counts)
+                j = self.order[np.arange(total)-shift]
+                d = np.sqrt(((self.xyz[j]-points[i])**2).sum(axis=1))
+                close = d <= radius
+                yield i[close]+first, j[close], d[close]
+
+
+def knnDistances(xyz, k, cellSize=None, maxIterations=6):
+    """
+    Distances to the k nearest neighbors of each point (the point itself
+    excluded), as a (n,k) array sorted in increasing order.
+    The search radius starts at cellSize and doubles for the points that
+    miss neighbors, missing neighbors after maxIterations are inf.
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    result = np.empty((len(xyz), k))
+    result.fill(np.inf)
+    cellSize = estimateSpacing(xyz)*2 if cellSize is None else cellSize
+    todo = np.arange(len(xyz))
+    for iteration in xrange(maxIterations):
+        if len(todo) == 0:
+            break
+        grid = NeighborGrid(xyz, cellSize)
+        found = [(i, j, d) for i, j, d in grid.pairs(xyz[todo]) if len(i)]
+        if len(found):
+            i, j, d = map(np.concatenate, zip(*found))
+            other = todo[i] != j
+            i, d = i[other], d[other]
+            # Rank neighbors of each point by distance
+            order = np.lexsort((d, i))
+            i, d = i[order], d[order]
+            rank = np.arange(len(i))-np.searchsorted(i, i, 'left')
+            keep = rank < k
+            result[todo[i[keep]], rank[keep]] = d[keep]
+        todo = todo[np.isinf(result[todo, -1])]
+        cellSize *= 2
+    return result
+
+
+def countNeighbors(xyz, radius):
+    """ Number of neighbors within radius of each point (the point itself excluded) """
+    xyz = np.asarray(xyz, dtype=float)
+    counts = np.zeros(len(xyz), dtype=np.int64)
+    for i, j, d in NeighborGrid(xyz, radius).pairs(xyz, radius):
+        counts += np.bincount(i, minlength=len(xyz))
+    return counts-1
+
+
+def test_pairs():
+    xyz = np.array([(0, 0, 0), (1, 0, 0), (0, 3, 0), (10, 10, 10)], dtype=float)
+    found = set()
+    for i, j, d in NeighborGrid(xyz, 2).pairs(xyz, 1.5):
+        found.update(zip(i, j))
+    assert found == set([(0, 0), (1, 1), (2, 2), (3, 3), (0, 1), (1, 0)])
+
+def test_knnDistances():
+    xyz = np.array([(0, 0, 0), (1, 0, 0), (3, 0, 0), (30, 0, 0)], dtype=float)
+    d = knnDistances(xyz, 2, cellSize=1.5)
+    assert list(d[0]) == [1, 3]
+    assert list(d[2]) == [2, 3]
+    assert list(d[3]) == [27, 29]
+
+def test_knnDistances_bruteforce():
+    xyz = np.random.RandomState(1).uniform(0, 100, (500, 3))
+    expected = np.sort(np.sqrt(((xyz[:, None]-xyz[None])**2).sum(axis=2)), axis=1)[:, 1:5]
+    assert np.allclose(knnDistances(xyz, 4), expected)
+
+def test_countNeighbors():
+    xyz = np.array([(0, 0, 0), (1, 0, 0), (0, 1, 0), (5, 5, 5)], dtype=float)
+    assert list(countNeighbors(xyz, 1.2)) == [2, 1, 1, 0]
@@ -0,0 +1,197 @@
+import logging
+import numpy as np
+import cv2
+from voxel import pointsToArrays, arraysToPoints
+from slicegrid import scanPoints
+
+
+def wrapAngles(array, pad):
+    """ array with pad columns of the other side added on each side: angles are periodic """
+    return np.concatenate((array[:, -pad:], array, array[:, :pad]), axis=1) if pad > 0 else array
+
+
+class RangeImage:
+    def __init__(self, angles, rows, heightStep=1.0, top=0.0):
+        """ Create a new RangeImage object, a scan seen from the turntable axis
+        angles     = number of columns, for a whole turn
+        rows       = number of rows, from top down to top-(rows-1)*heightStep
+        heightStep = height of the rows
+        top        = height of the first row
+        """
+        self.angles     = angles
+        self.heightStep = float(heightStep)
+        self.top        = float(top)
+        self.radius     = np.zeros((rows, angles), dtype=np.float32)
+        self.colors     = np.zeros((rows, angles, 3), dtype=np.float32)
+        self.valid      = np.zeros((rows, angles), dtype=bool)
+
+    def median(self, size=3):
+        """ Replace the radius of the valid cells by the median of the valid ones around (size x size cells) """
+        pad = size//2
+        radius = np.where(self.valid, self.radius, np.nan)
+        radius = np.pad(wrapAngles(radius, pad), ((pad, pad), (0, 0)), 'constant', constant_values=np.nan)
+        rows, angles = self.radius.shape
+        windows = [radius[i:i+rows, j:j+angles] for i in range(size) for j in range(size)]
+        with np.errstate(invalid='ignore'):
+            median = np.nanmedian(windows, axis=0)
+        self.radius[self.valid] = median[self.valid]
+
+    def bilateral(self, size=5, sigmaRadius=2.0, sigmaSpace=2.0):
+        """ Smooth the radius of the valid cells, preserving edges (see cv2.bilateralFilter) """
+        pad = size//2
+        # Invalid cells are too far from any radius to weigh
+        radius = wrapAngles(np.where(self.valid, self.radius, -1e4).astype(np.float32), pad)
+        smoothed = cv2.bilateralFilter(radius, size, sigmaRadius, sigmaSpace)[:, pad:pad+self.angles]
+        self.radius[self.valid] = smoothed[self.valid]
+
+    def fillHoles(self, maxArea=16, inpaintRadius=3):
+        """
+        Inpaint the holes of at most maxArea cells. Invalid cells connected
+        to the top or bottom rows are around the object, not holes.
+        Returns the number of cells filled
+        """
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(np.uint8(~self.valid), connectivity=4)
+        outside = np.union1d(labels[0], labels[-1])
+        holes = np.flatnonzero(stats[:, cv2.CC_STAT_AREA] <= maxArea)
+        holes = np.isin(labels, holes[~np.isin(holes, outside)]) & ~self.valid
+        if not holes.any():
+            return 0
+        pad = inpaintRadius+1
+        mask = np.uint8(wrapAngles(holes, pad))
+        radius = cv2.inpaint(wrapAngles(self.radius, pad), mask, inpaintRadius, cv2.INPAINT_NS)
+        colors = cv2.inpaint(np.uint8(np.clip(wrapAngles(self.colors, pad)*255, 0, 255)), mask, inpaintRadius, cv2.INPAINT_NS)
+        self.radius[holes] = radius[:, pad:pad+self.angles][holes]
+        self.colors[holes] = colors[:, pad:pad+self.angles][holes]/255.0
+        self.valid |= holes
+        return int(holes.sum())
+
+    def save(self, filename, resolution=100.0):
+        """
+        Save in a npz file with the radius as a 16 bits PNG (in 1/resolution
+        units, 0 for invalid cells) and the colors as a PNG
+        """
+        radius = np.where(self.valid, np.clip(np.round(self.radius*resolution), 1, 65535), 0).astype(np.uint16)
+        colors = np.uint8(np.clip(np.round(self.colors*255), 0, 255))
+        np.savez(filename, radius=cv2.imencode('.png', radius)[1], colors=cv2.imencode('.png', colors)[1],
+                 geometry=np.array([self.heightStep, self.top, resolution]))
+
+    def toArrays(self):
+        """ Returns the (xyz, colors, normals) arrays of the valid cells """
+        rows, columns = np.nonzero(self.valid)
+        step = 2*np.pi/self.angles
+        theta = (columns+0.5)*step
+        radius = self.radius[rows, columns].astype(float)
+        # Derivatives of the radius by angle and by height, 0 next to invalid cells
+        def derivative(axis, delta):
+            before = np.roll(np.where(self.valid, self.radius, np.nan), 1, axis=axis)
+            after = np.roll(np.where(self.valid, self.radius, np.nan), -1, axis=axis)
+            if axis == 0:
+                before[0], after[-1] = np.nan, np.nan
+            values = (after-before)[rows, columns]/(2*delta)
+            return np.where(np.isfinite(values), values, 0.0)
+        dTheta, dHeight = derivative(1, step), derivative(0, -self.heightStep)
+        cos, sin = np.cos(theta), np.sin(theta)
+        # Cross product of the surface derivatives by angle and by height
+        tangentTheta = np.column_stack((dTheta*cos - radius*sin, dTheta*sin + radius*cos, np.zeros(len(rows))))
+        tangentHeight = np.column_stack((dHeight*cos, dHeight*sin, np.ones(len(rows))))
+        normals = np.cross(tangentTheta, tangentHeight)
+        normals /= np.maximum(np.sqrt((normals**2).sum(axis=1)), 1e-9)[:, None]
+        xyz = np.column_stack((radius*cos, radius*sin, self.top - rows*self.heightStep))
+        return xyz, self.colors[rows, columns].astype(float), normals
+
+    def toPoints(self):
+        return arraysToPoints(*self.toArrays())
+
+
+def fromPoints(points, angles=360, heightStep=1.0):
+    """ RangeImage of points (nested lists of points), averaging the points of each cell """
+    xyz, colors, normals = pointsToArrays(list(scanPoints(points)))
+    top = xyz[:, 2].max() if len(xyz) else 0.0
+    rows = np.round((top - xyz[:, 2])/heightStep).astype(int)
+    columns = (np.floor(np.arctan2(xyz[:, 1], xyz[:, 0])/(2*np.pi)*angles).astype(int)) % angles
+    image = RangeImage(angles, rows.max()+1 if len(xyz) else 0, heightStep, top)
+    cells = rows*angles + columns
+    size = image.radius.size
+    counts = np.bincount(cells, minlength=size).reshape(image.radius.shape)
+    image.valid = counts > 0
+    mean = lambda values: np.bincount(cells, weights=values, minlength=size).reshape(image.radius.shape)/np.maximum(counts, 1)
+    image.radius[:] = mean(np.hypot(xyz[:, 0], xyz[:, 1]))
+    for channel in range(3):
+        image.colors[:, :, channel] = mean(colors[:, channel])
+    return image
+
+
+def loadRangeImage(filename):
+    """ RangeImage saved by RangeImage.save """
+    with np.load(filename) as data:
+        radius = cv2.imdecode(data['radius'], cv2.IMREAD_UNCHANGED)
+        colors = cv2.imdecode(data['colors'], cv2.IMREAD_UNCHANGED)
+        heightStep, top, resolution = data['geometry']
+    image = RangeImage(radius.shape[1], radius.shape[0], heightStep, top)
+    image.valid = radius > 0
+    image.radius[:] = radius/resolution
+    image.colors[:] = colors/255.0
+    return image
+
+
+def smoothPoints(points, angles=360, heightStep=1.0, median=0, holes=0):
+    """
+    Denoise a scan in its range image: fill the holes of at most holes cells
+    then apply a median filter of median x median cells (0 for none).
+    Returns the points of the cells, an empty list if there are no points
+    """
+    points = list(scanPoints(points))
+    if len(points) == 0:
+        return points
+    image = fromPoints(points, angles, heightStep)
+    filled = image.fillHoles(holes) if holes > 0 else 0
+    if median > 1:
+        image.median(median)
+    logging.info("Range image %dx%d : %d cells, %d holes filled" % (image.angles, len(image.radius), image.valid.sum(), filled))
+    return image.toPoints()
+
+
+def cylinder(noise=0.0, hole=False):
+    """ Points of a cylinder of radius 100, on the cells of a 90 x 50 range image """
+    rng = np.random.RandomState(0)
+    theta = (np.arange(90)+0.5)*2*np.pi/90
+    heights = np.arange(50, dtype=float)
+    theta, heights = [values.ravel() for values in np.meshgrid(theta, heights)]
+    radius = 100 + rng.normal(0, noise, len(theta))
+    keep = ~((np.abs(heights-25) < 2) & (np.abs(theta-np.pi) < 0.1)) if hole else np.ones(len(theta), dtype=bool)
+    xyz = np.column_stack((radius*np.cos(theta), radius*np.sin(theta), heights))[keep]
+    return arraysToPoints(xyz, np.full(xyz.shape, 0.5), np.zeros(xyz.shape))
+
+
+def test_fromPoints():
+    image = fromPoints(cylinder(), angles=90)
+    assert image.radius.shape == (50, 90) and image.valid.all()
+    xyz, colors, normals = image.toArrays()
+    assert np.allclose(np.hypot(xyz[:, 0], xyz[:, 1]), 100, atol=1e-3)
+    # Normals point outwards
+    assert (normals[:, 0]*xyz[:, 0] + normals[:, 1]*xyz[:, 1] > 0.99*100).all()
+
+def test_median():
+    image = fromPoints(cylinder(noise=1.0), angles=90)
+    before = image.radius[image.valid].std()
+    image.median(3)
+    assert image.radius[image.valid].std() < 0.6*before
+    image = fromPoints(cylinder(noise=1.0), angles=90)
+    image.bilateral(5, 3.0, 2.0)
+    assert image.radius[image.valid].std() < before
+
+def test_fillHoles(tmpdir):
+    image = fromPoints(cylinder(hole=True), angles=90)
+    assert not image.valid.all()
+    assert image.fillHoles(maxArea=4) == 0
+    assert image.fillHoles(maxArea=32) > 0
+    assert image.valid.all() and np.allclose(image.radius, 100, atol=0.5)
+    filename = str(tmpdir.join("range.npz"))
+    image.save(filename)
+    loaded = loadRangeImage(filename)
+    assert np.array_equal(loaded.valid, image.valid)
+    assert np.abs(loaded.radius-image.radius).max() <= 0.005
+
+def test_smoothPoints_empty():
+    assert smoothPoints([], 360, 1.0, 3, 16) == []
+    assert smoothPoints([[], ([],)], 360, 1.0, 3, 0) == []
@@ -0,0 +1,173 @@
+import logging
+from math import sqrt
+import numpy as np
+from voxel import pointsToArrays
+from meshfile import writePly
+
+
+def scanPoints(items):
+    """ Yields the points of nested lists or tuples of points (as the scenes give them) """
+    for item in items:
+        if isinstance(item, (list, tuple)):
+            for point in scanPoints(item):
+                yield point
+        else:
+            yield item
+
+
+def scanProfiles(points):
+    """
+    Groups the points by the (scene, step) they were found at, each group
+    sorted by picture line. Returns the (xyz, colors, normals) arrays of the
+    profiles and their angles around the turntable axis, by increasing angle:
+    left and right laser profiles are interleaved
+    """
+    groups = dict()
+    for point in points:
+        if point.origin is not None:
+            name, step, line = point.origin
+            groups.setdefault((name, step), []).append((line, point))
+    profiles, angles = [], []
+    for key in groups:
+        group = sorted(groups[key], key=lambda item: item[0])
+        profile = pointsToArrays([point for row, point in group])
+        profiles.append(profile)
+        # Circular mean, profiles cross the -pi/pi limit
+        angles.append(np.angle(np.exp(1j*np.arctan2(profile[0][:, 1], profile[0][:, 0])).mean()))
+    order = np.argsort(angles)
+    return [profiles[i] for i in order], [angles[i] for i in order]
+
+
+def splitProfile(xyz, maxEdge):
+    """ Returns the slices of the parts of a profile separated by gaps larger than maxEdge """
+    gaps = np.flatnonzero(np.sqrt((np.diff(xyz, axis=0)**2).sum(axis=1)) > maxEdge)+1
+    bounds = np.concatenate(([0], gaps, [len(xyz)]))
+    return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def zipper(xyz, a, b, maxEdge):
+    """
+    Triangle strip between the polylines of vertices a and b (indices in
+    the xyz list of (x, y, z), ordered by picture line), each triangle
+    joining the next vertex of one polyline with the shortest diagonal.
+    Triangles with an edge longer than maxEdge are left out.
+    Returns a list of (i, j, k) faces
+    """
+    def distance(p, q):
+        (px, py, pz), (qx, qy, qz) = xyz[p], xyz[q]
+        return sqrt((px-qx)**2 + (py-qy)**2 + (pz-qz)**2)
+    i, j = 0, 0
+    # Polylines may start at different heights: start from the closest ends
+    while i < len(a)-1 and distance(a[i+1], b[0]) < distance(a[i], b[0]):
+        i += 1
+    while j < len(b)-1 and distance(b[j+1], a[i]) < distance(b[j], a[i]):
+        j += 1
+
+    faces = []
+    while i < len(a)-1 or j < len(b)-1:
+        if j == len(b)-1 or (i < len(a)-1 and distance(a[i+1], b[j]) <= distance(a[i], b[j+1])):
+            face = (a[i], a[i+1], b[j])
+            i += 1
+        else:
+            face = (a[i], b[j+1], b[j])
+            j += 1
+        if max(distance(face[0], face[1]), distance(face[1], face[2]), distance(face[2], face[0])) <= maxEdge:
+            faces.append(face)
+    return faces
+
+
+def meshSliceGrid(points, outFile=None, maxEdge=20.0, decimation=None):
+    """
+    Meshes the points of a scan by joining the laser profiles of adjacent
+    turntable angles (see Point.origin) with triangle strips, in time linear
+    with the number of points (after sorting each profile). Parts of
+    profiles separated by more than maxEdge are meshed separately.
+    Returns the (xyz, faces, normals, colors) arrays, written to outFile
+    (PLY) if given, simplified to decimation (see meshfile.simplify)
+    """
+    profiles, angles = scanProfiles(scanPoints(points))
+    if len(profiles) == 0:
+        logging.warning("\033[93m No points with their scan origin to mesh \033[0m")
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=int), np.zeros((0, 3)), np.zeros((0, 3))
+    xyz = np.vstack([profile[0] for profile in profiles])
+    colors = np.vstack([profile[1] for profile in profiles])
+    normals = np.vstack([profile[2] for profile in profiles])
+    offsets = np.cumsum([0]+[len(profile[0]) for profile in profiles])
+
+    parts = []
+    for index, profile in enumerate(profiles):
+        vertices = np.arange(offsets[index], offsets[index+1])
+        heights = profile[0][:, 2]
+        parts.append([(vertices[s], heights[s].min(), heights[s].max()) for s in splitProfile(profile[0], maxEdge)])
+
+    coordinates = xyz.tolist()
+    faces = []
+    # The last profile is joined to the first one: too far apart, they give no triangle
+    for index in range(len(parts) if len(parts) > 2 else len(parts)-1):
+        for a, aLow, aHigh in parts[index]:
+            for b, bLow, bHigh in parts[(index+1) % len(parts)]:
+                if aLow <= bHigh+maxEdge and bLow <= aHigh+maxEdge:
+                    faces += zipper(coordinates, a.tolist(), b.tolist(), maxEdge)
+    faces = np.array(faces, dtype=int).reshape((-1, 3))
+
+    # Faces point to the lasers, as the normals of the points
+    if len(faces):
+        faceNormals = np.cross(xyz[faces[:, 1]]-xyz[faces[:, 0]], xyz[faces[:, 2]]-xyz[faces[:, 0]])
+        if (faceNormals*normals[faces].sum(axis=1)).sum() < 0:
+            faces = faces[:, ::-1]
+
+    logging.info("Slice grid mesh : %d profiles, %d points, %d triangles" % (len(profiles), len(xyz), len(faces)))
+    if outFile is not None:
+        writePly(outFile, xyz, faces, normals, colors, decimation)
+    return xyz, faces, normals, colors
+
+
+def triangulatedSphere(directory, steps=20, radius=80.0):
+    """
+    Points triangulated by a right and a left scene (scanner.scene) from
+    the pixels of a sphere of radius above the turntable center, seen by a
+    camera 450 mm high. Returns the list of the points of each scene and step
+    """
+    from scanner.scene import Camera, Scene
+    from scanner.arduino import TurnTable, Laser
+    camera = Camera("simulated", (640, 480), (0, 450, 0), 90, ('', '.png'), directory)
+    turntable = TurnTable((0, 178, 350), 500, steps, None)
+    # Turntable center at the picture center
+    camera.calibrate(turntable, (0, 0))
+    center = turntable.position + (0, 100, 0)
+    picture = np.zeros((480, 640, 3), dtype=np.uint8)
+    points = []
+    for name, x in (('right', 150.0), ('left', -150.0)):
+        laser = Laser(name[0].upper(), None)
+        laser.calibrate(np.array([x, 450, 0], dtype=np.float32), np.arctan2(x, 350))
+        scene = Scene(name, camera, laser, turntable)
+        # The sphere is the same at each step: intersection with the laser plane, lit and seen
+        world = []
+        for h in np.linspace(-radius, radius, 200) + center[1] - laser.position[1]:
+            offset = laser.position + h*laser.v1 - center
+            b, c = offset.dot(laser.v2), offset.dot(offset) - radius**2
+            if b*b > c:
+                point = laser.position + h*laser.v1 + (-b - np.sqrt(b*b - c))*laser.v2
+                if (laser.position-point).dot(point-center) > 0 and (camera.position-point).dot(point-center) > 0:
+                    world.append(point)
+        for step in range(steps):
+            points.append(scene.triangulate(camera.project(np.array(world)), picture, step))
+    camera.release()
+    return points
+
+
+def test_meshSliceGrid(tmpdir):
+    scans = triangulatedSphere(str(tmpdir))
+    # A gap in one profile
+    scans[5] = [point for point in scans[5] if not 40 < point.z < 80]
+    xyz, faces, normals, colors = meshSliceGrid([scans[:20], (scans[20:],)], maxEdge=60)
+    center = np.array([0, 0, 100])
+    assert len(xyz) == sum(map(len, scans))
+    assert np.allclose(np.sqrt(((xyz-center)**2).sum(axis=1)), 80, atol=0.01)
+    # Normals of triangulate are in the axes order of the points: outwards
+    assert ((normals*(xyz-center)).sum(axis=1) > 0).all()
+    edges = np.sqrt(((xyz[faces]-xyz[np.roll(faces, 1, axis=1)])**2).sum(axis=2))
+    assert edges.max() <= 60
+    assert len(faces) > 1.5*len(xyz)
+    faceNormals = np.cross(xyz[faces[:, 1]]-xyz[faces[:, 0]], xyz[faces[:, 2]]-xyz[faces[:, 0]])
+    assert ((faceNormals*(xyz[faces].mean(axis=1)-center)).sum(axis=1) > 0).all()
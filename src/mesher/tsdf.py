@@ -0,0 +1,319 @@
+import time
+import logging
+import resource
+import multiprocessing
+import numpy as np
+from voxel import pointsToArrays
+from slicegrid import scanPoints
+
+# Cube corner i is at (i&1, i>>1&1, i>>2&1), cube edges join corners differing by one bit
+CORNERS = np.array([(i & 1, (i >> 1) & 1, (i >> 2) & 1) for i in range(8)])
+EDGES = [(a, a | bit) for a in range(8) for bit in (1, 2, 4) if not a & bit]
+EDGE_AXIS = np.array([(b ^ a).bit_length()-1 for a, b in EDGES])
+# Triangles (as edge indices) of each of the 256 inside/outside corner configurations
+TRIANGLES = None
+
+
+def cubeTriangles(config):
+    """
+    Triangles (edge indices) of the surface in a cube whose corners i with
+    config bit i set are inside. The surface is traced around the cube faces:
+    on a face with two inside corners on a diagonal, they are kept apart, so
+    that neighbor cubes agree and the surface is closed. Triangles turn
+    counterclockwise seen from the outside
+    """
+    inside = [(config >> i) & 1 for i in range(8)]
+    middle = lambda edge: (CORNERS[EDGES[edge][0]] + CORNERS[EDGES[edge][1]])/2.0
+    edgeOf = dict(((a, b), e) for e, (a, b) in enumerate(EDGES))
+    edgeOf.update(((b, a), e) for e, (a, b) in enumerate(EDGES))
+    following = dict()
+    for axis in range(3):
+        u, v = [other for other in range(3) if other != axis]
+        for side in (0, 1):
+            normal = np.zeros(3)
+            normal[axis] = 1 if side else -1
+            # Face corners in cyclic order
+            cycle = [(side << axis) | (du << u) | (dv << v) for du, dv in ((0, 0), (1, 0), (1, 1), (0, 1))]
+            crossings = [(k, edgeOf[cycle[k], cycle[(k+1) % 4]]) for k in range(4) if inside[cycle[k]] != inside[cycle[(k+1) % 4]]]
+            if len(crossings) == 2:
+                segments = [(crossings[0][1], crossings[1][1], np.mean([CORNERS[c] for c in cycle if inside[c]], axis=0))]
+            elif len(crossings) == 4:
+                # Each inside corner is cut off by the segment of its two edges
+                segments = [(edgeOf[cycle[k-1], cycle[k]], edgeOf[cycle[k], cycle[(k+1) % 4]], CORNERS[cycle[k]])
+                            for k in range(4) if inside[cycle[k]]]
+            else:
+                segments = []
+            for a, b, corner in segments:
+                # Inside on the left of the segment, seen from outside the cube
+                if np.dot(np.cross(middle(b)-middle(a), corner-middle(a)), normal) < 0:
+                    a, b = b, a
+                following[a] = b
+    triangles = []
+    while following:
+        loop = [following.keys()[0]]
+        while following[loop[-1]] != loop[0]:
+            loop.append(following.pop(loop[-1]))
+        following.pop(loop[-1])
+        triangles += [(loop[0], loop[i+1], loop[i]) for i in range(1, len(loop)-1)]
+    return triangles
+
+
+def triangleTable():
+    """ (256, 12, 3) array of the triangles of each configuration (-1 padded) and their (256,) counts """
+    global TRIANGLES
+    if TRIANGLES is None:
+        table = -np.ones((256, 12, 3), dtype=int)
+        counts = np.zeros(256, dtype=int)
+        for config in range(256):
+            triangles = cubeTriangles(config)
+            counts[config] = len(triangles)
+            if triangles:
+                table[config, :len(triangles)] = triangles
+        TRIANGLES = (table, counts)
+    return TRIANGLES
+
+
+class TSDFVolume:
+    def __init__(self, voxelSize=2.0, truncation=None, spread=None, blockSize=8, maxWeight=64):
+        """ Create a new TSDFVolume object, a truncated signed distance field
+            stored in blocks of voxels allocated where surfaces are seen
+        voxelSize  = size of the voxels
+        truncation = distances along the rays are clipped to [-truncation, truncation] (3 voxels by default)
+        spread     = distance to the rays up to which voxels are updated (2 voxels by default):
+                     laser profiles are lines, it fills the space between them
+        blockSize  = number of voxels of the side of a block
+        maxWeight  = weight after which new observations stop averaging down the old ones
+        """
+        self.voxelSize  = float(voxelSize)
+        self.truncation = float(truncation) if truncation is not None else 3*self.voxelSize
+        self.spread     = float(spread) if spread is not None else 2*self.voxelSize
+        self.blockSize  = blockSize
+        self.maxWeight  = maxWeight
+        # (bx, by, bz) -> (distance, weight) arrays of blockSize**3 voxels
+        self.blocks     = {}
+
+    def memory(self):
+        """ Bytes of the allocated blocks """
+        return len(self.blocks)*2*4*self.blockSize**3
+
+    def integrate(self, points, origins, chunkSize=2048):
+        """
+        Fuse surface points seen from origins (a (3,) position or one per
+        point) along their rays: voxels within the truncation distance of a
+        point along its ray, and within spread of the ray, get the signed
+        distance along the ray, positive on the origin side
+        """
+        points = np.asarray(points, dtype=float).reshape((-1, 3))
+        origins = np.broadcast_to(np.asarray(origins, dtype=float), points.shape)
+        half = int(np.ceil(max(self.truncation, self.spread)/self.voxelSize))
+        box = np.array(np.meshgrid(*[np.arange(-half, half+1)]*3, indexing='ij')).reshape((3, -1)).T
+        for start in range(0, len(points), chunkSize):
+            chunk = points[start:start+chunkSize]
+            rays = chunk - origins[start:start+chunkSize]
+            rays /= np.maximum(np.sqrt((rays**2).sum(axis=1)), 1e-9)[:, None]
+            # Voxels of a box around each point
+            voxels = np.floor(chunk/self.voxelSize).astype(np.int64)[:, None, :] + box[None]
+            offsets = chunk[:, None, :] - (voxels+0.5)*self.voxelSize
+            along = (offsets*rays[:, None, :]).sum(axis=2)
+            across = (offsets**2).sum(axis=2) - along**2
+            kept = (np.abs(along) <= self.truncation) & (across <= self.spread**2)
+            voxels, distances = voxels[kept], along[kept]/self.truncation
+            # One mean distance by voxel for the whole chunk
+            voxels, inverse = np.unique(voxels, axis=0, return_inverse=True)
+            counts = np.bincount(inverse).astype(np.float32)
+            self.update(voxels, np.bincount(inverse, weights=distances).astype(np.float32)/counts, counts)
+
+    def update(self, voxels, distances, weights):
+        """ Average (voxels, distances, weights) observations in the blocks """
+        blockKeys, inverse = np.unique(voxels // self.blockSize, axis=0, return_inverse=True)
+        local = voxels % self.blockSize
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.searchsorted(inverse[order], np.arange(len(blockKeys)+1))
+        size = self.blockSize
+        for index, key in enumerate(map(tuple, blockKeys)):
+            if key not in self.blocks:
+                self.blocks[key] = (np.ones((size, size, size), dtype=np.float32), np.zeros((size, size, size), dtype=np.float32))
+            distance, weight = self.blocks[key]
+            selected = order[bounds[index]:bounds[index+1]]
+            x, y, z = local[selected].T
+            total = weight[x, y, z] + weights[selected]
+            distance[x, y, z] = (distance[x, y, z]*weight[x, y, z] + distances[selected]*weights[selected])/total
+            weight[x, y, z] = np.minimum(total, self.maxWeight)
+
+    def paddedBlock(self, key):
+        """ Distances of a block and of the first voxels of the next blocks, NaN where unknown """
+        size = self.blockSize
+        padded = np.full((size+1, size+1, size+1), np.nan, dtype=np.float32)
+        for corner in CORNERS:
+            block = self.blocks.get((key[0]+corner[0], key[1]+corner[1], key[2]+corner[2]))
+            if block is not None:
+                target = tuple(slice(size, size+1) if c else slice(0, size) for c in corner)
+                source = tuple(slice(0, 1) if c else slice(0, size) for c in corner)
+                padded[target] = np.where(block[1][source] > 0, block[0][source], np.nan)
+        return padded
+
+    def extractMesh(self):
+        """
+        Marching cubes on the zero level of the distances, vectorized by block.
+        Returns the (xyz, faces, normals) arrays, normals pointing outside
+        """
+        table, counts = triangleTable()
+        size = self.blockSize
+        edgeKeys, positions = [], []
+        for key in self.blocks:
+            padded = self.paddedBlock(key)
+            corners = np.stack([padded[x:x+size, y:y+size, z:z+size] for x, y, z in CORNERS], axis=-1).reshape((-1, 8))
+            # Only cubes known and near the surface: far values are truncated
+            with np.errstate(invalid='ignore'):
+                near = np.all(np.abs(corners) < 1, axis=1)
+                configs = ((corners < 0)*(1 << np.arange(8))).sum(axis=1)
+            cubes = np.flatnonzero(near & (counts[configs] > 0))
+            if len(cubes) == 0:
+                continue
+            configs, corners = configs[cubes], corners[cubes]
+            # One row by triangle
+            triangleCubes = np.repeat(np.arange(len(cubes)), counts[configs])
+            triangleIndex = np.arange(len(triangleCubes)) - np.repeat(np.cumsum(counts[configs])-counts[configs], counts[configs])
+            edges = table[configs[triangleCubes], triangleIndex]
+            # Edges are named by their first corner (global voxel index) and axis, shared by neighbor cubes
+            origin = np.array(np.unravel_index(cubes, (size, size, size))).T + np.array(key)*size
+            first = np.array([a for a, b in EDGES])[edges]
+            second = np.array([b for a, b in EDGES])[edges]
+            cubeOfEdge = np.repeat(triangleCubes, 3).reshape(edges.shape)
+            start = origin[cubeOfEdge] + CORNERS[first]
+            edgeKeys.append(np.concatenate((start, EDGE_AXIS[edges][..., None]), axis=-1).reshape((-1, 4)))
+            a = corners[cubeOfEdge, first]
+            b = corners[cubeOfEdge, second]
+            t = (a/(a-b))[..., None]
+            positions.append(((start + t*(CORNERS[second]-CORNERS[first]))*self.voxelSize + self.voxelSize/2).reshape((-1, 3)))
+
+        if len(edgeKeys) == 0:
+            return np.zeros((0, 3)), np.zeros((0, 3), dtype=int), np.zeros((0, 3))
+        edgeKeys, positions = np.vstack(edgeKeys), np.vstack(positions)
+        edgeKeys, first, inverse = np.unique(edgeKeys, axis=0, return_index=True, return_inverse=True)
+        xyz = positions[first]
+        faces = inverse.reshape((-1, 3))
+        # Degenerate triangles of vertices on the same corner
+        faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+        faceNormals = np.cross(xyz[faces[:, 1]]-xyz[faces[:, 0]], xyz[faces[:, 2]]-xyz[faces[:, 0]])
+        normals = np.zeros(xyz.shape)
+        for i in range(3):
+            np.add.at(normals, faces[:, i], faceNormals)
+        normals /= np.maximum(np.sqrt((normals**2).sum(axis=1)), 1e-12)[:, None]
+        return xyz, faces, normals
+
+    def integrateScan(self, points, sensors):
+        """
+        Fuse the points of a scan (nested lists of points, see Point.origin)
+        along the camera and laser rays
+        sensors = function of (scene name, step) returning the positions of
+                  the camera and the laser in the points coordinates
+        """
+        groups = dict()
+        for point in scanPoints(points):
+            if point.origin is not None:
+                groups.setdefault(point.origin[:2], []).append(point)
+        for key, group in groups.items():
+            xyz = pointsToArrays(group)[0]
+            for origin in sensors(*key):
+                self.integrate(xyz, origin)
+        logging.info("TSDF : %d profiles fused in %d blocks (%.1f MB)" % (len(groups), len(self.blocks), self.memory()/1e6))
+
+
+def meshTSDF(points, sensors, outFile=None, voxelSize=2.0, decimation=None):
+    """
+    Mesh a scan by fusing it in a TSDFVolume, written to outFile (PLY) if
+    given, simplified to decimation if given (see meshfile.simplify)
+    """
+    volume = TSDFVolume(voxelSize)
+    volume.integrateScan(points, sensors)
+    xyz, faces, normals = volume.extractMesh()
+    logging.info("TSDF mesh : %d points, %d triangles" % (len(xyz), len(faces)))
+    if outFile is not None:
+        from meshfile import writePly
+        writePly(outFile, xyz, faces, normals, decimation=decimation)
+    return xyz, faces, normals
+
+
+def sphereProfiles(radius=50.0, steps=40, lines=60, distance=300.0):
+    """ Profiles of a sphere seen by a sensor turning around it: (points, sensor positions) by step """
+    profiles = []
+    for step in range(steps):
+        angle = 2*np.pi*step/steps
+        heights = np.linspace(-0.95, 0.95, lines)*radius
+        ring = np.sqrt(radius**2-heights**2)
+        points = np.column_stack((ring*np.cos(angle), ring*np.sin(angle), heights))
+        profiles.append((points, np.array([distance*np.cos(angle), distance*np.sin(angle), 0.0])))
+    return profiles
+
+
+def measure(function, *args):
+    """ (seconds, peak memory in MB) of function(*args) run in a new process """
+    def run(queue):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        function(*args)
+        queue.put((time.time()-start, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-before)/1024.0))
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run, args=(queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def benchmark(steps=40, lines=60, voxelSize=2.0):
+    """ Time and memory of TSDF meshing and of Mesher.run on a scanned sphere, as lines of text """
+    from __init__ import Mesher
+    from voxel import VoxelSpace, Point
+    profiles = sphereProfiles(steps=steps, lines=lines)
+
+    def tsdf():
+        volume = TSDFVolume(voxelSize)
+        for points, sensor in profiles:
+            volume.integrate(points, sensor)
+        return volume.extractMesh()
+
+    def regionGrowing():
+        space = VoxelSpace(10)
+        space.addPoints([Point(*xyz) for points, sensor in profiles for xyz in points])
+        Mesher(space).run()
+
+    lines = ["%d points" % (steps*lines)]
+    for name, function in (('TSDF', tsdf), ('Mesher.run', regionGrowing)):
+        seconds, memory = measure(function)
+        lines.append("%-12s %8.2fs %8.1f MB peak increase" % (name, seconds, memory))
+    return "\n".join(lines)
+
+
+def test_cubeTriangles():
+    table, counts = triangleTable()
+    assert counts[0] == 0 and counts[255] == 0
+    assert counts[1] == 1 and counts[3] == 2
+    # The surface cuts all the edges between inside and outside corners, and only them
+    for config in range(256):
+        crossed = set(e for e, (a, b) in enumerate(EDGES) if (config >> a & 1) != (config >> b & 1))
+        assert set(table[config, :counts[config]].ravel()) == crossed
+
+def test_tsdf_sphere():
+    volume = TSDFVolume(voxelSize=2.0, blockSize=8)
+    for points, sensor in sphereProfiles(steps=60, lines=80):
+        volume.integrate(points, sensor)
+    xyz, faces, normals = volume.extractMesh()
+    radii = np.sqrt((xyz**2).sum(axis=1))
+    assert len(faces) > 1000
+    # Poles are not seen
+    assert np.abs(radii-50)[np.abs(xyz[:, 2]) < 40].max() < 1.0
+    # Closed but at the poles: edges are shared by 2 triangles
+    edges = np.sort(np.vstack((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]])), axis=1)
+    shared = np.unique(edges, axis=0, return_counts=True)[1]
+    assert (shared == 2).mean() > 0.98 and shared.max() == 2
+    # Normals point outside
+    assert ((normals*xyz).sum(axis=1) > 0).mean() > 0.95
+    # Blocks only around the surface, not in the whole bounding box
+    keys = np.array(volume.blocks.keys())
+    assert volume.memory() < 0.6*np.prod((keys.max(axis=0)-keys.min(axis=0)+1)*8)*8
+
+
+if __name__ == "__main__":
+    print benchmark()
@@ -22,9 +22,11 @@ def combine(Xrange, Yrange, Zrange):
 				yield (x, y, z)
 
 class Point:
-	def __init__(self, x=0, y=0, z=0, index=None, r=0x77, g=0x77, b=0x77, nx=0, ny=0, nz=0):
+	def __init__(self, x=0, y=0, z=0, index=None, r=0x77, g=0x77, b=0x77, nx=0, ny=0, nz=0, origin=None):
 		self.xyz = np.array((x, y, z))
 		self.index = index
+		# (scene name, step, picture line) the point was found at, if known
+		self.origin = origin
 		if r > 1 or g > 1 or b > 1:
 			r, g, b = r/255., g/255., b/255.
 		self.color = np.array((r, g, b))
@@ -92,6 +94,59 @@ class Point:
 	def distance(self, other):
 		return norm3D(self - other)
 
+def pointsToArrays(points):
+	""" Returns the positions, colors and normals of a list of points as (n,3) arrays """
+	xyz = np.array([p.xyz for p in points], dtype=float).reshape((-1, 3))
+	colors = np.array([p.color for p in points], dtype=float).reshape((-1, 3))
+	normals = np.array([p.normal for p in points], dtype=float).reshape((-1, 3))
+	return xyz, colors, normals
+
+def arraysToPoints(xyz, colors, normals, origins=None):
+	""" Inverse of pointsToArrays, origins is an optional list of Point origins """
+	origins = origins if origins is not None else [None]*len(xyz)
+	return [Point(x, y, z, r=r, g=g, b=b, nx=nx, ny=ny, nz=nz, origin=origin)
+	        for (x, y, z), (r, g, b), (nx, ny, nz), origin in zip(xyz, colors, normals, origins)]
+
+def mergeCells(xyz, colors, normals, cellSize, returnCells=False):
+	"""
+	Merges all points of each cubic cell of a grid into one point, at their
+	mean position, with their mean color and (normalized) mean normal.
+	Returns the merged (xyz, colors, normals) arrays, and the index of the
+	merged point of each point if returnCells
+	"""
+	cells = np.floor(xyz/cellSize).astype(np.int64)
+	inverse = np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+	counts = np.bincount(inverse).astype(float)
+	mean = lambda values: np.column_stack([np.bincount(inverse, weights=values[:, i])/counts for i in xrange(3)])
+	normals = mean(normals)
+	norms = np.sqrt((normals**2).sum(axis=1))
+	normals[norms > 0] /= norms[norms > 0, None]
+	if returnCells:
+		return mean(xyz), mean(colors), normals, inverse
+	return mean(xyz), mean(colors), normals
+
+def downsample(points, cellSize=None, targetCount=None, iterations=20):
+	"""
+	Downsamples a list of points by merging the points of each cell of a grid,
+	either of a given cellSize (the target spacing), or of the size giving
+	about targetCount points (found by bisection). Returns a list of points
+	"""
+	xyz, colors, normals = pointsToArrays(points)
+	if cellSize is None:
+		if targetCount is None or targetCount >= len(xyz):
+			return list(points)
+		# The number of cells decreases with their size
+		low, high = 0.0, float(np.ptp(xyz, axis=0).max()) or 1.0
+		for i in xrange(iterations):
+			cellSize = (low+high)/2
+			count = len(np.unique(np.floor(xyz/cellSize).astype(np.int64), axis=0))
+			if count > targetCount:
+				low = cellSize
+			else:
+				high = cellSize
+		cellSize = high
+	return arraysToPoints(*mergeCells(xyz, colors, normals, cellSize))
+
 class VoxelSpace:
 	""" VoxelSpace holds points within voxels. It makes it easier to find
 		points that are close to each other for example"""
@@ -168,6 +223,19 @@ class VoxelSpace:
 			res += self.voxels[voxel]
 		return res
 
+	def downsample(self, subdivisions=1, spacing=None, targetCount=None):
+		"""
+		Returns a new VoxelSpace where the points of each voxel (or of each
+		cell of a grid subdivisions times finer) are merged into one point.
+		The grid can also be given by its spacing, or chosen to keep about
+		targetCount points
+		"""
+		if spacing is None and targetCount is None:
+			spacing = float(self.voxelSize)/subdivisions
+		space = VoxelSpace(self.voxelSize)
+		space.addPoints(downsample(self.allPoints(), spacing, targetCount))
+		return space
+
 	def pointsInCube(self, vx, vy, vz, neighbours=0):
 		"""
 		Returns a list of all points within a cube centered on vx,vy,vz
@@ -315,6 +383,24 @@ def test_partition():
 
 	assert space.voxelsAroundRegion((0,0,0), (1,1,1)) == [(-1, -1, -1)]
 
+def test_downsample():
+	points = [Point(0, 0, 0, r=1., g=0., b=0., nx=1.), Point(1, 1, 1, r=0., g=0., b=1., ny=1.), Point(15, 0, 0)]
+	res = sorted(downsample(points, 10), key=lambda p: p.x)
+	assert len(res) == 2
+	assert res[0] == (0.5, 0.5, 0.5)
+	assert np.allclose(res[0].color, (0.5, 0, 0.5))
+	assert np.allclose(res[0].normal, (np.sqrt(0.5), np.sqrt(0.5), 0))
+	assert res[1] == (15, 0, 0)
+
+def test_downsample_targetCount():
+	points = [Point(x, y, 0) for x in range(20) for y in range(20)]
+	res = downsample(points, targetCount=100)
+	assert 80 <= len(res) <= 100
+	space = VoxelSpace(10)
+	space.addPoints(points)
+	assert space.downsample().numberOfPoints() == 4
+	assert space.downsample(2).numberOfPoints() == 16
+
 def test_closestPointTo():
 	points = VoxelSpace(10)
 	points.addPoints([(0, 0, 9), (0, 0, 11), (0, 0, 0)])
@@ -340,5 +426,7 @@ if __name__ == "__main__":
 	test_flatten()
 	test_combine()
 	test_partition()
+	test_downsample()
+	test_downsample_targetCount()
 	test_closestPointTo()
 	test_voxelsInRegion()
@@ -4,15 +4,18 @@ import sys, os
 import logging
 import threading
 import getopt
-import numpy as np
 from gui import Gui, Tkinter
 from scanner.config import Config
-from scanner.scene import Camera, Scene
-from scanner.arduino import Arduino, TurnTable, Laser
-from mesher.voxel import VoxelSpace
+from scanner.arduino import Arduino
+from scanner.scheduler import Scheduler
+from scanner.writer import FrameWriter
+from scanner.processing import loadScanner, calibrate, toVoxelSpace, decimation
+from scanner.calibration import calibrationPath, loadCalibration, saveCalibration, applyCalibration, validateCalibration
 from mesher import Mesher
 from mesher.vtkdelaunay3D import delaunay3D
 from mesher.bpa import meshBPA
+from mesher.slicegrid import meshSliceGrid
+from mesher.tsdf import meshTSDF
 
 class Scanner3D(Tkinter.Tk):
     def __init__(self, args):
@@ -23,9 +26,11 @@ class Scanner3D(Tkinter.Tk):
         self.sceneLeft  = None
         self.sceneRight = None
         self.turntable  = None
+        self.camera     = None
         self.arduino    = None
         self.gui        = None
         self.directory  = None
+        self.reduce     = 1
         self.logLevel   = logging.WARNING
         self.thread     = threading.Thread(target=self.startScan, args=(False,))
     
@@ -37,13 +42,14 @@ class Scanner3D(Tkinter.Tk):
         print("  --help      , -h             : print this help")
         print("  --config    , -c <filename>  : use filename as configuration file (default=default.cfg)")
         print("  --processing, -p <directory> : use directory as the path to the directory of pictures to process (when you don't use the scanner)")
+        print("  --reduce    , -r <factor>    : process pictures at 1/2, 1/4 or 1/8 of their resolution (preview, with --processing)")
         print("  --loglevel  , -l <loglevel>  : set logelevel (default=WARNING)")
         print("  --arduino   , -a <path>      : start communication arduino")
 
     def parseArgv(self,args):
         """ This method parse command line """
         try:
-            opts, arguments = getopt.getopt(args[1:],"c:l:p:a:h",["file=", "loglevel=", "directory=", "arduino", "help"])
+            opts, arguments = getopt.getopt(args[1:],"c:l:p:r:a:h",["file=", "loglevel=", "directory=", "reduce=", "arduino", "help"])
         except getopt.GetoptError as err:
             logging.error(str(err))
             self.usage(args)
@@ -65,18 +71,22 @@ class Scanner3D(Tkinter.Tk):
             elif(o in ("-p", "--processing")):
                 self.directory = a
                 self.config = Config(os.path.join(a,'default.cfg'))
+            elif(o in ("-r", "--reduce")):
+                if(a not in ("1", "2", "4", "8")):
+                    logging.error("Invalid reduce factor")
+                    sys.exit(2)
+                self.reduce = int(a)
             elif(o in ("-a", "--arduino")):
                 self.arduino = Arduino(a)
             else:
                 assert False, "Unknown option"
 
     def toVoxelSpace(self, voxelSize=10):
-        space = VoxelSpace(voxelSize)
+        points = []
         for scene in (self.sceneRight, self.sceneLeft):
             for step in scene:
-                for point in step:
-                    space.addPoint(point)
-        return space
+                points += step
+        return toVoxelSpace(points, self.config, voxelSize)
 
     def meshDelaunay3D(self, filename):
         voxelspace = self.toVoxelSpace()
@@ -84,15 +94,29 @@ class Scanner3D(Tkinter.Tk):
         self.gui.popUpConfirm('Meshing', 'Meshing with delaunay3D finished')
 
     def meshBPA(self, filename):
-        meshBPA(self.toVoxelSpace().allPoints(), filename)
+        progress = lambda info: logging.info("[BPA] %s" % (info,))
+        meshBPA(self.toVoxelSpace().allPoints(), filename, progress=progress, decimation=decimation(self.config))
         self.gui.popUpConfirm('Meshing', 'Meshing with BPA finished')
 
+    def meshSliceGrid(self, filename):
+        # Points keep their scan origin, before any filtering
+        points = [list(scene) for scene in (self.sceneRight, self.sceneLeft)]
+        meshSliceGrid(points, filename, self.config.get('Mesher', 'maxedge', 20.0), decimation(self.config))
+        self.gui.popUpConfirm('Meshing', 'Meshing with the slice grid finished')
+
+    def meshTSDF(self, filename):
+        scenes = dict((scene.name, scene) for scene in (self.sceneRight, self.sceneLeft))
+        points = [list(scene) for scene in (self.sceneRight, self.sceneLeft)]
+        meshTSDF(points, lambda name, step: scenes[name].sensorPositions(step), filename,
+                 self.config.get('Mesher', 'tsdfvoxel', 2.0), decimation(self.config))
+        self.gui.popUpConfirm('Meshing', 'Meshing with TSDF fusion finished')
+
     def meshToObjFile(self, filename):
         space = self.toVoxelSpace()
         mesher = Mesher(space)
         try:
             mesher.run()
-            mesher.writeToObj(filename)
+            mesher.writeToObj(filename, decimation(self.config))
         except:
             logging.exception("\033[31mError during meshing of %s\033[0m" % (filename))
         self.gui.popUpConfirm('Meshing', 'Meshing finished')
@@ -103,83 +127,44 @@ class Scanner3D(Tkinter.Tk):
         mesher.writeToObj(filename)
 
     def loadConfig(self):
-        arduino = Arduino(self.config['Arduino']['port'],
-                          True if (self.directory == None) else False)
-
-        self.turntable = TurnTable(self.config['TurnTable']['position'],
-                                   self.config['TurnTable']['diameter'],
-                                   self.config['TurnTable']['steps'],
-                                   arduino)
-
-        self.camera = Camera(self.config['Camera']['port'],
-                        (self.config['Camera']['width'], self.config['Camera']['height']),
-                        self.config['Camera']['position'],
-                        self.config['Camera']['viewangle'],
-                        (self.config['File']['save'], self.config['File']['extension']),
-                        self.directory)
-
-        # Assume that Laser point to the center of the turntable
-        laserRight = Laser(self.config['LaserRight']['pin'], arduino)
-        self.sceneRight = Scene("right", self.camera, laserRight, self.turntable)
-
-        laserLeft = Laser(self.config['LaserLeft']['pin'], arduino)
-        self.sceneLeft  = Scene("left", self.camera, laserLeft,  self.turntable)    
-
-
-    def getCalibrationLimits(self, left, right):
-        dist = left[0][0] - right[0][0]
-        limit = left[0][1]
-
-        for idx in range(len(left)):
-            for offset in range(max(0,idx-20),min(len(right),idx+20)):
-                x_dist = right[offset][0]-left[idx][0]
-                if(x_dist >= 0):
-                    x_dist = np.sqrt(np.square(x_dist) + np.square(right[offset][1]-left[idx][1]))
-                    if(x_dist<=dist):
-                        dist = x_dist
-                        limit = min(right[offset][1],left[idx][1])
-        return (limit, limit+self.camera.shape[1]/10)
-
-    def getBetween(self, points, limits):
-        y = (points.T)[1]
-        return points[(limits[0]<y) & (y<limits[1])]
-
-    def linearRegression(self, points):
-        x,y = points.T
-        param = np.linalg.lstsq(np.vstack([x, np.ones(y.shape)]).T, y)[0]
-        return param
-
-    def interserctLines(self, line_1, line_2):
-        x = int(round((line_1[1]-line_2[1])/(line_2[0]-line_1[0]),0))
-        y = int(round(x*line_1[0]+line_1[1],0))
-        return x,y
+        if(self.camera != None):
+            self.camera.release()
+
+        # Pictures are encoded and saved in the background during the scan
+        writer = None
+        if(self.directory == None and len(self.config['File']['save']) > 0):
+            roi = self.config.get('File', 'roi', '')
+            writer = FrameWriter(self.config['File']['save'], self.config['File']['extension'],
+                                 int(self.config.get('File', 'writers', 2)),
+                                 compression=self.config.get('File', 'compression', 3),
+                                 roi=roi if(len(roi) == 4) else None)
+
+        self.turntable, self.camera, self.sceneLeft, self.sceneRight = loadScanner(
+            self.config, self.directory, self.reduce, writer)
+
+    def loadCalibration(self):
+        """ Load the saved calibration if a picture shows that the rig did not move since """
+        path = calibrationPath(self.config.configFile)
+        calibration = loadCalibration(path, self.config, self.camera)
+        if(calibration is None):
+            return False
+        self.turntable.arduino.batch(self.sceneLeft.laser.code(False), self.sceneRight.laser.code(False))
+        if(not validateCalibration(calibration, self.camera.getPicture("calibration_check", save=False))):
+            logging.warning("\033[93m The rig moved since the saved calibration.. \033[0m")
+            return False
+        applyCalibration(calibration, self.camera, self.sceneLeft, self.sceneRight)
+        logging.info('\033[94m Calibration loaded from %s\033[0m' % path)
+        return True
 
     def calibration(self):
+        if(self.directory == None and self.loadCalibration()):
+            return
         logging.info('\033[94m Start calibration (free the table)...\033[0m')
         self.gui.popUpConfirm('Calibration', 'Calibration : free the table and press OK...')
-        
-        left_line = self.sceneLeft.calibrateBackground()
-        right_line = self.sceneRight.calibrateBackground()
-
-        limits = self.getCalibrationLimits(left_line, right_line)
-        logging.debug("[CALIBRATION] y limits : %s" %(limits,))
-        left_line = self.getBetween(left_line, limits)
-        right_line = self.getBetween(right_line, limits)
-
-        left_line = self.linearRegression(left_line)
-        right_line = self.linearRegression(right_line)
-        logging.debug("[CALIBRATION] left line  : %.2f*x+%.2f" %(-left_line[0], left_line[1]))
-        logging.debug("[CALIBRATION] right line : %.2f*x+%.2f" %(-right_line[0], left_line[1]))
-
-        center = self.interserctLines(left_line, right_line)
-        logging.debug("[CALIBRATION] center @ %s" %(center,))
-
-        # Move zero to image center
-        center = (center[0] - self.camera.shape[0]/2.0, self.camera.shape[1]/2.0 - center[1])
-
-        self.camera.calibrate(self.turntable, center)
-        self.sceneLeft.calibrateLaser(center, -left_line[0])
-        self.sceneRight.calibrateLaser(center, -right_line[0])
+        center = calibrate(self.camera, self.turntable, self.sceneLeft, self.sceneRight)
+        if(self.directory == None):
+            saveCalibration(calibrationPath(self.config.configFile), self.config,
+                            self.camera, self.sceneLeft, self.sceneRight, center)
         logging.info('\033[94m Calibration done. (place your object on the table)\033[0m')
         self.gui.popUpConfirm('Calibration', 'Calibration : Place object and press OK...')
 
@@ -191,6 +176,54 @@ class Scanner3D(Tkinter.Tk):
             self.gui = Gui(self)
             self.gui.run()
 
+    def scheduleScan(self):
+        """
+        Build the scan as a graph of actions. Hardware actions (camera, lasers
+        and turntable) run in order, each step being: laser-off picture shared
+        by both scenes, left laser on, left picture, left off and right on in
+        one batch, right picture, right off and rotation in one batch.
+        Saving and processing of the pictures overlap the following actions.
+        """
+        scheduler = Scheduler()
+        arduino = self.turntable.arduino
+        scenes = (self.sceneLeft, self.sceneRight)
+        lastStep = self.turntable.nSteps-1
+        rotate = None
+        for step in range(self.turntable.nSteps):
+            def capture(name):
+                return lambda: self.camera.getPicture(name, save=False)
+
+            # Lasers are off after calibration and after each rotation
+            name = "%d_off" %(step)
+            imgOff = scheduler.add("capture off", capture(name),
+                                   [rotate] if rotate else [], 'camera', step)
+            scheduler.add("save off", lambda n=name, a=imgOff: self.camera.savePicture(n, a.result),
+                          [imgOff], None, step)
+
+            laserOn = scheduler.add("laser %s on" %(scenes[0].name),
+                                    lambda: arduino.batch(scenes[0].laser.code(True)),
+                                    [imgOff], 'arduino', step)
+            previous = laserOn
+            for index, scene in enumerate(scenes):
+                name = scene.pictureName(step)
+                imgOn = scheduler.add("capture %s" %(scene.name), capture(name), [previous], 'camera', step)
+                scheduler.add("save %s" %(scene.name), lambda n=name, a=imgOn: self.camera.savePicture(n, a.result),
+                              [imgOn], None, step)
+                # Pictures of a scene are fed in order
+                scheduler.add("feed %s" %(scene.name),
+                              lambda s=scene, a=imgOn, b=imgOff, i=step: s.feed(a.result, b.result, i, i == lastStep),
+                              [imgOn, imgOff], 'pipeline '+scene.name, step)
+                if(index < len(scenes)-1):
+                    nextScene = scenes[index+1]
+                    previous = scheduler.add("laser %s off, %s on" %(scene.name, nextScene.name),
+                                             lambda s=scene, n=nextScene: arduino.batch(s.laser.code(False), n.laser.code(True)),
+                                             [imgOn], 'arduino', step)
+                else:
+                    rotate = scheduler.add("laser %s off, rotate" %(scene.name),
+                                           lambda s=scene: arduino.batch(s.laser.code(False), *self.turntable.code()),
+                                           [imgOn], 'arduino', step)
+        return scheduler
+
     def startScan(self, startThread=True):
         if(not self.thread.isAlive()):
             self.loadConfig()
@@ -199,11 +232,10 @@ class Scanner3D(Tkinter.Tk):
             self.thread = threading.Thread(target=self.startScan, args=(False,))
             self.thread.start()
         elif(not startThread):
-            for step in range(self.turntable.nSteps):
-                self.sceneLeft.runStep(step, True if(step==self.turntable.nSteps-1) else False)
-                self.sceneRight.runStep(step, True if(step==self.turntable.nSteps-1) else False)
-                self.turntable.rotate()
-                logging.info('Step %d done', step+1)
+            scheduler = self.scheduleScan()
+            scheduler.run()
+            logging.info('Critical path per step :\n%s' % scheduler.report())
+            self.camera.release()
             self.arduino.powerOff()
 
             logging.info('\033[92m Scanning DONE \033[0m')
@@ -1,7 +1,7 @@
 import logging
 import serial
-import time
 import numpy as np
+from .protocol import SerialProtocol
 
 class Arduino:
     def __init__(self, port, isActive=True):
@@ -10,33 +10,45 @@ class Arduino:
         """
         logging.debug("Create Arduino @ port %s" % (port))
         self.isActive = isActive
+        self.protocol = None
         if(isActive):
             try:
-                self.serialPort = serial.Serial(port, 115200)
-                time.sleep(3)
-                self.command('P')
+                self.protocol = SerialProtocol(serial.Serial(port, 115200, timeout=0.1))
                 logging.debug("Handshaking with Arduino...")
+                if(not self.protocol.handshake()):
+                    logging.warning("\033[93m Arduino does not answer.. \033[0m")
             except:
                 logging.warning("\033[93m No arduino connected / bad serial port.. \033[0m")
 
-    def command(self, cmd):
-        #FIXME why arduino fails to response sometimes ?
-        response = ''
-        if(self.isActive):
-            try:
-                self.serialPort.write(cmd)
-                while(response == ''):
-                    response = self.serialPort.read(3)
-            except:
-                logging.exception("\033[93m Impossible to send the command to the arduino.. \033[0m")
+    def send(self, *cmds):
+        """ Send commands without waiting for their replies, return their Command objects """
+        if(self.protocol is None):
+            return []
+        try:
+            return self.protocol.send(*cmds)
+        except:
+            logging.exception("\033[93m Impossible to send the command to the arduino.. \033[0m")
+            return []
+
+    def wait(self, commands, timeout=None):
+        """ Wait for the replies of commands sent with send() """
+        return self.protocol.wait(commands, timeout) if commands else []
 
-        return response
+    def batch(self, *cmds):
+        """ Send commands in one write and wait for all their replies,
+            e.g. batch(laserLeft.code(False), laserRight.code(True), turntable.code(2)) """
+        return self.wait(self.send(*cmds))
+
+    def command(self, cmd):
+        responses = self.batch(cmd)
+        return responses[0] if responses and responses[0] is not None else ''
 
     def debugMode(self):
         cmd = raw_input('command : ')
         while(cmd not in ('q','quit','e','exit')):
-            response = self.command(cmd)
-            print("Response : %s" %response)
+            # One command per character, each echoed on its own line
+            responses = self.batch(*cmd)
+            print("Response : %s" %' '.join(r if r is not None else '-' for r in responses))
             cmd = raw_input('command : ')
 
 
@@ -65,13 +77,13 @@ class Laser:
         self.v1       = np.array([0,1,0], dtype=np.float32)
         self.v2       = np.array([-np.sin(self.yAngle), 0, np.cos(self.yAngle)], dtype=np.float32)
 
+    def code(self, switchOn):
+        """ Arduino command switching the laser """
+        return self.pin.upper() if switchOn else self.pin.lower()
+
     def switch(self, switchOn):
-        if(switchOn):
-            self.arduino.command(self.pin.upper())
-            logging.info('Switching laser on pin %s %s' %(self.pin, 'ON'))
-        else:
-            self.arduino.command(self.pin.lower())
-            logging.info('Switching laser on pin %s %s' %(self.pin, 'OFF'))
+        self.arduino.command(self.code(switchOn))
+        logging.info('Switching laser on pin %s %s' %(self.pin, 'ON' if switchOn else 'OFF'))
 
 
 class TurnTable:
@@ -98,6 +110,10 @@ class TurnTable:
                                     [-np.sin(angle), 0, np.cos(angle)]])
         return rotationMatrix
         
+    def code(self, step=1):
+        """ Arduino commands rotating the turntable of step steps """
+        return 'T'*step
+
     def rotate(self, step=1):
         logging.info('Rotating the turntable')
-        self.arduino.command('T')
+        self.arduino.batch(*self.code(step))
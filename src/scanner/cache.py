@@ -0,0 +1,86 @@
+import os
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+# Change it when the extraction or triangulation results change for the same inputs
+CACHE_VERSION = 3
+
+
+def digest(*values):
+    """ sha1 of arrays (content, shape and type) and of other values (repr) """
+    sha = hashlib.sha1(str(CACHE_VERSION))
+    for value in values:
+        if(isinstance(value, np.ndarray)):
+            sha.update("%s%s" % (value.dtype.str, value.shape))
+            sha.update(np.ascontiguousarray(value).data)
+        elif(isinstance(value, dict)):
+            for key in sorted(value):
+                sha.update(repr(key))
+                sha.update(digest(value[key]))
+        else:
+            sha.update(repr(value))
+    return sha.hexdigest()
+
+
+class StepCache:
+    def __init__(self, directory):
+        """ Create a new StepCache object, storing the results of scan steps
+            in npz files named after the hash of everything they depend on
+        directory = path where results are stored
+        """
+        self.directory = directory
+        # Kind -> [hits, misses], a step looks up several kinds
+        self.counts    = dict()
+        if(not os.path.exists(directory)):
+            os.makedirs(directory)
+
+    def path(self, kind, key):
+        return os.path.join(self.directory, "%s_%s.npz" % (kind, key))
+
+    def load(self, kind, key):
+        """ Return the dict of arrays stored for (kind, key), or None """
+        path = self.path(kind, key)
+        counts = self.counts.setdefault(kind, [0, 0])
+        if(not os.path.exists(path)):
+            counts[1] += 1
+            return None
+        try:
+            with np.load(path) as data:
+                result = dict((name, data[name]) for name in data.files)
+        except Exception:
+            logging.warning("Corrupted cache file %s" % path)
+            counts[1] += 1
+            return None
+        counts[0] += 1
+        return result
+
+    def report(self):
+        """ Hits and misses of each kind of result, as a string """
+        return ", ".join("%s %d hits / %d misses" % (kind, hits, misses)
+                         for kind, (hits, misses) in sorted(self.counts.items()))
+
+    def save(self, kind, key, **arrays):
+        # Write then rename, so that a file in the cache is always complete
+        handle, tmp = tempfile.mkstemp('.npz', dir=self.directory)
+        with os.fdopen(handle, 'wb') as output:
+            np.savez_compressed(output, **arrays)
+        os.rename(tmp, self.path(kind, key))
+
+
+def test_digest():
+    a = np.arange(6, dtype=np.uint8).reshape((2, 3))
+    assert digest(a, {'x': 1}) == digest(a.copy(), {'x': 1})
+    assert digest(a) != digest(a.reshape((3, 2)))
+    assert digest(a, {'x': 1}) != digest(a, {'x': 2})
+
+def test_cache(tmpdir):
+    cache = StepCache(str(tmpdir.join("cache")))
+    key = digest(np.zeros(3))
+    assert cache.load('pixels', key) is None
+    cache.save('pixels', key, pixels=np.ones((4, 2)))
+    assert np.array_equal(cache.load('pixels', key)['pixels'], np.ones((4, 2)))
+    assert cache.load('points', key) is None
+    assert cache.counts == {'pixels': [1, 1], 'points': [0, 1]}
+    assert cache.report() == "pixels 1 hits / 1 misses, points 0 hits / 1 misses"
@@ -0,0 +1,121 @@
+import os
+import logging
+import numpy as np
+import cv2
+from .cache import digest
+
+# Change it when the content of calibration files changes
+CALIBRATION_VERSION = 1
+
+# Config sections the calibration depends on
+SETUP_SECTIONS = ('Camera', 'TurnTable', 'LaserLeft', 'LaserRight')
+
+# Arrays of a calibration file (see saveCalibration)
+CALIBRATION_KEYS = ('version', 'setup', 'center', 'rotation', 'shape', 'leftPosition', 'leftAngle',
+                    'rightPosition', 'rightAngle', 'leftMask', 'rightMask', 'background')
+
+
+def calibrationPath(configFile):
+    """ Calibration file stored next to a config file """
+    return os.path.splitext(configFile)[0]+".calibration.npz"
+
+
+def setupDigest(config):
+    """ Hash of the config values the calibration depends on """
+    return digest(dict((section, config[section]) for section in SETUP_SECTIONS))
+
+
+def saveCalibration(path, config, camera, sceneLeft, sceneRight, center):
+    """ Save the calibration of the camera and the lasers, and the background it was made with """
+    np.savez_compressed(path,
+        version=CALIBRATION_VERSION, setup=setupDigest(config), center=np.array(center, dtype=float),
+        rotation=np.asarray(camera.rotationMatrix), shape=np.array(camera.shape, dtype=float),
+        leftPosition=sceneLeft.laser.position, leftAngle=sceneLeft.laser.yAngle,
+        rightPosition=sceneRight.laser.position, rightAngle=sceneRight.laser.yAngle,
+        leftMask=sceneLeft.imageProcessor.calibrationMask,
+        rightMask=sceneRight.imageProcessor.calibrationMask,
+        background=camera.getPicture("calibration_off"))
+    logging.info("Calibration saved in %s" % path)
+
+
+def loadCalibration(path, config, camera):
+    """ Return the dict of a calibration file, or None if it is missing or outdated """
+    if(not os.path.exists(path)):
+        return None
+    try:
+        with np.load(path) as data:
+            calibration = dict((name, data[name]) for name in data.files)
+    except Exception:
+        logging.warning("\033[93m Unreadable calibration file %s \033[0m" % path)
+        return None
+    missing = [key for key in CALIBRATION_KEYS if key not in calibration]
+    if(len(missing) > 0):
+        logging.info("Calibration file %s has an old version (no %s)" % (path, ", ".join(missing)))
+    elif(int(calibration['version']) != CALIBRATION_VERSION):
+        logging.info("Calibration file %s has an old version" % path)
+    elif(str(calibration['setup']) != setupDigest(config)):
+        logging.info("Setup changed since the calibration")
+    elif(tuple(calibration['shape']) != tuple(map(float, camera.shape))):
+        logging.info("Camera resolution changed since the calibration")
+    else:
+        return calibration
+    return None
+
+
+def applyCalibration(calibration, camera, sceneLeft, sceneRight):
+    camera.rotationMatrix = np.matrix(calibration['rotation'])
+    sceneLeft.laser.calibrate(calibration['leftPosition'], float(calibration['leftAngle']))
+    sceneRight.laser.calibrate(calibration['rightPosition'], float(calibration['rightAngle']))
+    sceneLeft.imageProcessor.calibrationMask = calibration['leftMask']
+    sceneRight.imageProcessor.calibrationMask = calibration['rightMask']
+
+
+def compareBackgrounds(background, frame, scale=4):
+    """
+    Return ((dx, dy), response): shift in pixels of frame relative to
+    background (phase correlation on grayscale pictures reduced scale times)
+    and the correlation peak, low when pictures do not match
+    """
+    images = []
+    for image in (background, frame):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        gray = cv2.resize(gray, None, fx=1.0/scale, fy=1.0/scale, interpolation=cv2.INTER_AREA)
+        images.append(np.float32(gray))
+    window = cv2.createHanningWindow(images[0].shape[::-1], cv2.CV_32F)
+    (dx, dy), response = cv2.phaseCorrelate(images[0], images[1], window)
+    return (dx*scale, dy*scale), response
+
+
+def validateCalibration(calibration, frame, maxShift=3.0, minResponse=0.2):
+    """
+    Return True if frame (lasers off) shows the rig where it was at the
+    calibration: an object on the table does not move the background
+    """
+    if(frame is None or frame.shape != calibration['background'].shape):
+        return False
+    (dx, dy), response = compareBackgrounds(calibration['background'], frame)
+    logging.info("Calibration check : shift (%.1f, %.1f) pixels, correlation %.2f" % (dx, dy, response))
+    return np.hypot(dx, dy) <= maxShift and response >= minResponse
+
+
+def test_compareBackgrounds():
+    rng = np.random.RandomState(0)
+    background = np.zeros((240, 320, 3), dtype=np.uint8)
+    for i in range(40):
+        x, y = rng.randint(0, 320), rng.randint(0, 240)
+        cv2.rectangle(background, (x, y), (x+rng.randint(10, 60), y+rng.randint(10, 60)),
+                      tuple(map(int, rng.randint(0, 255, 3))), -1)
+    calibration = {'background': background}
+    scene = background.copy()
+    cv2.circle(scene, (160, 120), 20, (255, 255, 255), -1)
+    assert validateCalibration(calibration, scene)
+    moved = np.roll(background, 12, axis=1)
+    (dx, dy), response = compareBackgrounds(background, moved)
+    assert abs(dx-12) < 2 and abs(dy) < 2
+    assert not validateCalibration(calibration, moved)
+    assert not validateCalibration(calibration, background[:100])
+
+def test_loadCalibration_incomplete(tmpdir):
+    path = str(tmpdir.join("setup.calibration.npz"))
+    np.savez_compressed(path, version=CALIBRATION_VERSION, center=np.zeros(2))
+    assert loadCalibration(path, None, None) is None
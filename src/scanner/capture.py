@@ -0,0 +1,206 @@
+import time
+import logging
+import threading
+from collections import deque
+import numpy as np
+import cv2
+
+# cv2.VideoCapture properties ids
+FRAME_WIDTH  = 3
+FRAME_HEIGHT = 4
+FRAME_FPS    = 5
+
+
+class SimulatedDevice:
+    def __init__(self, shape=(640, 480), fps=30.0, frames=None, queued=0):
+        """ Create a new SimulatedDevice object, a stand-in for cv2.VideoCapture
+        shape  = (W,H), frames shape Width x Heigth
+        fps    = frame rate of the device
+        frames = optional function (index, timestamp) -> frame, black frames by default,
+                 timestamp being the exposure time: one period before delivery
+        queued = number of frames waiting in the driver queue, returned at once
+        """
+        self.shape  = (int(shape[0]), int(shape[1]))
+        self.period = 1.0/fps
+        self.frames = frames
+        self.queued = queued
+        self.index  = 0
+        self.next   = time.time()
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        if(prop == FRAME_WIDTH):
+            self.shape = (int(value), self.shape[1])
+        elif(prop == FRAME_HEIGHT):
+            self.shape = (self.shape[0], int(value))
+        return True
+
+    def get(self, prop):
+        return 1.0/self.period if prop == FRAME_FPS else 0.0
+
+    def read(self):
+        # Frames are delivered at the device rate, like a real camera,
+        # after the ones taken before and still queued in the driver
+        if(self.queued > 0):
+            self.queued -= 1
+        else:
+            delay = self.next - time.time()
+            if(delay > 0):
+                time.sleep(delay)
+            self.next = max(self.next, time.time()) + self.period
+        self.index += 1
+        if(self.frames is not None):
+            frame = self.frames(self.index, time.time() - self.period)
+        else:
+            frame = np.zeros((self.shape[1], self.shape[0], 3), dtype=np.uint8)
+        return True, frame
+
+    def release(self):
+        self.opened = False
+
+
+class CaptureSession:
+    def __init__(self, device, shape=None, bufferSize=4, settleFrames=5, queuedDelay=0.002, latency=0.0):
+        """ Create a new CaptureSession object, keeping a camera open while a
+            grabber thread stores its latest frames in a ring buffer
+        device       = camera index, or an object with the cv2.VideoCapture interface
+        shape        = (W,H), requested resolution or None
+        bufferSize   = number of frames kept in the ring buffer
+        settleFrames = number of frames dropped at start (auto-exposure settling)
+        queuedDelay  = reads returning within this delay (seconds) give a frame
+                       queued by the driver, taken at an unknown time: dropped
+        latency      = delay (seconds) between the end of the exposure of a frame
+                       and its delivery, on top of the frame period
+        """
+        self.device  = cv2.VideoCapture(device) if isinstance(device, int) else device
+        self.frames  = deque(maxlen=bufferSize)
+        self.settleFrames = settleFrames
+        self.queuedDelay = queuedDelay
+        self.latency = latency
+        # Frame period, measured between delivered frames
+        self.intervals = deque(maxlen=9)
+        self.condition = threading.Condition()
+        self.thread  = None
+        self.running = False
+        if(shape is not None):
+            self.device.set(FRAME_WIDTH, shape[0])
+            self.device.set(FRAME_HEIGHT, shape[1])
+        fps = self.device.get(FRAME_FPS)
+        self.nominalPeriod = 1.0/fps if fps > 0 else 1.0/30
+
+    def start(self):
+        if(self.thread is None):
+            self.running = True
+            self.thread = threading.Thread(target=self.grab)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def period(self):
+        """ Median of the last intervals between frames, the device frame period until known """
+        with self.condition:
+            intervals = sorted(self.intervals)
+        return intervals[len(intervals)//2] if intervals else self.nominalPeriod
+
+    def grab(self):
+        dropped = 0
+        last = None
+        while(self.running):
+            # The driver queues frames: read() may return one taken long
+            # before. Only frames read() waited for are kept, stamped when
+            # they were delivered
+            start = time.time()
+            ok, frame = self.device.read()
+            timestamp = time.time()
+            if(not ok):
+                logging.error("impossible to get a picture from the camera..")
+                time.sleep(0.1)
+                continue
+            if(timestamp - start < self.queuedDelay):
+                last = None
+                continue
+            if(last is not None):
+                with self.condition:
+                    self.intervals.append(timestamp - last)
+            last = timestamp
+            if(dropped < self.settleFrames):
+                dropped += 1
+                continue
+            with self.condition:
+                self.frames.append((timestamp, frame))
+                self.condition.notify_all()
+
+    def getFrame(self, trigger=None, timeout=2.0):
+        """
+        Return (timestamp, frame) of the first frame exposed after trigger
+        (a time.time() value, default: now), or (None, None) after timeout
+        seconds. Frames are stamped at delivery: exposed one frame period
+        and the latency before
+        """
+        trigger = time.time() if trigger is None else trigger
+        trigger += self.period() + self.latency
+        limit = time.time() + timeout
+        with self.condition:
+            while(True):
+                for timestamp, frame in self.frames:
+                    if(timestamp >= trigger):
+                        return timestamp, frame
+                remaining = limit - time.time()
+                if(remaining <= 0 or not self.running):
+                    logging.error("No frame captured after trigger in %.1fs" % timeout)
+                    return None, None
+                self.condition.wait(remaining)
+
+    def stop(self):
+        self.running = False
+        if(self.thread is not None):
+            self.thread.join()
+            self.thread = None
+        self.device.release()
+
+
+def test_session_trigger():
+    session = CaptureSession(SimulatedDevice(fps=200.0, frames=lambda i, t: i), settleFrames=2)
+    session.start()
+    try:
+        first = session.getFrame()[1]
+        assert first >= 3
+        trigger = time.time()
+        timestamp, frame = session.getFrame(trigger)
+        assert timestamp >= trigger and frame > first
+    finally:
+        session.stop()
+    assert session.getFrame(time.time(), timeout=0.1) == (None, None)
+
+def test_session_queued():
+    # Frames 1 to 5 were queued before the session started: never returned
+    session = CaptureSession(SimulatedDevice(fps=100.0, frames=lambda i, t: i, queued=5), settleFrames=0)
+    session.start()
+    try:
+        assert session.getFrame(0)[1] > 5
+    finally:
+        session.stop()
+
+def test_session_exposure():
+    # The laser switches at the trigger: frames exposed before do not show it
+    device = SimulatedDevice(fps=50.0)
+    switch = [time.time() + 1e3]
+    device.frames = lambda i, t: t >= switch[0]
+    session = CaptureSession(device, settleFrames=2)
+    session.start()
+    try:
+        for i in range(5):
+            assert not session.getFrame()[1]
+            switch[0] = time.time()
+            assert session.getFrame(switch[0])[1]
+            switch[0] = time.time() + 1e3
+    finally:
+        session.stop()
+
+def test_simulated_shape():
+    device = SimulatedDevice(fps=1000.0)
+    device.set(FRAME_WIDTH, 32)
+    device.set(FRAME_HEIGHT, 16)
+    assert device.read()[1].shape == (16, 32, 3)
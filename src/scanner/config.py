@@ -22,6 +22,10 @@ class Config:
     def __getitem__(self, index):
         return self.config[index]
 
+    def get(self, section, option, default=None):
+        """ Return the value of an option, or default if the config file does not define it """
+        return self.config.get(section, dict()).get(option, default)
+
     def load(self, configFile=""):
         """ This method read the config file """
         if(configFile != ""):
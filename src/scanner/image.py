@@ -1,6 +1,75 @@
 import numpy as np
 import cv2
+import os
 import time
+import ctypes
+import operator
+from multiprocessing.pool import ThreadPool
+
+# Laser decision tables already built, by thresholds
+LUT_CACHE = dict()
+
+# PyDataMem_SetEventHook of the numpy C API (slot of its table, up to numpy 1.x)
+ALLOCATION_HOOK_SLOT = 291
+AllocationHook = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+SetAllocationHook = ctypes.CFUNCTYPE(ctypes.c_void_p, AllocationHook, ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p))
+
+
+def allocationHookSetter():
+    """ numpy PyDataMem_SetEventHook function, or None if this numpy has none """
+    api = getattr(np.core.multiarray, '_ARRAY_API', None)
+    try:
+        if(type(api).__name__ == 'PyCapsule'):
+            get, args = ctypes.pythonapi.PyCapsule_GetPointer, (api, None)
+            get.argtypes = [ctypes.py_object, ctypes.c_char_p]
+        else:
+            get, args = ctypes.pythonapi.PyCObject_AsVoidPtr, (api,)
+            get.argtypes = [ctypes.py_object]
+        get.restype = ctypes.c_void_p
+        table = ctypes.cast(get(*args), ctypes.POINTER(ctypes.c_void_p))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return SetAllocationHook(table[ALLOCATION_HOOK_SLOT]) if table[ALLOCATION_HOOK_SLOT] else None
+
+
+class AllocationCounter:
+    def __init__(self):
+        """ Create a new AllocationCounter object, counting the data of the
+            arrays numpy allocates (the results of OpenCV too) in a with block
+        """
+        self.setter = allocationHookSetter()
+        self.hook   = AllocationHook(self.record)
+        self.count  = 0
+        self.bytes  = 0
+        self.live   = 0
+        self.peak   = 0
+        self.sizes  = dict()
+        self.previous = None
+
+    def available(self):
+        return self.setter is not None
+
+    def record(self, old, new, size, data):
+        # Allocation (old NULL), reallocation or free (new NULL)
+        if(old):
+            self.live -= self.sizes.pop(old, 0)
+        if(new and size):
+            self.count += 1
+            self.bytes += size
+            self.sizes[new] = size
+            self.live += size
+            self.peak = max(self.peak, self.live)
+
+    def __enter__(self):
+        if(self.setter is not None):
+            self.previous = (self.setter(self.hook, None, ctypes.byref(ctypes.c_void_p())), ctypes.c_void_p())
+        return self
+
+    def __exit__(self, *exception):
+        if(self.setter is not None):
+            hook, data = self.previous
+            self.setter(ctypes.cast(hook, AllocationHook) if hook else AllocationHook(), data, ctypes.byref(ctypes.c_void_p()))
+        return False
 
 
 class ImageProcessor:
@@ -8,6 +77,30 @@ class ImageProcessor:
         """ Create a new ImageProcessor object
         """
         self.calibrationMask = None
+        self.redThreshold    = 20
+        self.gbThreshold     = 5
+        self.luminosity      = 20
+        self.useLUT          = True
+        self.buffers         = dict()
+        self.allocated       = 0
+        self.columnsShape    = None
+        self.coarseMask      = (None, None, None)
+        self.bands           = 1
+        self.workers         = (None, None, [])
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        """ Work buffer called name, allocated again only when a larger one is needed """
+        size = reduce(operator.mul, shape, np.dtype(dtype).itemsize)
+        memory = self.buffers.get(name)
+        if(memory is None or memory.nbytes < size):
+            memory = np.empty(size, dtype=np.uint8)
+            self.buffers[name] = memory
+            self.allocated += size
+        return memory[:size].view(dtype).reshape(shape)
+
+    def parameters(self):
+        """ Settings the laser pixels depend on, besides the pictures """
+        return {'red': self.redThreshold, 'greenblue': self.gbThreshold, 'luminosity': self.luminosity, 'bands': self.bands}
 
     def setCalibrationMask(self, foreground, background):
         mask = self.getLaserMask(foreground, background)
@@ -37,24 +130,347 @@ class ImageProcessor:
         mask = cv2.bitwise_or(cv2.inRange(image, lower, upper), mask)
         return mask
 
+    def getLUT(self):
+        """
+        Decision of getRGBmask and getHSVmask for all the 256**3 BGR colors,
+        as bits (index b<<16 | g<<8 | r), built once for each set of thresholds
+        """
+        key = (self.redThreshold, self.gbThreshold, self.luminosity)
+        if(key not in LUT_CACHE):
+            colors = np.arange(1 << 24, dtype=np.uint32)
+            image = np.dstack(((colors >> 16) & 255, (colors >> 8) & 255, colors & 255)).astype(np.uint8).reshape((4096, 4096, 3))
+            mask = cv2.bitwise_or(self.getRGBmask(image, self.redThreshold, self.gbThreshold),
+                                  self.getHSVmask(image, self.luminosity))
+            LUT_CACHE[key] = np.packbits(mask.ravel() != 0)
+        return LUT_CACHE[key]
+
+    def minimumValue(self):
+        """ Below this value on all channels, no mask selects a color (see getHSVmask) """
+        return min(self.redThreshold, self.luminosity, 200)
+
+    def classify(self, imageDiff):
+        """ Mask of the laser colored pixels of a difference of pictures """
+        if(not self.useLUT):
+            return cv2.bitwise_or(self.getRGBmask(imageDiff, self.redThreshold, self.gbThreshold),
+                                  self.getHSVmask(imageDiff, self.luminosity))
+        lut = self.getLUT()
+        shape = imageDiff.shape[:2]
+        b, g, r = [cv2.extractChannel(imageDiff, i, dst=self.buffer(name, shape)) for i, name in enumerate('bgr')]
+        # Most of a difference of pictures is dark: only look up the others
+        peak = cv2.max(cv2.max(b, g, dst=self.buffer('peak', shape)), r, dst=self.buffer('peak', shape))
+        candidates = np.flatnonzero(np.greater_equal(peak, self.minimumValue(), out=self.buffer('candidates', shape, np.bool_)))
+        index = (b.ravel()[candidates].astype(np.uint32) << 16) | (g.ravel()[candidates].astype(np.uint32) << 8) | r.ravel()[candidates]
+        mask = self.buffer('classified', shape)
+        mask.fill(0)
+        mask.ravel()[candidates] = ((lut[index >> 3] >> (7 - (index & 7))) & 1)*255
+        return mask
+
     def getLaserMask(self, foreground, background):
-        imageDiff = np.array(foreground, dtype=np.int16) - np.array(background, dtype=np.int16)
-        imageDiff = np.array(imageDiff.clip(0, 255), dtype=np.uint8)
-        imageDiff = cv2.medianBlur(imageDiff,3)
-        mask = cv2.bitwise_or(self.getRGBmask(imageDiff), self.getHSVmask(imageDiff))
-        mask = cv2.GaussianBlur(mask,(3,3),0)
-        return cv2.inRange(mask, np.array([250]), np.array([255]))
-        
+        """ Mask of the laser line, in a work buffer (overwritten by the next call) """
+        shape = foreground.shape[:2]
+        # Saturated subtraction, negative differences are 0
+        imageDiff = cv2.subtract(foreground, background, dst=self.buffer('diff', foreground.shape))
+        imageDiff = cv2.medianBlur(imageDiff, 3, dst=self.buffer('median', foreground.shape))
+        mask = self.classify(imageDiff)
+        mask = cv2.GaussianBlur(mask, (3,3), 0, dst=self.buffer('gaussian', shape))
+        return cv2.inRange(mask, np.array([250]), np.array([255]), dst=self.buffer('laser', shape))
+
     def massCenter(self, image):
-        points = []
-        for line in range(image.shape[0]):
-            moments = cv2.moments(image[line,:,2])
-            if(moments['m00'] != 0):
-                points.append([round(moments['m01']/moments['m00']), line])
-        return np.array(points)
-
-    def extractPoints(self, imgLaserOn, imgLaserOff):
-        mask = cv2.bitwise_and(self.getLaserMask(imgLaserOn, imgLaserOff), self.calibrationMask)
-        res = cv2.bitwise_and(imgLaserOn, imgLaserOn, mask=mask)
-        res = self.massCenter(res)
+        return self.rowsMassCenter(np.ascontiguousarray(image[:,:,2]))
+
+    def rowsMassCenter(self, channel):
+        """ Return [x, line] of the mass center of each line of channel with a non zero mass """
+        height, width = channel.shape
+        # x coordinate of each pixel, computed only when the shape changes
+        columns = self.buffer('columns', (height, width), np.float32)
+        if(self.columnsShape != (height, width)):
+            columns[:] = np.arange(width)
+            self.columnsShape = (height, width)
+        # Products (< 2**24) are exact in float32, their sums in float64
+        weighted = cv2.multiply(channel, columns, dst=self.buffer('weighted', (height, width), np.float32), dtype=cv2.CV_32F)
+        m01 = cv2.reduce(weighted, 1, cv2.REDUCE_SUM, dst=self.buffer('m01', (height, 1), np.float64), dtype=cv2.CV_64F)[:, 0]
+        m00 = cv2.reduce(channel, 1, cv2.REDUCE_SUM, dst=self.buffer('m00', (height, 1), np.float64), dtype=cv2.CV_64F)[:, 0]
+        lines = np.flatnonzero(m00)
+        # Sums of integers are exact: same values as cv2.moments, rounded like round()
+        return np.column_stack((np.floor(m01[lines]/m00[lines]+0.5), lines)).astype(float)
+
+    def measureMemory(self, imgLaserOn, imgLaserOff, region=None, frames=4):
+        """
+        Return (once, perFrame, arrays, peak) : bytes of the work buffers,
+        bytes and number of the arrays allocated by each extractPoints call
+        on the pictures once the buffers exist, and the peak of these arrays
+        alive together (perFrame, arrays and peak are None if numpy cannot
+        count its allocations)
+        """
+        self.extractPoints(imgLaserOn, imgLaserOff, region)
+        counter = AllocationCounter()
+        if(not counter.available()):
+            return self.allocated, None, None, None
+        with counter:
+            for frame in range(frames):
+                self.extractPoints(imgLaserOn, imgLaserOff, region)
+        return self.allocated, counter.bytes//frames, counter.count//frames, counter.peak
+
+    def memoryReport(self, imgLaserOn, imgLaserOff, region=None):
+        """ measureMemory of pictures as a string """
+        once, perFrame, arrays, peak = self.measureMemory(imgLaserOn, imgLaserOff, region)
+        if(perFrame is None):
+            return "Work buffers : %.1f MB allocated once (allocations per frame not measurable)" % (once/1e6)
+        return ("Work buffers : %.1f MB allocated once, per frame : %.2f MB in %d arrays (%.2f MB at most at once)"
+                % (once/1e6, perFrame/1e6, arrays, peak/1e6))
+
+    def extractPoints(self, imgLaserOn, imgLaserOff, region=None):
+        """ Return the (x, y) pixels of the laser line, one per line of the pictures
+            region = (x, y, w, h) part of the pictures to process, or None for all
+        """
+        if(self.bands > 1 and (region[3] if region is not None else imgLaserOn.shape[0]) >= 64*self.bands):
+            return self.extractParallel(imgLaserOn, imgLaserOff, region)
+        calibrationMask = self.calibrationMask
+        if(region is not None):
+            x, y, w, h = region
+            imgLaserOn = imgLaserOn[y:y+h, x:x+w]
+            imgLaserOff = imgLaserOff[y:y+h, x:x+w]
+            calibrationMask = calibrationMask[y:y+h, x:x+w]
+        shape = imgLaserOn.shape[:2]
+        mask = cv2.bitwise_and(self.getLaserMask(imgLaserOn, imgLaserOff), calibrationMask, dst=self.buffer('mask', shape))
+        # Only the red channel is used: masked by a 0/255 mask with a bitwise and
+        red = cv2.extractChannel(imgLaserOn, 2, dst=self.buffer('red', shape))
+        res = self.rowsMassCenter(cv2.bitwise_and(red, mask, dst=red))
+        if(region is not None and len(res)):
+            res += (x, y)
         return res
+
+    def extractBand(self, imgLaserOn, imgLaserOff, region, margin=2, bounds=None):
+        """
+        Return (points, pixels) : laser pixels of the lines of region, and the
+        number of pixels processed. Region is processed with a margin, within
+        bounds (x, y, w, h), the whole pictures if None, so that the blurs
+        give the same result as on bounds
+        """
+        x, y, w, h = region
+        height, width = imgLaserOn.shape[:2]
+        left, top, right, bottom = (bounds[0], bounds[1], bounds[0]+bounds[2], bounds[1]+bounds[3]) if bounds is not None else (0, 0, width, height)
+        x0, y0 = max(x-margin, left), max(y-margin, top)
+        x1, y1 = min(x+w+margin, right), min(y+h+margin, bottom)
+        points = self.extractPoints(imgLaserOn, imgLaserOff, (x0, y0, x1-x0, y1-y0))
+        if(len(points)):
+            points = points[(points[:, 1] >= y) & (points[:, 1] < y+h) & (points[:, 0] >= x) & (points[:, 0] < x+w)]
+        return points, (x1-x0)*(y1-y0)
+
+    def getWorkers(self):
+        """ (thread pool, ImageProcessor of each thread) processing the bands of the pictures """
+        # Threads do not survive a fork: the pipeline processes create their own pool
+        pid, pool, workers = self.workers
+        if(pid != os.getpid() or len(workers) != self.bands):
+            pool, workers = ThreadPool(self.bands), [ImageProcessor() for band in range(self.bands)]
+            self.workers = (os.getpid(), pool, workers)
+        for worker in workers:
+            worker.calibrationMask = self.calibrationMask
+            worker.redThreshold, worker.gbThreshold, worker.luminosity = self.redThreshold, self.gbThreshold, self.luminosity
+            worker.useLUT = self.useLUT
+        return pool, workers
+
+    def extractParallel(self, imgLaserOn, imgLaserOff, region=None):
+        """ extractPoints on self.bands horizontal bands of the pictures processed by threads """
+        height, width = imgLaserOn.shape[:2]
+        x, y, w, h = region if region is not None else (0, 0, width, height)
+        pool, workers = self.getWorkers()
+        if(self.useLUT):
+            # Built once, before the threads need it
+            self.getLUT()
+        limits = np.linspace(y, y+h, self.bands+1).astype(int)
+        # OpenCV releases the GIL, the lines of a band do not depend on the others
+        # (their margins stay in the region, as for a single extractPoints)
+        bands = pool.map(lambda (worker, y0, y1): worker.extractBand(imgLaserOn, imgLaserOff, (x, y0, w, y1-y0), bounds=(x, y, w, h))[0],
+                         zip(workers, limits[:-1], limits[1:]))
+        bands = [band for band in bands if len(band)]
+        return np.vstack(bands) if len(bands) else np.zeros((0, 2))
+
+    def extractTracked(self, imgLaserOn, imgLaserOff, previous, window=8, region=None, block=16, fallback=True):
+        """
+        Return (points, pixels) : laser pixels searched within window columns
+        around the previous ones (x, y), on whole lines (of region) where
+        the line was not found (if fallback), and the number of pixels processed
+        """
+        height, width = imgLaserOn.shape[:2]
+        x, y, w, h = region if region is not None else (0, 0, width, height)
+        previousX = np.full(h, -1, dtype=int)
+        if(len(previous)):
+            lines = previous[:, 1].astype(int)-y
+            inside = (lines >= 0) & (lines < h)
+            previousX[lines[inside]] = previous[inside, 0]
+
+        points, pixels = [], 0
+        found = np.zeros(h, dtype=bool)
+        # Lines of a block are searched in the union of their windows
+        for start in range(0, h, block):
+            xs = previousX[start:start+block]
+            xs = xs[xs >= 0]
+            if(len(xs) == 0):
+                continue
+            left, right = max(x, xs.min()-window), min(x+w, xs.max()+window+1)
+            band, n = self.extractBand(imgLaserOn, imgLaserOff, (left, y+start, right-left, min(block, h-start)))
+            pixels += n
+            if(len(band)):
+                points.append(band)
+                found[band[:, 1].astype(int)-y] = True
+
+        # Lost lines are searched entirely, by runs of consecutive lines
+        lost = np.flatnonzero(~found) if fallback else []
+        for run in np.split(lost, np.flatnonzero(np.diff(lost) > 1)+1) if len(lost) else []:
+            band, n = self.extractBand(imgLaserOn, imgLaserOff, (x, y+run[0], w, len(run)))
+            pixels += n
+            if(len(band)):
+                points.append(band)
+
+        if(len(points) == 0):
+            return np.zeros((0, 2)), pixels
+        points = np.vstack(points)
+        return points[np.argsort(points[:, 1], kind='mergesort')], pixels
+
+    def coarseLine(self, imgLaserOn, imgLaserOff, region, scale):
+        """
+        Return the (x, y) laser pixels found on the pictures of region reduced
+        scale times, one per reduced line, in full resolution coordinates.
+        The line is too thin there for the blurs of getLaserMask: only the
+        colors of the difference are checked
+        """
+        x, y, w, h = region
+        size = (w//scale, h//scale)
+        if(size[0] == 0 or size[1] == 0):
+            return np.zeros((0, 2))
+        shape = (size[1], size[0])
+        x1, y1 = x+size[0]*scale, y+size[1]*scale
+        imageDiff = cv2.subtract(imgLaserOn[y:y1, x:x1], imgLaserOff[y:y1, x:x1], dst=self.buffer('diff', (y1-y, x1-x, 3)))
+        imageDiff = cv2.resize(imageDiff, size, dst=self.buffer('coarseDiff', shape+(3,)), interpolation=cv2.INTER_AREA)
+        mask = self.classify(imageDiff)
+        # Reduced blocks partly in the calibration mask are kept, the full resolution pass checks them
+        # The cache holds the mask itself: a new mask can not be mistaken for it by its id
+        cachedMask, key, coarse = self.coarseMask
+        if(cachedMask is not self.calibrationMask or key != (region, scale)):
+            calibration = cv2.resize(self.calibrationMask[y:y1, x:x1], size, interpolation=cv2.INTER_AREA)
+            coarse = cv2.compare(calibration, 0, cv2.CMP_GT)
+            self.coarseMask = (self.calibrationMask, (region, scale), coarse)
+        mask = cv2.bitwise_and(mask, coarse, dst=mask)
+        red = cv2.extractChannel(imageDiff, 2, dst=self.buffer('coarseRed', shape))
+        points = self.rowsMassCenter(cv2.bitwise_and(red, mask, dst=red))
+        return points*scale + ((scale-1)/2.0 + x, y)
+
+    def extractPyramid(self, imgLaserOn, imgLaserOff, region=None, levels=1, window=None, block=64):
+        """
+        Return (points, pixels) : laser pixels found on the pictures reduced
+        2**levels times, then refined at full resolution within window columns
+        around them (see extractTracked), and the number of pixels processed
+        """
+        height, width = imgLaserOn.shape[:2]
+        region = region if region is not None else (0, 0, width, height)
+        scale = 2**levels
+        coarse = self.coarseLine(imgLaserOn, imgLaserOff, region, scale)
+        # Each reduced line gives the search window of scale full resolution lines
+        previous = np.repeat(coarse, scale, axis=0)
+        previous[:, 1] += np.tile(np.arange(scale), len(coarse))
+        window = window if window is not None else 2*scale
+        points, pixels = self.extractTracked(imgLaserOn, imgLaserOff, previous, window, region, block, fallback=False)
+        return points, pixels + (region[2]//scale)*(region[3]//scale)
+
+
+def compareLines(points, reference, tolerance=1.0):
+    """
+    Return True if points (x, y) match reference : on at least 99% of the
+    lines of either one, both have a point and their x differ by tolerance at most
+    """
+    lines = dict((int(y), x) for x, y in points)
+    matching = sum(1 for x, y in reference if int(y) in lines and abs(lines[int(y)]-x) <= tolerance)
+    return matching >= 0.99*max(len(points), len(reference))
+
+
+def test_extractPoints_region():
+    processor = ImageProcessor()
+    processor.calibrationMask = np.full((120, 160), 255, dtype=np.uint8)
+    imgLaserOff = np.zeros((120, 160, 3), dtype=np.uint8)
+    imgLaserOn = imgLaserOff.copy()
+    cv2.line(imgLaserOn, (70, 20), (80, 100), (0, 0, 255), 3)
+    full = processor.extractPoints(imgLaserOn, imgLaserOff)
+    assert len(full) > 0
+    assert np.array_equal(processor.extractPoints(imgLaserOn, imgLaserOff, (40, 10, 80, 100)), full)
+
+def test_classify_lut():
+    processor = ImageProcessor()
+    imageDiff = np.random.RandomState(0).randint(0, 256, (200, 300, 3)).astype(np.uint8)
+    imageDiff[:100] //= 8
+    processor.useLUT = False
+    expected = processor.classify(imageDiff)
+    processor.useLUT = True
+    assert np.array_equal(processor.classify(imageDiff), expected)
+    # Thresholds changes give a new table
+    processor.redThreshold = 60
+    processor.useLUT = False
+    expected = processor.classify(imageDiff)
+    processor.useLUT = True
+    assert np.array_equal(processor.classify(imageDiff), expected)
+
+def test_buffers():
+    processor = ImageProcessor()
+    processor.calibrationMask = np.full((120, 160), 255, dtype=np.uint8)
+    imgLaserOff = np.random.RandomState(0).randint(0, 50, (120, 160, 3)).astype(np.uint8)
+    imgLaserOn = imgLaserOff.copy()
+    cv2.line(imgLaserOn, (70, 20), (80, 100), (0, 0, 255), 3)
+    first = processor.extractPoints(imgLaserOn, imgLaserOff)
+    allocated = processor.allocated
+    assert np.array_equal(processor.extractPoints(imgLaserOn, imgLaserOff), first)
+    assert processor.allocated == allocated
+    once, perFrame, arrays, peak = processor.measureMemory(imgLaserOn, imgLaserOff)
+    assert once == allocated
+    # Only the laser pixels and per line results are left, no full frame
+    assert 0 < peak <= perFrame and peak < 120*160
+    # Same pixels as cv2.moments line by line
+    expected = [[round(cv2.moments(line)['m01']/cv2.moments(line)['m00']), y]
+                for y, line in enumerate(imgLaserOn[:, :, 2]) if line.any()]
+    assert np.array_equal(processor.rowsMassCenter(np.ascontiguousarray(imgLaserOn[:, :, 2])), expected)
+
+def test_extractTracked():
+    processor = ImageProcessor()
+    processor.calibrationMask = np.full((120, 160), 255, dtype=np.uint8)
+    imgLaserOff = np.random.RandomState(0).randint(0, 50, (120, 160, 3)).astype(np.uint8)
+    imgLaserOn = imgLaserOff.copy()
+    cv2.line(imgLaserOn, (70, 20), (80, 100), (0, 0, 255), 3)
+    full = processor.extractPoints(imgLaserOn, imgLaserOff)
+    # Line moved by 3 pixels since the previous step, and lost on its top
+    previous = full[full[:, 1] > 40] - (3, 0)
+    points, pixels = processor.extractTracked(imgLaserOn, imgLaserOff, previous, window=6)
+    assert np.array_equal(points, full)
+    assert pixels < 120*160
+
+def test_extractPyramid():
+    processor = ImageProcessor()
+    processor.calibrationMask = np.full((240, 320), 255, dtype=np.uint8)
+    imgLaserOff = np.random.RandomState(0).randint(0, 50, (240, 320, 3)).astype(np.uint8)
+    imgLaserOn = imgLaserOff.copy()
+    cv2.line(imgLaserOn, (140, 20), (190, 220), (0, 0, 255), 3)
+    full = processor.extractPoints(imgLaserOn, imgLaserOff)
+    for levels in (1, 2):
+        points, pixels = processor.extractPyramid(imgLaserOn, imgLaserOff, levels=levels)
+        assert compareLines(points, full, tolerance=0.0)
+        assert pixels < 240*320/2
+    assert not compareLines(full + (2, 0), full)
+    # A new calibration mask replaces the cached reduced one
+    processor.calibrationMask = np.zeros((240, 320), dtype=np.uint8)
+    processor.calibrationMask[120:] = 255
+    points, pixels = processor.extractPyramid(imgLaserOn, imgLaserOff)
+    assert len(points) and points[:, 1].min() >= 118
+
+def test_extractParallel():
+    processor = ImageProcessor()
+    processor.calibrationMask = np.full((480, 320), 255, dtype=np.uint8)
+    imgLaserOff = np.random.RandomState(0).randint(0, 50, (480, 320, 3)).astype(np.uint8)
+    imgLaserOn = imgLaserOff.copy()
+    cv2.line(imgLaserOn, (140, 20), (190, 460), (0, 0, 255), 3)
+    expected = processor.extractPoints(imgLaserOn, imgLaserOff)
+    processor.bands = 4
+    assert np.array_equal(processor.extractPoints(imgLaserOn, imgLaserOff), expected)
+    assert np.array_equal(processor.extractPoints(imgLaserOn, imgLaserOff, (100, 0, 120, 480)), expected)
+    # The line crosses the edges of this region: the blurs stop there too
+    processor.bands = 1
+    expected = processor.extractPoints(imgLaserOn, imgLaserOff, (150, 100, 40, 300))
+    processor.bands = 4
+    assert np.array_equal(processor.extractPoints(imgLaserOn, imgLaserOff, (150, 100, 40, 300)), expected)
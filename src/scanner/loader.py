@@ -0,0 +1,80 @@
+import os
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from .writer import readFrame
+
+
+def frameOrder(name):
+    """ Sort key of a frame name: calibration frames first, then by step """
+    match = re.match(r'(\d+)_(.*)', name)
+    if(match is None):
+        return (0, 0, name)
+    return (1, int(match.group(1)), match.group(2))
+
+
+class FrameLoader:
+    def __init__(self, directory, extension, shape=None, roi=None, workers=4, lookahead=8, reduce=1):
+        """ Create a new FrameLoader object, decoding the frames of a scan
+            directory ahead of their use in a pool of threads
+        directory = path to the directory of frames
+        extension = extension of the frames
+        shape     = (W,H), full frame shape (for frames saved with a roi)
+        roi       = (x, y, w, h) the frames were cropped to, or None
+        workers   = number of decoding threads
+        lookahead = number of frames decoded ahead of the last requested one
+        reduce    = 1, 2, 4 or 8, decode at a reduced resolution for previews
+        """
+        self.directory = directory
+        self.extension = extension
+        self.shape     = shape
+        self.roi       = roi
+        self.lookahead = lookahead
+        self.reduce    = reduce
+        self.names     = sorted([f[:-len(extension)] for f in os.listdir(directory) if f.endswith(extension)],
+                                key=frameOrder)
+        self.index     = dict((name, i) for i, name in enumerate(self.names))
+        self.pending   = dict()
+        self.submitted = 0
+        self.lock      = threading.Lock()
+        self.pool      = ThreadPool(workers)
+
+    def read(self, name):
+        return readFrame(os.path.join(self.directory, name+self.extension), self.shape, self.roi, self.reduce)
+
+    def getFrame(self, name):
+        """ Return the frame called name (None if it does not exist) """
+        with self.lock:
+            current = self.index.get(name)
+            if(current is not None):
+                # Forget frames far behind, decode the next ones
+                for i in [i for i in self.pending if i < current-self.lookahead]:
+                    del self.pending[i]
+                self.submitted = max(self.submitted, current-self.lookahead)
+                while(self.submitted < min(current+self.lookahead+1, len(self.names))):
+                    self.pending[self.submitted] = self.pool.apply_async(self.read, (self.names[self.submitted],))
+                    self.submitted += 1
+                result = self.pending.get(current)
+        if(current is None or result is None):
+            return self.read(name)
+        return result.get()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def test_loader(tmpdir):
+    names = ["calibration_left", "calibration_off"]+["%d_%s" % (s, n) for s in range(12) for n in ("left", "off")]
+    for i, name in enumerate(names):
+        np.save(str(tmpdir.join(name+".npy")), np.full((8, 8, 3), i, dtype=np.uint8))
+    loader = FrameLoader(str(tmpdir), ".npy", lookahead=3)
+    assert loader.names == names
+    for i, name in enumerate(names):
+        assert loader.getFrame(name)[0, 0, 0] == i
+        assert len(loader.pending) <= 7
+    assert loader.getFrame("0_off")[0, 0, 0] == 3
+    assert loader.getFrame("missing") is None
+    assert FrameLoader(str(tmpdir), ".npy", reduce=2).getFrame("3_left").shape == (4, 4, 3)
+    loader.close()
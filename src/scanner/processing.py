@@ -0,0 +1,247 @@
+import os
+import time
+import logging
+import traceback
+import multiprocessing
+import numpy as np
+from .config import Config
+from .scene import Camera, Scene
+from .arduino import Arduino, TurnTable, Laser
+from .cache import StepCache
+from mesher.voxel import VoxelSpace, pointsToArrays
+from mesher.filters import removeOutliers
+from mesher.rangeimage import smoothPoints
+from mesher.meshfile import writePly
+
+
+def loadScanner(config, directory=None, reduce=1, writer=None):
+    """
+    Create the scanner objects described by a Config object
+    directory = path to the pictures to process, or None to use the scanner.
+                Results of the steps are cached in its [File] cache subdirectory
+    reduce    = process pictures at a reduced resolution (see Camera)
+    writer    = FrameWriter saving the pictures (see Camera)
+    Return (turntable, camera, sceneLeft, sceneRight)
+    """
+    arduino = Arduino(config['Arduino']['port'],
+                      True if (directory == None) else False)
+
+    turntable = TurnTable(config['TurnTable']['position'],
+                          config['TurnTable']['diameter'],
+                          config['TurnTable']['steps'],
+                          arduino)
+
+    roi = config.get('File', 'roi', '')
+    roi = roi if(len(roi) == 4) else None
+    camera = Camera(config['Camera']['port'],
+                    (config['Camera']['width'], config['Camera']['height']),
+                    config['Camera']['position'],
+                    config['Camera']['viewangle'],
+                    (config['File']['save'], config['File']['extension']),
+                    directory, writer, roi, reduce,
+                    config.get('Camera', 'distortion'),
+                    config.get('Camera', 'latency', 0.0))
+
+    # New pictures are never seen twice, archived ones are reprocessed
+    cache = None
+    if(directory != None and len(config.get('File', 'cache', 'cache')) > 0):
+        cache = StepCache(os.path.join(directory, config.get('File', 'cache', 'cache')))
+
+    # Assume that Laser point to the center of the turntable
+    detection = (config.get('Processing', 'tracking', 0),
+                 config.get('Processing', 'pyramid', 0),
+                 config.get('Processing', 'tolerance', 1.0))
+    sceneRight = Scene("right", camera, Laser(config['LaserRight']['pin'], arduino), turntable, cache, *detection)
+    sceneLeft  = Scene("left", camera, Laser(config['LaserLeft']['pin'], arduino), turntable, cache, *detection)
+    for scene in (sceneLeft, sceneRight):
+        scene.imageProcessor.bands = int(config.get('Processing', 'bands', 1))
+    return turntable, camera, sceneLeft, sceneRight
+
+
+def getCalibrationLimits(left, right, height):
+    dist = left[0][0] - right[0][0]
+    limit = left[0][1]
+
+    for idx in range(len(left)):
+        for offset in range(max(0,idx-20),min(len(right),idx+20)):
+            x_dist = right[offset][0]-left[idx][0]
+            if(x_dist >= 0):
+                x_dist = np.sqrt(np.square(x_dist) + np.square(right[offset][1]-left[idx][1]))
+                if(x_dist<=dist):
+                    dist = x_dist
+                    limit = min(right[offset][1],left[idx][1])
+    return (limit, limit+height/10)
+
+def getBetween(points, limits):
+    y = (points.T)[1]
+    return points[(limits[0]<y) & (y<limits[1])]
+
+def linearRegression(points):
+    x,y = points.T
+    param = np.linalg.lstsq(np.vstack([x, np.ones(y.shape)]).T, y)[0]
+    return param
+
+def interserctLines(line_1, line_2):
+    x = int(round((line_1[1]-line_2[1])/(line_2[0]-line_1[0]),0))
+    y = int(round(x*line_1[0]+line_1[1],0))
+    return x,y
+
+def calibrate(camera, turntable, sceneLeft, sceneRight):
+    """ Calibrate the camera and the lasers from the pictures of the free table, return the turntable center """
+    left_line = sceneLeft.calibrateBackground()
+    right_line = sceneRight.calibrateBackground()
+
+    limits = getCalibrationLimits(left_line, right_line, camera.shape[1])
+    logging.debug("[CALIBRATION] y limits : %s" %(limits,))
+    left_line = getBetween(left_line, limits)
+    right_line = getBetween(right_line, limits)
+
+    left_line = linearRegression(left_line)
+    right_line = linearRegression(right_line)
+    logging.debug("[CALIBRATION] left line  : %.2f*x+%.2f" %(-left_line[0], left_line[1]))
+    logging.debug("[CALIBRATION] right line : %.2f*x+%.2f" %(-right_line[0], right_line[1]))
+
+    center = interserctLines(left_line, right_line)
+    logging.debug("[CALIBRATION] center @ %s" %(center,))
+
+    # Move zero to image center
+    center = (center[0] - camera.shape[0]/2.0, camera.shape[1]/2.0 - center[1])
+
+    camera.calibrate(turntable, center)
+    sceneLeft.calibrateLaser(center, -left_line[0])
+    sceneRight.calibrateLaser(center, -right_line[0])
+    return center
+
+
+def toVoxelSpace(points, config, voxelSize=10):
+    """ Filter the points of a scan as set in the [Mesher] section and put them in a VoxelSpace """
+    # Remove stray reflections before they reach the mesher
+    stdRatio = config.get('Mesher', 'outlierstd', 0)
+    radius = config.get('Mesher', 'outlierradius', 0)
+    if(stdRatio > 0 or radius > 0):
+        points, report = removeOutliers(points, stdRatio=stdRatio, radius=radius,
+                                        minNeighbors=int(config.get('Mesher', 'outlierneighbors', 3)))
+
+    # Denoise the scan as a range image: height x angle cells of the radius
+    median = int(config.get('Mesher', 'median', 0))
+    holes = int(config.get('Mesher', 'holes', 0))
+    if(median > 1 or holes > 0):
+        points = smoothPoints(points, int(config.get('Mesher', 'angles', 360)),
+                              config.get('Mesher', 'heightstep', 1.0), median, holes)
+
+    space = VoxelSpace(voxelSize)
+    space.addPoints(points)
+
+    # Merge near-duplicate points to a target spacing or number of points
+    spacing = config.get('Mesher', 'spacing', 0)
+    count = config.get('Mesher', 'points', 0)
+    if(spacing > 0 or count > 0):
+        nPoints = space.numberOfPoints()
+        space = space.downsample(spacing=spacing if spacing > 0 else None,
+                                 targetCount=int(count) if count > 0 else None)
+        logging.info("Downsampling %d -> %d points" % (nPoints, space.numberOfPoints()))
+    return space
+
+
+def decimation(config):
+    """ (target number of faces, maximum error) of the [Mesher] section to simplify meshes to, None if both are 0 """
+    faces = int(config.get('Mesher', 'faces', 0))
+    maxError = config.get('Mesher', 'maxerror', 0)
+    if(faces <= 0 and maxError <= 0):
+        return None
+    return (faces if faces > 0 else None, maxError if maxError > 0 else None)
+
+
+def processDirectory(task):
+    """
+    Process the pictures of a scan directory without GUI: calibration,
+    triangulation (in this process) and optional meshing
+    task = (directory, Config object, output directory, mesh, reduce)
+    Return a dict of the timings (seconds), number of points and error if any
+    """
+    directory, config, output, mesh, reduce = task
+    name = os.path.basename(os.path.normpath(directory))
+    result = {'directory': directory, 'points': 0, 'error': None}
+    start = time.time()
+    camera = None
+    try:
+        turntable, camera, sceneLeft, sceneRight = loadScanner(config, directory, reduce)
+        result['load'] = time.time()-start
+
+        calibrate(camera, turntable, sceneLeft, sceneRight)
+        result['calibration'] = time.time()-start-result['load']
+
+        # The pipelines processes cannot be started from a pool worker
+        points = []
+        pictures = None
+        for step in range(turntable.nSteps):
+            imgOff = camera.getPicture("%d_off" %(step))
+            for scene in (sceneRight, sceneLeft):
+                imgOn = camera.getPicture(scene.pictureName(step))
+                if(imgOn is None or imgOff is None):
+                    logging.warning("Missing pictures for step %d in %s" %(step, directory))
+                    continue
+                points += scene.getWorldPoint(imgOn, imgOff, step)
+                pictures = (imgOn, imgOff, scene)
+        result['triangulation'] = time.time()-start-result['load']-result['calibration']
+        if(pictures is not None):
+            imgOn, imgOff, scene = pictures
+            logging.info("%s : %s" %(name, scene.imageProcessor.memoryReport(imgOn, imgOff, scene.getRegion())))
+        if(sceneLeft.cache is not None):
+            logging.info("%s : cache %s" %(name, sceneLeft.cache.report()))
+
+        space = toVoxelSpace(points, config)
+        xyz, colors, normals = pointsToArrays(space.allPoints())
+        result['points'] = len(xyz)
+        writePly(os.path.join(output, name+".ply"), xyz, np.zeros((0, 3), dtype=int), normals, colors)
+        if(mesh):
+            from mesher.bpa import meshBPA
+            meshStart = time.time()
+            meshBPA(space.allPoints(), os.path.join(output, name+"_mesh.ply"), decimation=decimation(config))
+            result['meshing'] = time.time()-meshStart
+    except Exception:
+        result['error'] = traceback.format_exc().strip().split('\n')[-1]
+        logging.exception("\033[31mError while processing %s\033[0m" %(directory))
+    finally:
+        if(camera is not None):
+            camera.release()
+    result['total'] = time.time()-start
+    return result
+
+
+def processDirectories(directories, output, jobs=None, mesh=False, reduce=1):
+    """ Process scan directories in a pool of jobs processes, return their results (see processDirectory) """
+    if(not os.path.exists(output)):
+        os.makedirs(output)
+    # Configs are loaded here: loading creates the pictures directories
+    tasks = [(d, Config(os.path.join(d, 'default.cfg')), output, mesh, reduce) for d in directories]
+    if(jobs == 1):
+        return map(processDirectory, tasks)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(processDirectory, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def summary(results):
+    """ Timing summary of processDirectories results, one line per directory """
+    columns = ('load', 'calibration', 'triangulation', 'meshing', 'total')
+    lines = ["%-30s %8s " % ('directory', 'points') + " ".join("%13s" % c for c in columns)]
+    for result in results:
+        line = "%-30s %8d " % (result['directory'][-30:], result['points'])
+        line += " ".join("%12.2fs" % result[c] if c in result else "%13s" % '-' for c in columns)
+        if(result['error'] is not None):
+            line += "  ERROR: %s" % result['error']
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def test_summary():
+    results = [{'directory': 'scan1', 'points': 12, 'error': None, 'load': 0.1, 'total': 1.5},
+               {'directory': 'scan2', 'points': 0, 'error': 'IOError: x', 'total': 0.2}]
+    lines = summary(results).split('\n')
+    assert len(lines) == 3
+    assert lines[1].startswith('scan1') and '1.50s' in lines[1]
+    assert lines[2].endswith('ERROR: IOError: x')
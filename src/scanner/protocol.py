@@ -0,0 +1,309 @@
+import os
+import pty
+import time
+import logging
+import threading
+import serial
+
+
+class Command:
+    def __init__(self, id, cmd):
+        """ Create a new Command object, the pending reply of one command
+        id  = sequence number of the command
+        cmd = the command character
+        """
+        self.id       = id
+        self.cmd      = cmd
+        self.sent     = time.time()
+        self.received = None
+        self.response = None
+        self.event    = threading.Event()
+
+    def resolve(self, response):
+        self.received = time.time()
+        self.response = response
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """ Return the response, or None if it did not come within timeout seconds """
+        self.event.wait(timeout)
+        return self.response
+
+    def latency(self):
+        return None if self.received is None else self.received - self.sent
+
+
+class SerialProtocol:
+    def __init__(self, port, timeout=5.0, maxInFlight=16):
+        """ Create a new SerialProtocol object, keeping several commands in
+            flight on a serial port. The arduino handles commands in order and
+            echoes each of them on a line, so replies are matched in order too.
+        port        = a serial.Serial object (with a read timeout)
+        timeout     = default time to wait for a reply, in seconds
+        maxInFlight = maximum number of commands sent but not answered
+        """
+        self.port     = port
+        self.timeout  = timeout
+        self.pending  = []
+        self.nextId   = 0
+        self.lock     = threading.Lock()
+        # Held from the queuing of commands to their write: the port gets them in pending order
+        self.writeLock = threading.Lock()
+        self.slots    = threading.Semaphore(maxInFlight)
+        self.running  = True
+        self.thread   = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        partial = ''
+        while(self.running):
+            try:
+                line = self.port.readline()
+            except (serial.SerialException, OSError):
+                if(self.running):
+                    logging.exception("\033[93m Serial port read failed.. \033[0m")
+                break
+            # The port timeout may cut a line: keep its start for the next read
+            partial += line
+            if(not partial.endswith('\n')):
+                continue
+            response, partial = partial.strip(), ''
+            if(response == ''):
+                continue
+            self.match(response)
+
+    def match(self, response):
+        """
+        Resolve the pending command response replies to: the first one,
+        unless response echoes a later one, the replies of the commands
+        before it having been lost (they are resolved with None)
+        """
+        with self.lock:
+            index = 0
+            if(response != '?'):
+                cmds = [command.cmd for command in self.pending]
+                index = cmds.index(response) if response in cmds else -1
+            if(index < 0 or len(self.pending) == 0):
+                command, lost = None, []
+            else:
+                command, lost = self.pending[index], self.pending[:index]
+                del self.pending[:index+1]
+        if(command is None):
+            logging.warning("Unexpected reply from the arduino : %r" % response)
+            return
+        for skipped in lost:
+            logging.warning("Lost the reply to command %r (#%d)" % (skipped.cmd, skipped.id))
+            skipped.resolve(None)
+            self.slots.release()
+        command.resolve(response)
+        self.slots.release()
+
+    def acquireSlot(self, timeout):
+        """ Wait for a command slot at most timeout seconds, return True if one was taken """
+        limit = time.time() + timeout
+        while(not self.slots.acquire(False)):
+            if(time.time() > limit or not self.running):
+                return False
+            time.sleep(0.001)
+        return True
+
+    def send(self, *cmds):
+        """
+        Send commands in one write (several if more than maxInFlight),
+        return their Command objects without waiting for the replies.
+        Commands that found no slot within the timeout are not sent,
+        their Command objects are resolved with None
+        """
+        commands, unsent = [], ''
+        with self.writeLock:
+            for cmd in cmds:
+                if(not self.slots.acquire(False)):
+                    # Too many commands in flight: send what we have, wait for replies
+                    self.port.write(unsent)
+                    unsent = ''
+                    if(not self.acquireSlot(self.timeout)):
+                        logging.error("\033[93m No reply from the arduino, %d commands not sent \033[0m" % (len(cmds)-len(commands)))
+                        break
+                with self.lock:
+                    commands.append(Command(self.nextId, cmd))
+                    self.nextId += 1
+                    self.pending.append(commands[-1])
+                unsent += cmd
+            self.port.write(unsent)
+        for cmd in cmds[len(commands):]:
+            commands.append(Command(-1, cmd))
+            commands[-1].resolve(None)
+        return commands
+
+    def command(self, cmd, timeout=None):
+        """ Send a command and wait for its reply (None on timeout) """
+        return self.wait(self.send(cmd), timeout)[0]
+
+    def wait(self, commands, timeout=None):
+        """ Wait for the replies of commands, return them (None for the ones that timed out) """
+        limit = time.time() + (self.timeout if timeout is None else timeout)
+        responses = []
+        for command in commands:
+            response = command.wait(max(0, limit - time.time()))
+            if(response is None):
+                logging.error("\033[93m No reply to command %r (#%d) \033[0m" % (command.cmd, command.id))
+                self.forget(command)
+            responses.append(response)
+        return responses
+
+    def forget(self, command):
+        """ Stop waiting for the reply of command, freeing its slot """
+        with self.lock:
+            forget = command in self.pending
+            if(forget):
+                self.pending.remove(command)
+        if(forget):
+            self.slots.release()
+        return forget
+
+    def handshake(self, cmd='P', timeout=10.0, interval=0.2):
+        """
+        Poll the arduino with cmd every interval until it answers (it resets
+        when the port is opened). Return True if it answered
+        """
+        limit = time.time() + timeout
+        while(time.time() < limit):
+            command = self.send(cmd)[0]
+            if(command.wait(interval) is not None):
+                return True
+            # Forget the unanswered poll, a late reply resolves the next one
+            if(not self.forget(command) and command.wait(interval) is not None):
+                return True
+        return False
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.port.close()
+
+
+class FakeArduino:
+    def __init__(self, latency=0.001, turnDelay=0.3, bootDelay=0.0):
+        """ Create a new FakeArduino object, emulating the arduino sketch on a
+            pseudo-terminal, to measure the protocol without hardware
+        latency   = time to handle a laser or power command, in seconds
+        turnDelay = time to handle a turn command, in seconds
+        bootDelay = time before the fake arduino answers (reset on port opening)
+        """
+        self.master, self.slave = pty.openpty()
+        self.port      = os.ttyname(self.slave)
+        self.latency   = latency
+        self.turnDelay = turnDelay
+        self.bootTime  = time.time() + bootDelay
+        self.received  = []
+        self.drop      = 0
+        self.mute      = False
+        self.running   = True
+        self.thread    = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while(self.running):
+            try:
+                data = os.read(self.master, 64)
+            except OSError:
+                break
+            for cmd in data:
+                if(time.time() < self.bootTime):
+                    continue
+                if(self.mute):
+                    continue
+                self.received.append(cmd)
+                time.sleep(self.turnDelay if cmd in 'tT' else self.latency)
+                if(self.drop > 0):
+                    # Reply lost on the line
+                    self.drop -= 1
+                    continue
+                os.write(self.master, (cmd if cmd in '0bBlLrRtTpPmM' else '?') + '\r\n')
+
+    def close(self):
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+
+def measure(protocol, cmds, pipelined=True):
+    """
+    Send cmds one by one, waiting for each reply, or all at once (pipelined)
+    Return (total time, list of latencies)
+    """
+    start = time.time()
+    if(pipelined):
+        commands = protocol.send(*cmds)
+        protocol.wait(commands)
+    else:
+        commands = []
+        for cmd in cmds:
+            commands += protocol.send(cmd)
+            protocol.wait(commands[-1:])
+    return time.time() - start, [c.latency() for c in commands]
+
+
+def test_fake_arduino():
+    fake = FakeArduino(latency=0.005, turnDelay=0.02, bootDelay=0.3)
+    protocol = SerialProtocol(serial.Serial(fake.port, 115200, timeout=0.05))
+    try:
+        assert protocol.handshake(timeout=2.0, interval=0.05)
+        assert protocol.command('L') == 'L'
+        commands = protocol.send('l', 'R', 'T')
+        assert protocol.wait(commands) == ['l', 'R', 'T']
+        assert [c.id for c in commands] == [commands[0].id, commands[0].id+1, commands[0].id+2]
+        assert protocol.command('x') == '?'
+        sequential = measure(protocol, 'LlRr'*5, False)[0]
+        pipelined = measure(protocol, 'LlRr'*5, True)[0]
+        assert pipelined < sequential
+    finally:
+        protocol.close()
+        fake.close()
+
+def test_lost_reply():
+    fake = FakeArduino(latency=0.002)
+    protocol = SerialProtocol(serial.Serial(fake.port, 115200, timeout=0.05), timeout=0.5, maxInFlight=2)
+    try:
+        # A lost reply is noticed at the next one
+        fake.drop = 1
+        assert protocol.wait(protocol.send('L', 'l', 'R')) == [None, 'l', 'R']
+        # Timed out commands give their slot back
+        for i in range(3):
+            fake.drop = 1
+            assert protocol.command('r', timeout=0.1) is None
+        assert protocol.wait(protocol.send('L', 'x', 'l')) == ['L', '?', 'l']
+        assert len(protocol.pending) == 0
+    finally:
+        protocol.close()
+        fake.close()
+
+def test_unanswered_send():
+    fake = FakeArduino(latency=0.001)
+    protocol = SerialProtocol(serial.Serial(fake.port, 115200, timeout=0.05), timeout=0.2, maxInFlight=2)
+    try:
+        # More commands than slots to an arduino that does not answer: no hang
+        fake.mute = True
+        start = time.time()
+        commands = protocol.send(*'TTTTT')
+        assert protocol.wait(commands) == [None]*5
+        assert time.time()-start < 2.0 and len(protocol.pending) == 0
+        fake.mute = False
+        # Commands of concurrent senders are written in their pending order
+        results = []
+        def sender(cmds):
+            results.append((cmds, protocol.wait(protocol.send(*cmds), 2.0)))
+        threads = [threading.Thread(target=sender, args=(cmds,)) for cmds in ('LlLl', 'RrRr')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert all(list(cmds) == responses for cmds, responses in results)
+    finally:
+        protocol.close()
+        fake.close()
@@ -2,40 +2,76 @@ import os
 import logging
 import cv2
 import numpy as np
-from .image import ImageProcessor
+from .image import ImageProcessor, compareLines
+from .capture import CaptureSession, SimulatedDevice
+from .loader import FrameLoader
 from .pipeline import Pipeline
 from .douglaspeucker import reduce_pointset
-from mesher.voxel import Point
+from .cache import digest
+from mesher.voxel import Point, pointsToArrays, arraysToPoints
+
+# Undistorted coordinates of all the pixels, by camera calibration
+UNDISTORT_CACHE = dict()
 
 
 class Camera:
-    def __init__(self, port, shape, position, viewAngle, save, processDirectory=None):
+    def __init__(self, port, shape, position, viewAngle, save, processDirectory=None, writer=None, roi=None, reduce=1, distortion=None, latency=0.0):
         """ Create a new Camera object
-        port      = path to the camera
+        port      = path to the camera ("simulated" for a fake camera)
         shape     = (W,H), camera shape Width x Heigth
         position  = [X, Y, Z], camera position
         rotation  = [Rx, Ry, Rz], rotation order (Y->X'->Z")
         viewAngle = <angle>, view angle in degree
         save      = tuple (path where save pictures, extension) or None
         processDirectory = path to the directory of pictures to process (when don't use the scanner)
+        writer    = FrameWriter saving pictures in the background, or None to save them synchronously
+        roi       = (x, y, w, h) part of the pictures that was saved (the rest is black when reading)
+        reduce    = 1, 2, 4 or 8, process pictures at a reduced resolution (processDirectory only)
+        distortion = (k1, k2, p1, p2, k3), OpenCV lens distortion coefficients or None
+        latency   = delay between the exposure of a frame and its delivery, in seconds (see CaptureSession)
         """
 
         logging.debug("Create Camera %s (%.2f, %.2f) @ %s, viewAngle = %.2f" %(port, shape[0], shape[1], position, viewAngle))
 
-        self.camId     = int(port[-1])
-        self.shape     = shape
+        self.camId     = None if port == "simulated" else int(port[-1])
+        self.reduce    = reduce if processDirectory != None else 1
+        self.shape     = (shape[0]/self.reduce, shape[1]/self.reduce)
         self.position  = np.array(position, dtype=np.float32)
-        self.distance  = float(shape[0]/2)/np.tan(np.radians(viewAngle)/2)
+        self.distance  = float(self.shape[0]/2)/np.tan(np.radians(viewAngle)/2)
         self.rotation  = None
         self.save      = save
         self.processDirectory = processDirectory
         self.buffered  = ("", None)
         self.rotationMatrix = np.matrix(np.eye(3))
+        self.session   = None
+        self.writer    = writer
+        self.roi       = roi
+        self.loader    = None
+        self.distortion = None
+        if(distortion is not None and np.any(distortion)):
+            self.distortion = np.zeros(5)
+            self.distortion[:len(distortion)] = distortion
 
         if(self.processDirectory == None):
-            cam = cv2.VideoCapture(self.camId)
-            cam.read()
-            cam.release()
+            # The camera stays open for the whole scan
+            device = self.camId if self.camId is not None else SimulatedDevice(shape)
+            self.session = CaptureSession(device, shape, latency=latency)
+            self.session.start()
+        else:
+            # Pictures are decoded ahead of their use
+            self.loader = FrameLoader(self.processDirectory, self.save[1], shape, roi, reduce=self.reduce)
+
+    def release(self):
+        if(self.session is not None):
+            self.session.stop()
+            self.session = None
+        if(self.writer is not None):
+            self.writer.close()
+            logging.info("Pictures archival : %s" % self.writer.report())
+            self.writer = None
+        if(self.loader is not None):
+            self.loader.close()
+            self.loader = None
 
     def calibrate(self, turnTable, (x,y)):
         ''' Compute Camera rotation from expected and observed turnTable (x,y) center
@@ -67,6 +103,46 @@ class Camera:
                                          [ np.cos(Xyz)*np.sin(Yzx), np.sin(Xyz),  np.cos(Xyz)*np.cos(Yzx)]])
 
 
+    def project(self, points):
+        """ Return the (x, y) pixels of (n,3) world points, NaN for points behind the camera """
+        # Inverse of the ray computation of Scene.triangulate
+        rays = np.asarray(np.linalg.inv(self.rotationMatrix) * np.matrix(np.asarray(points) - self.position).T).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x, y = np.where(rays[:, 2] > 0, rays[:, 0]/rays[:, 2], np.nan), -rays[:, 1]/rays[:, 2]
+        if(self.distortion is not None):
+            k1, k2, p1, p2, k3 = self.distortion
+            r2 = x*x + y*y
+            radial = 1 + k1*r2 + k2*r2**2 + k3*r2**3
+            x, y = x*radial + 2*p1*x*y + p2*(r2 + 2*x*x), y*radial + p1*(r2 + 2*y*y) + 2*p2*x*y
+        return np.column_stack((x*self.distance + self.shape[0]/2.0, y*self.distance + self.shape[1]/2.0))
+
+    def cameraMatrix(self):
+        return np.array([[self.distance, 0, self.shape[0]/2.0],
+                         [0, self.distance, self.shape[1]/2.0],
+                         [0, 0, 1]])
+
+    def undistortTable(self):
+        """ (H, W, 2) undistorted (x, y) of each pixel, computed once by calibration """
+        key = (tuple(self.shape), self.distance, tuple(self.distortion))
+        if(key not in UNDISTORT_CACHE):
+            width, height = int(self.shape[0]), int(self.shape[1])
+            ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+            pixels = np.dstack((xs, ys)).reshape((-1, 1, 2))
+            UNDISTORT_CACHE[key] = cv2.undistortPoints(pixels, self.cameraMatrix(), self.distortion,
+                                                       P=self.cameraMatrix()).reshape((height, width, 2))
+        return UNDISTORT_CACHE[key]
+
+    def undistort(self, pixels):
+        """ (x, y) pixels of a perfect pinhole camera corresponding to (x, y) pixels of the pictures """
+        pixels = np.array(pixels, dtype=float).reshape((-1, 2))
+        if(self.distortion is None or len(pixels) == 0):
+            return pixels
+        # Laser pixels are on the pixels grid: a gather is enough
+        table = self.undistortTable()
+        xs = np.clip(np.rint(pixels[:, 0]).astype(int), 0, table.shape[1]-1)
+        ys = np.clip(np.rint(pixels[:, 1]).astype(int), 0, table.shape[0]-1)
+        return table[ys, xs].astype(float)
+
     def getAngle(self, a, b, c):
         ''' Solve a = b*cos(angle)+c*sin(angle) equation with angle [-pi/2:pi/2]
         '''
@@ -79,7 +155,11 @@ class Camera:
         return ((angle + np.pi/2) % np.pi) - np.pi/2
 
 
-    def getPicture(self, name, toBuffer=False):
+    def getPicture(self, name, toBuffer=False, trigger=None, save=True):
+        """ Return the picture called name
+            trigger = time.time() value the picture must be taken after (default: now)
+            save    = False to leave saving the picture to the caller (see savePicture)
+        """
         picture = None
         if(self.processDirectory == None):
             logging.info('Taking a picture')
@@ -87,37 +167,53 @@ class Camera:
             if(self.buffered[0] == name):
                 picture = self.buffered[1]
             else:
-                cam = cv2.VideoCapture(self.camId)
-                cam.set(3, self.shape[0])
-                cam.set(4, self.shape[1])
-                ok, picture = cam.read()
-                cam.release()
-                if not ok:
+                timestamp, picture = self.session.getFrame(trigger)
+                if picture is None:
                     logging.error("impossible to get a picture from the camera..")
-                elif(len(self.save[0]) > 0):
-                    cv2.imwrite(os.path.join(self.save[0],name+self.save[1]), picture)
+                elif(save):
+                    self.savePicture(name, picture)
   
                 if(toBuffer):
                     self.buffered = (name, np.copy(picture))
         else:
             logging.info('Reading a picture')
-            picture = cv2.imread(os.path.join(self.processDirectory, name+self.save[1]))
+            picture = self.loader.getFrame(name)
 
         return picture
 
+    def savePicture(self, name, picture):
+        if(self.processDirectory == None and picture is not None and len(self.save[0]) > 0):
+            if(self.writer is not None):
+                self.writer.write(name, picture)
+            else:
+                cv2.imwrite(os.path.join(self.save[0],name+self.save[1]), picture)
+
 
 class Scene:
-    def __init__(self, name, camera, laser, turnTable):
+    def __init__(self, name, camera, laser, turnTable, cache=None, tracking=0, pyramid=0, tolerance=1.0):
         """ Create a new scene object
         name   = the name of the scene for pictures names
         camera = the camera object of the scene
         laser  = the laser object of the scene (only on by scene)
         table  = the turntable object of the scene
+        cache  = StepCache object to reuse the results of unchanged steps, or None
+        tracking = search the laser line of a step within tracking columns around
+                   the one of the previous step (0 to search whole lines)
+        pyramid  = find the laser line on pictures reduced 2**pyramid times first (0 for no)
+        tolerance = max difference in pixels of the pyramid results with the full
+                   resolution ones, checked on the first step (pyramid is disabled above)
         """
         self.name       = name
         self.camera     = camera
         self.laser      = laser
         self.turnTable  = turnTable
+        self.cache      = cache
+        self.tracking   = int(tracking)
+        self.previous   = None
+        self.pyramid    = int(pyramid)
+        self.tolerance  = float(tolerance)
+        self.pyramidChecked = False
+        self.examined   = []
         self.imageProcessor = ImageProcessor()
         self.pipeline   = Pipeline(self.getWorldPoint)
         self.result = []
@@ -139,7 +235,7 @@ class Scene:
         self.laser.switch(False)
         imgLaserOff = self.camera.getPicture("calibration_off", True)
 
-        return self.imageProcessor.setCalibrationMask(imgLaserOn, imgLaserOff)
+        return self.camera.undistort(self.imageProcessor.setCalibrationMask(imgLaserOn, imgLaserOff))
 
     def calibrateLaser(self, (x,y), m):
         ''' Compute Laser position and angle from the slope of the laser line on the
@@ -169,26 +265,143 @@ class Scene:
         self.laser.calibrate(np.array([laserX, self.camera.position[1], 0.0], dtype=np.float32), laserAngle)
 
 
+    def getRegion(self, margin=8):
+        """
+        Return the (x, y, w, h) part of the pictures where the laser plane
+        crosses the volume above the turntable (None if the laser is not
+        calibrated or misses the turntable): points are only kept there
+        """
+        if(self.laser.position is None):
+            return None
+        # Segment of the laser plane over the turntable disk (in the XZ plane)
+        origin = self.laser.position[[0, 2]] - self.turnTable.position[[0, 2]]
+        direction = self.laser.v2[[0, 2]]
+        b = np.dot(origin, direction)
+        delta = b**2 - (np.dot(origin, origin) - (self.turnTable.diameter/2.0)**2)
+        if(delta <= 0):
+            return None
+        ends = [self.turnTable.position[[0, 2]] + origin + t*direction for t in (-b-np.sqrt(delta), -b+np.sqrt(delta))]
+        # Objects height is not bounded: go up until the picture top is passed
+        heights = [0.0]+[10.0*2**i for i in range(12)]
+        points = [(x, self.turnTable.position[1]+height, z) for x, z in ends for height in heights]
+        pixels = self.camera.project(np.array(points, dtype=float))
+        pixels = pixels[np.isfinite(pixels[:, 0])]
+        if(len(pixels) == 0):
+            return None
+        width, height = int(self.camera.shape[0]), int(self.camera.shape[1])
+        x0, y0 = np.clip(np.floor(pixels.min(axis=0))-margin, 0, (width, height)).astype(int)
+        x1, y1 = np.clip(np.ceil(pixels.max(axis=0))+margin+1, 0, (width, height)).astype(int)
+        if(x1 <= x0 or y1 <= y0):
+            return None
+        return (x0, y0, x1-x0, y1-y0)
+
+    def detect(self, imgLaserOn, imgLaserOff, region, step):
+        """ Laser pixels of a step, searched around the ones of the previous step when tracking """
+        previous = self.trackedPixels(step)
+        if(previous is not None):
+            cameraPoints, pixels = self.imageProcessor.extractTracked(imgLaserOn, imgLaserOff, previous, self.tracking, region)
+        elif(self.pyramid > 0):
+            cameraPoints, pixels = self.imageProcessor.extractPyramid(imgLaserOn, imgLaserOff, region, self.pyramid)
+            if(not self.pyramidChecked):
+                self.pyramidChecked = True
+                reference = self.imageProcessor.extractPoints(imgLaserOn, imgLaserOff, region)
+                if(not compareLines(cameraPoints, reference, self.tolerance)):
+                    logging.warning("\033[93m Scene %s : pyramid detection does not match the full resolution one, disabled \033[0m" % self.name)
+                    self.pyramid = 0
+                    cameraPoints = reference
+                pixels += region[2]*region[3]
+        else:
+            cameraPoints, pixels = self.imageProcessor.extractPoints(imgLaserOn, imgLaserOff, region), region[2]*region[3]
+        self.examined.append(float(pixels)/(imgLaserOn.shape[0]*imgLaserOn.shape[1]))
+        logging.info("Scene %s step %d : %.1f%% of the pixels examined" %(self.name, step, 100*self.examined[-1]))
+        return cameraPoints
+
+    def trackedPixels(self, step):
+        """ Pixels of the previous step if tracking can be used for step, else None """
+        if(self.tracking > 0 and self.previous is not None and self.previous[0] == step-1):
+            return self.previous[1]
+        return None
+
     def getWorldPoint(self, imgLaserOn, imgLaserOff, step):
+        region = self.getRegion()
+        if(region is None):
+            region = (0, 0, imgLaserOn.shape[1], imgLaserOn.shape[0])
+
+        if(self.cache is None):
+            cameraPoints = self.detect(imgLaserOn, imgLaserOff, region, step)
+            self.previous = (step, np.array(cameraPoints, dtype=float))
+            return self.triangulate(cameraPoints, imgLaserOff, step)
+
+        # Laser pixels depend on the pictures and the extraction settings only,
+        # world points also on the geometry: a calibration change keeps the pixels
+        pixelsKey = digest(imgLaserOn, imgLaserOff, self.imageProcessor.calibrationMask,
+                           self.imageProcessor.parameters(), region, self.tracking, self.trackedPixels(step), self.pyramid)
+        pointsKey = digest(pixelsKey, step, self.geometry())
+
+        # Tracking needs the pixels of each step for the next one
+        cachedPoints = self.cache.load('points', pointsKey)
+        if(cachedPoints is not None and self.tracking == 0):
+            return self.cachedPoints(cachedPoints, step)
+
+        cached = self.cache.load('pixels', pixelsKey)
+        if(cached is not None):
+            cameraPoints = cached['pixels']
+        else:
+            cameraPoints = self.detect(imgLaserOn, imgLaserOff, region, step)
+            self.cache.save('pixels', pixelsKey, pixels=cameraPoints)
+        self.previous = (step, np.array(cameraPoints, dtype=float))
+        if(cachedPoints is not None):
+            return self.cachedPoints(cachedPoints, step)
+
+        # triangulate modifies the pixels in place
+        worldPoints = self.triangulate(np.array(cameraPoints, dtype=float), imgLaserOff, step)
+        xyz, colors, normals = pointsToArrays(worldPoints)
+        lines = np.array([p.origin[2] for p in worldPoints], dtype=int)
+        self.cache.save('points', pointsKey, xyz=xyz, colors=colors, normals=normals, lines=lines)
+        return worldPoints
+
+    def cachedPoints(self, cached, step):
+        origins = [(self.name, step, line) for line in cached['lines']]
+        return arraysToPoints(cached['xyz'], cached['colors'], cached['normals'], origins)
+
+    def geometry(self):
+        """ Calibration and setup values the world points depend on """
+        return {'cameraPosition': self.camera.position, 'cameraRotation': np.asarray(self.camera.rotationMatrix),
+                'cameraDistance': self.camera.distance, 'cameraShape': tuple(self.camera.shape),
+                'cameraDistortion': self.camera.distortion,
+                'laserPosition': self.laser.position, 'laserAngle': self.laser.yAngle,
+                'turnTablePosition': self.turnTable.position, 'turnTableDiameter': self.turnTable.diameter,
+                'stepAngle': self.turnTable.stepAngle}
+
+    def sensorPositions(self, step):
+        """ Positions of the camera and the laser in the coordinates of the points of step (see triangulate) """
+        rotMatrix = self.turnTable.getRotationMatrix(step)
+        positions = []
+        for position in (self.camera.position, self.laser.position):
+            x, y, z = np.asarray(rotMatrix * np.matrix(position - self.turnTable.position).T).ravel()
+            positions.append(np.array([x, z, y]))
+        return positions
+
+    def triangulate(self, cameraPoints, imgLaserOff, step):
         # Intersection of a line and a plane
         # line  : OP = camera.position + lambda * CP
         # plane : OP = laser.position  + alpha * v1  + beta * v2
         #
         # Solve camera.position - laser.position = -lambda * CP + alpha * v1 + beta * v2
 
-        cameraPoints = self.imageProcessor.extractPoints(imgLaserOn, imgLaserOff)
-
         worldPoints = []
         maxRadius = (self.turnTable.diameter/2)**2
 
         rotMatrix = self.turnTable.getRotationMatrix(step)
 
-        for pixel in cameraPoints:
+        # Rays go through the undistorted pixels, colors are read at the pictures ones
+        undistorted = self.camera.undistort(cameraPoints)
+        for pixel, (x, y) in zip(cameraPoints, undistorted):
             pixel2D = tuple(map(int, pixel))
 
             # Move zero to image center
-            pixel[0]=  pixel[0] - self.camera.shape[0]/2.0
-            pixel[1]= -pixel[1] + self.camera.shape[1]/2.0
+            pixel[0]=  x - self.camera.shape[0]/2.0
+            pixel[1]= -y + self.camera.shape[1]/2.0
             # Camera-Ray (CP) vector in camera reference
             CP = np.matrix([pixel[0], pixel[1], self.camera.distance])
             # Rotate Ray in world reference
@@ -211,31 +424,49 @@ class Scene:
 
             # Conserve only points on the table
             if point[1] > 0.5 and (point[0]**2 + point[2]**2) < maxRadius:
+                # Turntable y axis is the height: the z of the points and normals
                 x, z, y = np.array(point.T)[0]
-                nx, ny, nz = np.array(normal.T)[0]
+                nx, nz, ny = np.array(normal.T)[0]
                 # TODO: verify color channels order and indexes order
                 b, g, r = imgLaserOff[pixel2D[1]][pixel2D[0]]
                 worldPoints.append(Point(
                     x=x, y=y, z=z, 
                     r=r, g=g, b=b, 
-                    nx=nx, ny=ny, nz=nz
+                    nx=nx, ny=ny, nz=nz,
+                    origin=(self.name, step, pixel2D[1])
                 ))
                 #logging.debug("%s -> %s" % (str(pixel),str(point.T)))
         
         return reduce_pointset(worldPoints, 2)
 
-    def runStep(self, step, isLastStep):
+    def pictureName(self, step):
+        return "%d_%s" %(step, self.name)
+
+    def feed(self, imgLaserOn, imgLaserOff, step, isLastStep):
+        """ Send the pictures of a step to the processing pipeline """
         if(step == 0):
             self.pipeline.start()
 
-        name = ("%d_%s" %(step, self.name))
+        self.pipeline.feed((imgLaserOn, imgLaserOff, step))
+        if(isLastStep):
+            self.pipeline.terminate()
+
+    def runStep(self, step, isLastStep):
         self.laser.switch(True)
-        imgLaserOn = self.camera.getPicture(name, False)
+        imgLaserOn = self.camera.getPicture(self.pictureName(step), False)
 
-        name = ("%d_%s" %(step, "off"))
         self.laser.switch(False)
-        imgLaserOff = self.camera.getPicture(name, True)
+        imgLaserOff = self.camera.getPicture("%d_off" %(step), True)
 
-        self.pipeline.feed((imgLaserOn, imgLaserOff, step))
-        if(isLastStep):
-            self.pipeline.terminate()
+        self.feed(imgLaserOn, imgLaserOff, step, isLastStep)
+
+
+def test_undistort(tmpdir):
+    points = np.array([[x, 200.0, z] for x in (-150, 0, 150) for z in (250, 400)])
+    pinhole = Camera("simulated", (640, 480), (0, 250, 0), 90, ('', '.png'), str(tmpdir))
+    camera = Camera("simulated", (640, 480), (0, 250, 0), 90, ('', '.png'), str(tmpdir), distortion=(-0.2, 0.05))
+    distorted = camera.project(points)
+    assert np.abs(distorted - pinhole.project(points)).max() > 5
+    # Undistorted at the nearest pixel
+    assert np.abs(camera.undistort(np.rint(distorted)) - pinhole.project(points)).max() < 1
+    assert np.array_equal(pinhole.undistort(distorted), distorted)
@@ -0,0 +1,135 @@
+import time
+import logging
+import threading
+
+
+class Action:
+    def __init__(self, name, method, after, resource=None, step=None):
+        """ Create a new Action object, a node of the scan dependency graph
+        name     = the name of the action for reports
+        method   = the function to call, without arguments
+        after    = list of actions that must be done before this one
+        resource = name of the hardware used: actions on a same resource run
+                   one at a time, in the order they were added
+        step     = the scan step the action belongs to
+        """
+        self.name     = name
+        self.method   = method
+        self.after    = after
+        self.resource = resource
+        self.step     = step
+        self.result   = None
+        self.start    = None
+        self.end      = None
+
+    def duration(self):
+        return self.end - self.start
+
+    def run(self):
+        self.start = time.time()
+        try:
+            self.result = self.method()
+        finally:
+            self.end = time.time()
+
+
+class Scheduler:
+    def __init__(self):
+        """ Create a new Scheduler object, running a graph of actions as soon
+            as their dependencies and resources allow, each in its own thread
+        """
+        self.actions   = []
+        self.resources = dict()
+        self.condition = threading.Condition()
+        self.error     = None
+
+    def add(self, name, method, after=(), resource=None, step=None):
+        after = list(after)
+        if(resource is not None):
+            if(resource in self.resources):
+                after.append(self.resources[resource])
+        action = Action(name, method, after, resource, step)
+        if(resource is not None):
+            self.resources[resource] = action
+        self.actions.append(action)
+        return action
+
+    def execute(self, action):
+        try:
+            action.run()
+        except Exception as err:
+            logging.exception("Action '%s' of step %s failed" % (action.name, action.step))
+            self.error = err
+        with self.condition:
+            self.condition.notify_all()
+
+    def run(self):
+        """ Run all actions, return when they are all done (raise the first error) """
+        waiting = list(self.actions)
+        threads = []
+        with self.condition:
+            while(len(waiting) and self.error is None):
+                ready = [a for a in waiting if all(d.end is not None for d in a.after)]
+                for action in ready:
+                    waiting.remove(action)
+                    thread = threading.Thread(target=self.execute, args=(action,))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                if(len(waiting) and len(ready) == 0):
+                    self.condition.wait(0.5)
+        for thread in threads:
+            thread.join()
+        if(self.error is not None):
+            raise self.error
+
+    def criticalPath(self, step):
+        """
+        Return (time, actions) for a step: the time from its first action start
+        to its last action end, and the chain of actions that determined it,
+        each one started when the last of its dependencies ended
+        """
+        actions = [a for a in self.actions if a.step == step and a.end is not None]
+        if(len(actions) == 0):
+            return 0.0, []
+        first = min(a.start for a in actions)
+        action = max(actions, key=lambda a: a.end)
+        chain = [action]
+        while(len(action.after)):
+            action = max(action.after, key=lambda a: a.end)
+            if(action.step != step):
+                break
+            chain.insert(0, action)
+        return chain[-1].end - first, chain
+
+    def report(self):
+        steps = sorted(set(a.step for a in self.actions if a.step is not None))
+        lines = []
+        for step in steps:
+            total, chain = self.criticalPath(step)
+            lines.append("Step %d : %.3fs (%s)" % (step, total,
+                         " -> ".join("%s %.3fs" % (a.name, a.duration()) for a in chain)))
+        return "\n".join(lines)
+
+
+def test_scheduler_resources():
+    log = []
+    scheduler = Scheduler()
+    scheduler.add("first", lambda: time.sleep(0.05) or log.append("first"), resource="arduino", step=0)
+    scheduler.add("free", lambda: log.append("free"), step=0)
+    last = scheduler.add("last", lambda: log.append("last") or 42, resource="arduino", step=0)
+    scheduler.add("after", lambda: log.append(last.result), after=[last], step=0)
+    scheduler.run()
+    assert log == ["free", "first", "last", 42]
+    total, chain = scheduler.criticalPath(0)
+    assert [a.name for a in chain] == ["first", "last", "after"]
+    assert total >= 0.05
+
+def test_scheduler_overlap():
+    scheduler = Scheduler()
+    scheduler.add("rotate", lambda: time.sleep(0.1), resource="arduino", step=0)
+    scheduler.add("feed", lambda: time.sleep(0.1), step=0)
+    start = time.time()
+    scheduler.run()
+    assert time.time() - start < 0.19
+    assert "Step 0" in scheduler.report()
@@ -0,0 +1,157 @@
+import os
+import time
+import logging
+import threading
+import Queue
+import numpy as np
+import cv2
+
+
+# cv2.imread flags decoding JPEG at 1/1, 1/2, 1/4 or 1/8 of the resolution
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def readFrame(path, shape=None, roi=None, reduce=1):
+    """
+    Read a frame saved by a FrameWriter (.npy or any format cv2 reads)
+    shape  = (W,H), full frame shape, to put back a frame cropped to roi
+    roi    = (x, y, w, h) the frame was cropped to
+    reduce = 1, 2, 4 or 8, decode at a reduced resolution (shape and roi are not reduced)
+    """
+    if(not os.path.exists(path)):
+        frame = None
+    elif(path.endswith('.npy')):
+        # Memory-mapped: only the pages of the rows kept are read
+        frame = np.array(np.load(path, mmap_mode='r')[::reduce, ::reduce])
+    elif(path.lower().endswith(('.jpg', '.jpeg'))):
+        # The JPEG decoder can skip details directly, at a fraction of the cost
+        frame = cv2.imread(path, REDUCED_FLAGS[reduce])
+    else:
+        frame = cv2.imread(path)
+        if(frame is not None and reduce != 1):
+            frame = cv2.resize(frame, None, fx=1.0/reduce, fy=1.0/reduce, interpolation=cv2.INTER_AREA)
+    if(frame is None or roi is None or shape is None):
+        return frame
+    x, y = int(roi[0])/reduce, int(roi[1])/reduce
+    full = np.zeros((int(shape[1])/reduce, int(shape[0])/reduce)+frame.shape[2:], dtype=frame.dtype)
+    frame = frame[:full.shape[0]-y, :full.shape[1]-x]
+    full[y:y+frame.shape[0], x:x+frame.shape[1]] = frame
+    return full
+
+
+class FrameWriter:
+    def __init__(self, directory, extension='.png', workers=2, queueSize=8, compression=3, roi=None):
+        """ Create a new FrameWriter object, saving frames from a pool of
+            threads so that encoding does not stall the capture
+        directory   = path where frames are saved
+        extension   = format of the frames: '.npy' (uncompressed, can be loaded
+                      with np.load(mmap_mode='r')) or any cv2.imwrite format
+        workers     = number of writer threads
+        queueSize   = maximum number of frames waiting, write() blocks beyond
+        compression = PNG compression level (0-9), JPEG quality (0-100) is not changed
+        roi         = (x, y, w, h) part of the frames to keep, or None for full frames
+        """
+        self.directory   = directory
+        self.extension   = extension
+        self.compression = int(compression)
+        self.roi         = None if roi is None else tuple(map(int, roi))
+        self.queue       = Queue.Queue(queueSize)
+        self.lock        = threading.Lock()
+        self.frames      = 0
+        self.bytes       = 0
+        self.encodeTime  = 0.0
+        self.errors      = 0
+        self.threads     = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, name, frame):
+        """ Queue a frame to be saved as name (without extension) """
+        if(frame is None):
+            return
+        if(self.roi is not None):
+            x, y, w, h = self.roi
+            frame = frame[y:y+h, x:x+w]
+        self.queue.put((name, frame))
+
+    def encode(self, path, frame):
+        if(self.extension == '.npy'):
+            np.save(path, np.ascontiguousarray(frame))
+            return True
+        params = []
+        if(self.extension == '.png'):
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+        return cv2.imwrite(path, frame, params)
+
+    def run(self):
+        item = self.queue.get()
+        while(item is not None):
+            name, frame = item
+            path = os.path.join(self.directory, name+self.extension)
+            start = time.time()
+            try:
+                ok = self.encode(path, frame)
+                size = os.path.getsize(path) if ok else 0
+            except:
+                logging.exception("\033[31mError while saving %s\033[0m" % (path))
+                ok, size = False, 0
+            with self.lock:
+                self.encodeTime += time.time()-start
+                self.frames += 1 if ok else 0
+                self.errors += 0 if ok else 1
+                self.bytes += size
+            self.queue.task_done()
+            item = self.queue.get()
+        self.queue.task_done()
+
+    def flush(self):
+        """ Wait until all queued frames are saved """
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def report(self):
+        with self.lock:
+            return ("%d frames saved (%d errors), %.1f MB, encoding %.3fs (%.1f ms/frame)"
+                    % (self.frames, self.errors, self.bytes/1e6, self.encodeTime,
+                       1000*self.encodeTime/max(self.frames, 1)))
+
+
+def test_writer_formats(tmpdir):
+    frame = np.random.RandomState(0).randint(0, 255, (48, 64, 3)).astype(np.uint8)
+    for extension in ('.npy', '.png'):
+        writer = FrameWriter(str(tmpdir), extension, workers=2, queueSize=2, compression=9)
+        for i in range(5):
+            writer.write("%d_left" % i, frame)
+        writer.close()
+        assert writer.frames == 5 and writer.bytes > 0
+        assert np.array_equal(readFrame(str(tmpdir.join("4_left"+extension))), frame)
+
+def test_writer_roi(tmpdir):
+    frame = np.arange(48*64*3).reshape((48, 64, 3)).astype(np.uint8)
+    writer = FrameWriter(str(tmpdir), '.npy', roi=(10, 5, 20, 30))
+    writer.write("0_off", frame)
+    writer.close()
+    path = str(tmpdir.join("0_off.npy"))
+    assert readFrame(path).shape == (30, 20, 3)
+    full = readFrame(path, (64, 48), (10, 5, 20, 30))
+    assert np.array_equal(full[5:35, 10:30], frame[5:35, 10:30])
+    assert full[0].sum() == 0
+    assert readFrame(path, (64, 48), (10, 5, 20, 30), reduce=2).shape == (24, 32, 3)
+
+def test_readFrame_reduce(tmpdir):
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    for extension in ('.png', '.jpg', '.npy'):
+        path = str(tmpdir.join("0_left"+extension))
+        np.save(path, frame) if extension == '.npy' else cv2.imwrite(path, frame)
+        assert readFrame(path, reduce=4).shape == (12, 16, 3)